@@ -1,13 +1,32 @@
 import os
 import re
 import sys
+import json
+import time
+import random
+import signal
+import ssl
+import hashlib
+import argparse
 import logging
 import requests
+import requests.adapters
 import datetime
 import tempfile
+import shutil
+import warnings
+import threading
+import zstandard
+import http.server
+import concurrent.futures
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 import boto3
+import botocore.config
 import botocore.exceptions
 from boto3 import exceptions
 
@@ -132,6 +151,430 @@ if ANNOTATIONS:
         logger.error("At least one of the items the 'ANNOTATIONS' list, contains an invalid K8s annotation key")
         sys.exit(1)
 
+EXCLUDED_NAMESPACES = os.environ.get("EXCLUDED_NAMESPACES")
+if EXCLUDED_NAMESPACES:
+    if not re.match(r"^[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?(,\s*[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?)*$",
+                    EXCLUDED_NAMESPACES):
+        logger.error("At least one of the items the 'EXCLUDED_NAMESPACES' list, contains an invalid Namespace name")
+        sys.exit(1)
+
+EXCLUDED_CONTROLLERS = os.environ.get("EXCLUDED_CONTROLLERS")
+if EXCLUDED_CONTROLLERS:
+    if not re.match(r"^[a-z0-9]([-a-z0-9.]{0,251}[a-z0-9])?(,\s*[a-z0-9]([-a-z0-9.]{0,251}[a-z0-9])?)*$",
+                    EXCLUDED_CONTROLLERS):
+        logger.error("At least one of the items the 'EXCLUDED_CONTROLLERS' list, contains an invalid controller name")
+        sys.exit(1)
+
+KUBECOST_ALLOCATION_API_FILTER = os.environ.get("KUBECOST_ALLOCATION_API_FILTER")
+if KUBECOST_ALLOCATION_API_FILTER:
+    if not re.match(r"^[^\r\n]{1,2048}$", KUBECOST_ALLOCATION_API_FILTER):
+        logger.error("The 'KUBECOST_ALLOCATION_API_FILTER' input must be a single-line Kubecost filter expression, "
+                     "of up to 2048 characters")
+        sys.exit(1)
+
+GLUE_DATABASE_NAME = os.environ.get("GLUE_DATABASE_NAME")
+GLUE_TABLE_NAME = os.environ.get("GLUE_TABLE_NAME")
+GLUE_REGION = os.environ.get("GLUE_REGION")
+GLUE_ENDPOINT_URL = os.environ.get("GLUE_ENDPOINT_URL")
+if GLUE_DATABASE_NAME or GLUE_TABLE_NAME:
+    if not (GLUE_DATABASE_NAME and GLUE_TABLE_NAME and GLUE_REGION):
+        logger.error("The 'GLUE_DATABASE_NAME', 'GLUE_TABLE_NAME' and 'GLUE_REGION' inputs must be given together")
+        sys.exit(1)
+    if not re.match(r"^[a-z0-9_]{1,255}$", GLUE_DATABASE_NAME):
+        logger.error(f"The 'GLUE_DATABASE_NAME' input contains an invalid AWS Glue Database name: {GLUE_DATABASE_NAME}")
+        sys.exit(1)
+    if not re.match(r"^[a-z0-9_]{1,255}$", GLUE_TABLE_NAME):
+        logger.error(f"The 'GLUE_TABLE_NAME' input contains an invalid AWS Glue Table name: {GLUE_TABLE_NAME}")
+        sys.exit(1)
+    if not re.match(r"^(us(-gov)?|ap|ca|cn|eu|sa)-(central|(north|south)?(east|west)?)-\d$", GLUE_REGION):
+        logger.error(f"The 'GLUE_REGION' input contains an invalid region code: {GLUE_REGION}")
+        sys.exit(1)
+if GLUE_ENDPOINT_URL:
+    if not re.match(r"^https?://.+$", GLUE_ENDPOINT_URL):
+        logger.error("The 'GLUE_ENDPOINT_URL' input is invalid. It must be in the format of "
+                     "'http://<name_or_ip>:[port]' or 'https://<name_or_ip>:[port]'")
+        sys.exit(1)
+
+VERIFY_UPLOADS = os.environ.get("VERIFY_UPLOADS", "False").lower()
+if VERIFY_UPLOADS in ["yes", "y", "true"]:
+    VERIFY_UPLOADS = True
+elif VERIFY_UPLOADS in ["no", "n", "false"]:
+    VERIFY_UPLOADS = False
+else:
+    logger.error("The 'VERIFY_UPLOADS' input must be one of "
+                 "'Yes', 'No', 'Y', 'N', 'True' or 'False' (case-insensitive)")
+    sys.exit(1)
+
+try:
+    VERIFY_WORKERS = int(os.environ.get("VERIFY_WORKERS", 16))
+    if VERIFY_WORKERS < 1:
+        logger.error("The 'VERIFY_WORKERS' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'VERIFY_WORKERS' input must be an integer")
+    sys.exit(1)
+
+COLLECTION_STRATEGY = os.environ.get("COLLECTION_STRATEGY", "auto")
+if COLLECTION_STRATEGY not in ["auto", "single", "chunked", "windowed", "paginated"]:
+    logger.error("The 'COLLECTION_STRATEGY' input must be one of "
+                 "'auto', 'single', 'chunked', 'windowed' or 'paginated'")
+    sys.exit(1)
+
+# The exporter always collects in daily step, so "KUBECOST_ALLOCATION_API_PAGINATE" (relevant for 1h step only) has no
+# effect. It's deprecated in favor of the "COLLECTION_STRATEGY" input, and isn't mapped to the "paginated" strategy,
+# as that would change the dataset to hourly rows
+if KUBECOST_ALLOCATION_API_PAGINATE in ["yes", "y", "true"]:
+    logger.warning("The 'KUBECOST_ALLOCATION_API_PAGINATE' input is deprecated and has no effect on the daily "
+                   "collection. Set the 'COLLECTION_STRATEGY' input to 'paginated' to collect with hourly API calls")
+
+try:
+    KUBECOST_SUB_WINDOW_HOURS = int(os.environ.get("KUBECOST_SUB_WINDOW_HOURS", 6))
+    if KUBECOST_SUB_WINDOW_HOURS not in [1, 2, 3, 4, 6, 8, 12]:
+        logger.error("The 'KUBECOST_SUB_WINDOW_HOURS' input must be one of 1, 2, 3, 4, 6, 8 or 12")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'KUBECOST_SUB_WINDOW_HOURS' input must be an integer")
+    sys.exit(1)
+
+try:
+    MEMORY_HEADROOM_PERCENT = float(os.environ.get("MEMORY_HEADROOM_PERCENT", 20))
+    if not 0 <= MEMORY_HEADROOM_PERCENT < 100:
+        logger.error("The 'MEMORY_HEADROOM_PERCENT' input must be a float between 0 and 100 (exclusive)")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'MEMORY_HEADROOM_PERCENT' input must be a float")
+    sys.exit(1)
+
+try:
+    TRANSFORM_CHUNK_SIZE = int(os.environ.get("TRANSFORM_CHUNK_SIZE", 10000))
+    if TRANSFORM_CHUNK_SIZE < 1:
+        logger.error("The 'TRANSFORM_CHUNK_SIZE' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'TRANSFORM_CHUNK_SIZE' input must be an integer")
+    sys.exit(1)
+
+# Estimated memory footprint (in bytes) of a single allocation, used by the memory governor
+# The response footprint covers the raw response body and the decoded (projected) allocation
+# The transform footprint covers the DataFrame of the allocation, including the intermediate copies of the transform
+# The daily row footprint covers a daily row of the DataFrame accumulated from sub-day windows, in the windowed strategy
+# The defaults are conservative, and can be tuned to the allocations of the cluster (e.g. their labels count)
+try:
+    KUBECOST_RESPONSE_BYTES_PER_ALLOCATION = int(os.environ.get("KUBECOST_RESPONSE_BYTES_PER_ALLOCATION", 8 * 1024))
+    if KUBECOST_RESPONSE_BYTES_PER_ALLOCATION < 1:
+        logger.error("The 'KUBECOST_RESPONSE_BYTES_PER_ALLOCATION' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'KUBECOST_RESPONSE_BYTES_PER_ALLOCATION' input must be an integer")
+    sys.exit(1)
+
+try:
+    TRANSFORM_BYTES_PER_ALLOCATION = int(os.environ.get("TRANSFORM_BYTES_PER_ALLOCATION", 16 * 1024))
+    if TRANSFORM_BYTES_PER_ALLOCATION < 1:
+        logger.error("The 'TRANSFORM_BYTES_PER_ALLOCATION' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'TRANSFORM_BYTES_PER_ALLOCATION' input must be an integer")
+    sys.exit(1)
+
+try:
+    DAILY_ROW_BYTES_PER_ALLOCATION = int(os.environ.get("DAILY_ROW_BYTES_PER_ALLOCATION", 2 * 1024))
+    if DAILY_ROW_BYTES_PER_ALLOCATION < 1:
+        logger.error("The 'DAILY_ROW_BYTES_PER_ALLOCATION' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'DAILY_ROW_BYTES_PER_ALLOCATION' input must be an integer")
+    sys.exit(1)
+
+try:
+    KUBECOST_RANGE_FETCH_MAX_DAYS = int(os.environ.get("KUBECOST_RANGE_FETCH_MAX_DAYS", 7))
+    if KUBECOST_RANGE_FETCH_MAX_DAYS < 1:
+        logger.error("The 'KUBECOST_RANGE_FETCH_MAX_DAYS' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'KUBECOST_RANGE_FETCH_MAX_DAYS' input must be an integer")
+    sys.exit(1)
+
+try:
+    LONG_TAIL_FOLD_COST_THRESHOLD = float(os.environ.get("LONG_TAIL_FOLD_COST_THRESHOLD", 0))
+    if LONG_TAIL_FOLD_COST_THRESHOLD < 0:
+        logger.error("The 'LONG_TAIL_FOLD_COST_THRESHOLD' input must be a non-negative float")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'LONG_TAIL_FOLD_COST_THRESHOLD' input must be a float")
+    sys.exit(1)
+
+try:
+    LONG_TAIL_FOLD_MINUTES_THRESHOLD = float(os.environ.get("LONG_TAIL_FOLD_MINUTES_THRESHOLD", 0))
+    if LONG_TAIL_FOLD_MINUTES_THRESHOLD < 0:
+        logger.error("The 'LONG_TAIL_FOLD_MINUTES_THRESHOLD' input must be a non-negative float")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'LONG_TAIL_FOLD_MINUTES_THRESHOLD' input must be a float")
+    sys.exit(1)
+
+LONG_TAIL_FOLD_BY = os.environ.get("LONG_TAIL_FOLD_BY", "namespace")
+if LONG_TAIL_FOLD_BY not in ["namespace", "controller"]:
+    logger.error("The 'LONG_TAIL_FOLD_BY' input must be one of 'namespace' or 'controller'")
+    sys.exit(1)
+
+PARQUET_SORT_COLUMNS = [x.strip() for x in os.environ.get(
+    "PARQUET_SORT_COLUMNS", "properties.namespace, properties.controller, properties.pod, window.start").split(",")
+                        if x.strip()]
+
+try:
+    PARQUET_ROW_GROUP_SIZE = int(os.environ.get("PARQUET_ROW_GROUP_SIZE", 65536))
+    if PARQUET_ROW_GROUP_SIZE < 1:
+        logger.error("The 'PARQUET_ROW_GROUP_SIZE' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'PARQUET_ROW_GROUP_SIZE' input must be an integer")
+    sys.exit(1)
+
+PARQUET_PAGE_INDEX = os.environ.get("PARQUET_PAGE_INDEX", "True").lower()
+if PARQUET_PAGE_INDEX in ["yes", "y", "true"]:
+    PARQUET_PAGE_INDEX = True
+elif PARQUET_PAGE_INDEX in ["no", "n", "false"]:
+    PARQUET_PAGE_INDEX = False
+else:
+    logger.error("The 'PARQUET_PAGE_INDEX' input must be one of "
+                 "'Yes', 'No', 'Y', 'N', 'True' or 'False' (case-insensitive)")
+    sys.exit(1)
+
+PARQUET_BLOOM_FILTER_COLUMNS = [x.strip() for x in os.environ.get("PARQUET_BLOOM_FILTER_COLUMNS", "").split(",")
+                                if x.strip()]
+
+try:
+    PARQUET_BLOOM_FILTER_FPP = float(os.environ.get("PARQUET_BLOOM_FILTER_FPP", 0.05))
+    if not 0 < PARQUET_BLOOM_FILTER_FPP < 1:
+        logger.error("The 'PARQUET_BLOOM_FILTER_FPP' input must be a float between 0 and 1 (exclusive)")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'PARQUET_BLOOM_FILTER_FPP' input must be a float")
+    sys.exit(1)
+
+KUBECOST_CACHE_DIR = os.environ.get("KUBECOST_CACHE_DIR", "")
+if KUBECOST_CACHE_DIR:
+    if not os.path.isabs(KUBECOST_CACHE_DIR):
+        logger.error(f"The 'KUBECOST_CACHE_DIR' input must be an absolute path: {KUBECOST_CACHE_DIR}")
+        sys.exit(1)
+
+try:
+    KUBECOST_CACHE_TTL_HOURS = float(os.environ.get("KUBECOST_CACHE_TTL_HOURS", 72))
+    if KUBECOST_CACHE_TTL_HOURS <= 0:
+        logger.error("The 'KUBECOST_CACHE_TTL_HOURS' input must be a non-zero positive float")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'KUBECOST_CACHE_TTL_HOURS' input must be a float")
+    sys.exit(1)
+
+# The default fits the default 50Mi "/tmp" volume, leaving room for the Parquet files written there
+# At about 0.5KB per compressed allocation, it holds the 3 daily responses of the default TTL, of about 25,000
+# allocations each
+try:
+    KUBECOST_CACHE_MAX_SIZE_MB = float(os.environ.get("KUBECOST_CACHE_MAX_SIZE_MB", 40))
+    if KUBECOST_CACHE_MAX_SIZE_MB <= 0:
+        logger.error("The 'KUBECOST_CACHE_MAX_SIZE_MB' input must be a non-zero positive float")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'KUBECOST_CACHE_MAX_SIZE_MB' input must be a float")
+    sys.exit(1)
+
+KUBECOST_CACHE_REPLAY = os.environ.get("KUBECOST_CACHE_REPLAY", "False").lower()
+if KUBECOST_CACHE_REPLAY in ["yes", "y", "true"]:
+    KUBECOST_CACHE_REPLAY = True
+elif KUBECOST_CACHE_REPLAY in ["no", "n", "false"]:
+    KUBECOST_CACHE_REPLAY = False
+else:
+    logger.error("The 'KUBECOST_CACHE_REPLAY' input must be one of "
+                 "'Yes', 'No', 'Y', 'N', 'True' or 'False' (case-insensitive)")
+    sys.exit(1)
+if KUBECOST_CACHE_REPLAY and not KUBECOST_CACHE_DIR:
+    logger.error("The 'KUBECOST_CACHE_REPLAY' input requires the 'KUBECOST_CACHE_DIR' input to be set")
+    sys.exit(1)
+
+
+OUTPUT_SINK = os.environ.get("OUTPUT_SINK", "parquet").lower()
+if OUTPUT_SINK not in ["parquet", "iceberg", "both"]:
+    logger.error("The 'OUTPUT_SINK' input must be one of 'parquet', 'iceberg' or 'both' (case-insensitive)")
+    sys.exit(1)
+
+ICEBERG_TABLE = os.environ.get("ICEBERG_TABLE", "")
+if ICEBERG_TABLE and not re.match(r"^[\w-]+\.[\w-]+$", ICEBERG_TABLE):
+    logger.error("The 'ICEBERG_TABLE' input must be in the format of '<namespace>.<table>'")
+    sys.exit(1)
+if OUTPUT_SINK != "parquet" and not ICEBERG_TABLE:
+    logger.error(f"The 'OUTPUT_SINK' input is '{OUTPUT_SINK}', so the 'ICEBERG_TABLE' input is required")
+    sys.exit(1)
+
+ICEBERG_CATALOG_NAME = os.environ.get("ICEBERG_CATALOG_NAME", "default")
+
+try:
+    ICEBERG_CATALOG_PROPERTIES = json.loads(os.environ.get("ICEBERG_CATALOG_PROPERTIES") or "{}")
+    if not isinstance(ICEBERG_CATALOG_PROPERTIES, dict):
+        logger.error("The 'ICEBERG_CATALOG_PROPERTIES' input must be a JSON object")
+        sys.exit(1)
+except json.JSONDecodeError:
+    logger.error("The 'ICEBERG_CATALOG_PROPERTIES' input must be a valid JSON object")
+    sys.exit(1)
+
+try:
+    DAEMON_INTERVAL_MINUTES = int(os.environ.get("DAEMON_INTERVAL_MINUTES", 1440))
+    if DAEMON_INTERVAL_MINUTES < 1:
+        logger.error("The 'DAEMON_INTERVAL_MINUTES' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'DAEMON_INTERVAL_MINUTES' input must be an integer")
+    sys.exit(1)
+
+try:
+    DAEMON_JITTER_MINUTES = int(os.environ.get("DAEMON_JITTER_MINUTES", 10))
+    if DAEMON_JITTER_MINUTES < 0:
+        logger.error("The 'DAEMON_JITTER_MINUTES' input must be a non-negative integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'DAEMON_JITTER_MINUTES' input must be an integer")
+    sys.exit(1)
+
+try:
+    DAEMON_PORT = int(os.environ.get("DAEMON_PORT", 8080))
+    if not 1 <= DAEMON_PORT <= 65535:
+        logger.error("The 'DAEMON_PORT' input must be an integer between 1 and 65535")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'DAEMON_PORT' input must be an integer")
+    sys.exit(1)
+
+COLLECTION_LEASE = os.environ.get("COLLECTION_LEASE", "False").lower()
+if COLLECTION_LEASE in ["yes", "y", "true"]:
+    COLLECTION_LEASE = True
+elif COLLECTION_LEASE in ["no", "n", "false"]:
+    COLLECTION_LEASE = False
+else:
+    logger.error("The 'COLLECTION_LEASE' input must be one of "
+                 "'Yes', 'No', 'Y', 'N', 'True' or 'False' (case-insensitive)")
+    sys.exit(1)
+
+COLLECTION_LEASE_PREFIX = os.environ.get("COLLECTION_LEASE_PREFIX", "kubecost_s3_exporter_leases").strip("/")
+if not COLLECTION_LEASE_PREFIX or COLLECTION_LEASE_PREFIX.startswith("account_id="):
+    logger.error("The 'COLLECTION_LEASE_PREFIX' input must be a non-empty S3 prefix, outside of the data prefixes")
+    sys.exit(1)
+
+try:
+    COLLECTION_LEASE_DURATION_MINUTES = int(os.environ.get("COLLECTION_LEASE_DURATION_MINUTES", 60))
+    if COLLECTION_LEASE_DURATION_MINUTES < 1:
+        logger.error("The 'COLLECTION_LEASE_DURATION_MINUTES' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'COLLECTION_LEASE_DURATION_MINUTES' input must be an integer")
+    sys.exit(1)
+
+try:
+    COLLECTION_LEASE_WAIT_MINUTES = int(os.environ.get("COLLECTION_LEASE_WAIT_MINUTES", 0))
+    if COLLECTION_LEASE_WAIT_MINUTES < 0:
+        logger.error("The 'COLLECTION_LEASE_WAIT_MINUTES' input must be a non-negative integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'COLLECTION_LEASE_WAIT_MINUTES' input must be an integer")
+    sys.exit(1)
+
+try:
+    SHARD_COUNT = int(os.environ.get("SHARD_COUNT", 1))
+    if SHARD_COUNT < 1:
+        logger.error("The 'SHARD_COUNT' input must be a positive integer")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'SHARD_COUNT' input must be an integer")
+    sys.exit(1)
+
+# In an Indexed Job, the shard index is taken from the completion index of the pod, if it isn't given explicitly
+try:
+    SHARD_INDEX = int(os.environ.get("SHARD_INDEX") or os.environ.get("JOB_COMPLETION_INDEX") or 0)
+    if not 0 <= SHARD_INDEX < SHARD_COUNT:
+        logger.error("The 'SHARD_INDEX' input must be an integer between 0 and 'SHARD_COUNT' - 1")
+        sys.exit(1)
+except ValueError:
+    logger.error("The 'SHARD_INDEX' input must be an integer")
+    sys.exit(1)
+
+SHARD_NAMESPACES = os.environ.get("SHARD_NAMESPACES")
+if SHARD_NAMESPACES:
+    if not re.match(r"^[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?([,;]\s*[a-z0-9]([-a-z0-9]{0,61}[a-z0-9])?)*$",
+                    SHARD_NAMESPACES):
+        logger.error("At least one of the items the 'SHARD_NAMESPACES' list, contains an invalid Namespace name")
+        sys.exit(1)
+    SHARD_NAMESPACES = [[y.strip() for y in x.split(",")] for x in SHARD_NAMESPACES.split(";")]
+    if len(SHARD_NAMESPACES) != SHARD_COUNT - 1:
+        logger.error("The 'SHARD_NAMESPACES' input must include a Namespace list for each shard except the first one "
+                     "('SHARD_COUNT' - 1 semicolon-separated lists)")
+        sys.exit(1)
+
+SHARD_PREFIX = os.environ.get("SHARD_PREFIX", "kubecost_s3_exporter_shards").strip("/")
+if not SHARD_PREFIX or SHARD_PREFIX.startswith("account_id="):
+    logger.error("The 'SHARD_PREFIX' input must be a non-empty S3 prefix, outside of the data prefixes")
+    sys.exit(1)
+
+RUN_TELEMETRY = os.environ.get("RUN_TELEMETRY", "False").lower()
+if RUN_TELEMETRY in ["yes", "y", "true"]:
+    RUN_TELEMETRY = True
+elif RUN_TELEMETRY in ["no", "n", "false"]:
+    RUN_TELEMETRY = False
+else:
+    logger.error("The 'RUN_TELEMETRY' input must be one of "
+                 "'Yes', 'No', 'Y', 'N', 'True' or 'False' (case-insensitive)")
+    sys.exit(1)
+
+RUN_TELEMETRY_PREFIX = os.environ.get("RUN_TELEMETRY_PREFIX", "kubecost_s3_exporter_telemetry").strip("/")
+if not RUN_TELEMETRY_PREFIX or RUN_TELEMETRY_PREFIX.startswith("account_id="):
+    logger.error("The 'RUN_TELEMETRY_PREFIX' input must be a non-empty S3 prefix, outside of the data prefixes")
+    sys.exit(1)
+
+
+# AWS clients and the Kubecost HTTP session, reused across API calls (and across runs in daemon mode)
+aws_clients = {}
+kubecost_session = requests.Session()
+
+# The telemetry of the current run (reset at the start of each run), written to S3 at the end of the run
+run_telemetry = {}
+
+# The schema of the run telemetry Parquet file
+RUN_TELEMETRY_SCHEMA = pa.schema([
+    ("cluster_id", pa.string()), ("cluster_name", pa.string()), ("shard_index", pa.int32()),
+    ("shard_count", pa.int32()), ("run_start", pa.timestamp("ms")), ("duration_seconds", pa.float64()),
+    ("dates_collected", pa.string()), ("dates_collected_count", pa.int32()), ("dates_uploaded_count", pa.int32()),
+    ("collection_strategies", pa.string()), ("backfill_seconds", pa.float64()),
+    ("kubecost_api_seconds", pa.float64()), ("transform_seconds", pa.float64()), ("output_seconds", pa.float64()),
+    ("merge_seconds", pa.float64()), ("kubecost_api_calls", pa.int64()), ("kubecost_response_bytes", pa.int64()),
+    ("kubecost_cache_hits", pa.int64()), ("rows", pa.int64()), ("folded_allocations", pa.int64()),
+    ("output_bytes", pa.int64()), ("aws_retries", pa.int64()), ("upload_retries", pa.int64()),
+    ("peak_rss_bytes", pa.int64()), ("memory_limit_bytes", pa.int64())
+])
+
+# The fields of the allocation which are summed when accumulating sub-day windows into a daily row
+# The request and usage averages are weighted by minutes, and the other numeric fields are recomputed from the sums
+KUBECOST_ADDITIVE_COLUMNS = ["minutes", "cpuCoreHours", "cpuCost", "cpuCostAdjustment", "gpuHours", "gpuCost",
+                             "gpuCostAdjustment", "networkTransferBytes", "networkReceiveBytes", "networkCost",
+                             "networkCrossZoneCost", "networkCrossRegionCost", "networkInternetCost",
+                             "networkCostAdjustment", "loadBalancerCost", "loadBalancerCostAdjustment", "pvByteHours",
+                             "pvCost", "pvCostAdjustment", "ramByteHours", "ramCost", "ramCostAdjustment",
+                             "sharedCost", "externalCost", "totalCost"]
+KUBECOST_MINUTE_WEIGHTED_COLUMNS = ["cpuCoreRequestAverage", "cpuCoreUsageAverage", "ramByteRequestAverage",
+                                    "ramByteUsageAverage"]
+
+# The name markers of Kubecost's special allocations, which are never folded
+# With "splitIdle" and "idleByNode", the idle allocations are named "<cluster>/<node>/__idle__", so the markers are
+# matched anywhere in the name, the same way Kubecost itself detects them
+KUBECOST_SPECIAL_ALLOCATION_PATTERN = "__idle__|__unallocated__|__unmounted__"
+
+# The columns that identify the synthetic row of the folded long-tail allocations, by the "LONG_TAIL_FOLD_BY" input
+LONG_TAIL_FOLD_KEY_COLUMNS = {
+    "namespace": ["window.start", "window.end", "properties.cluster", "properties.clusterid",
+                  "properties.eksClusterName", "properties.region", "properties.namespace"],
+    "controller": ["window.start", "window.end", "properties.cluster", "properties.clusterid",
+                   "properties.eksClusterName", "properties.region", "properties.namespace",
+                   "properties.controllerKind", "properties.controller"]
+}
+
 
 def create_kubecost_labels_to_k8s_labels_mapping(labels):
     """Creates a dict of the K8s labels keys as they're seen in Kubecost API response, to the original K8s labels keys.
@@ -259,6 +702,52 @@ def define_dataframe_columns(kubecost_labels_to_orig_labels, kubecost_annotation
     return dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations
 
 
+def get_aws_client(service_name, assume_role_response, **client_kwargs):
+    """Returns an AWS client, which is created on first use, and then reused.
+    Reusing the clients keeps their connection pools warm, across API calls, and across runs in daemon mode.
+
+    :param service_name: The AWS service name of the client
+    :param assume_role_response: The Assume Role API call response
+    :param client_kwargs: Additional arguments for the client definition (for example, the region or a botocore config)
+    :return: The AWS client
+    """
+
+    # A botocore config is compared by its options, so that the same config options reuse the same client
+    credentials = assume_role_response["Credentials"] if assume_role_response else {}
+    client_key = (service_name, credentials.get("AccessKeyId"), json.dumps(
+        {k: v._user_provided_options if isinstance(v, botocore.config.Config) else v for k, v in
+         client_kwargs.items()}, sort_keys=True, default=str))
+    if client_key not in aws_clients:
+
+        # Client definition in case the EKS cluster and the AWS service are in different AWS accounts.
+        # This means cross account authentication will be done, so the client contains the parent IAM role credentials
+        if assume_role_response:
+            aws_clients[client_key] = boto3.client(service_name, aws_access_key_id=credentials["AccessKeyId"],
+                                                   aws_secret_access_key=credentials["SecretAccessKey"],
+                                                   aws_session_token=credentials["SessionToken"], **client_kwargs)
+
+        # Client definition in case the EKS cluster and the AWS service are in the same AWS account.
+        # This means cross account authentication isn't necessary, so IRSA credentials will be used
+        else:
+            aws_clients[client_key] = boto3.client(service_name, **client_kwargs)
+
+        aws_clients[client_key].meta.events.register("after-call", count_aws_api_retries)
+
+    return aws_clients[client_key]
+
+
+def count_aws_api_retries(parsed=None, **kwargs):
+    """Counts the retries of an AWS API call (done by Boto3) in the run telemetry, after the call completes.
+
+    :param parsed: The parsed response of the AWS API call
+    :param kwargs: The other arguments of the Boto3 "after-call" event
+    :return:
+    """
+
+    if run_telemetry and isinstance(parsed, dict):
+        run_telemetry["aws_retries"] += parsed.get("ResponseMetadata", {}).get("RetryAttempts", 0)
+
+
 def iam_assume_role(iam_role_arn, iam_role_session_name):
     """Assumes an IAM Role, to be used on all AWS API calls.
 
@@ -268,7 +757,7 @@ def iam_assume_role(iam_role_arn, iam_role_session_name):
     """
 
     try:
-        sts = boto3.client("sts")
+        sts = get_aws_client("sts", None)
         response = sts.assume_role(RoleArn=iam_role_arn, RoleSessionName=iam_role_session_name)
 
         return response
@@ -287,19 +776,7 @@ def secrets_manager_get_secret_value(secret_name, region_code, assume_role_respo
     """
 
     try:
-        # Client definition in case the EKS cluster and AWS Secrets Manager are in different AWS accounts.
-        # This means cross account authentication will be done, so the client contains the parent IAM role credentials
-        if assume_role_response:
-            client = boto3.client("secretsmanager",
-                                  aws_access_key_id=assume_role_response["Credentials"]["AccessKeyId"],
-                                  aws_secret_access_key=assume_role_response["Credentials"]["SecretAccessKey"],
-                                  aws_session_token=assume_role_response["Credentials"]["SessionToken"],
-                                  region_name=region_code)
-
-        # Client definition in case the EKS cluster and AWS Secrets Manager are in the same AWS account.
-        # This means cross account authentication isn't necessary, so IRSA credentials will be used
-        else:
-            client = boto3.client("secretsmanager", region_name=region_code)
+        client = get_aws_client("secretsmanager", assume_role_response, region_name=region_code)
         logger.info(f"Retrieving secret '{secret_name}' from AWS Secrets Manager...")
 
         response = client.get_secret_value(SecretId=secret_name)
@@ -311,26 +788,47 @@ def secrets_manager_get_secret_value(secret_name, region_code, assume_role_respo
         sys.exit(1)
 
 
-def create_ca_cert_file(ca_cert_string):
-    """Creates a CA certificate file from the content of a CA certificate.
-
-    :param ca_cert_string: The CA certificate string (not file)
-    :return: The full path to the root CA certificate and the saved umask
+class KubecostTLSAdapter(requests.adapters.HTTPAdapter):
+    """An HTTP adapter of the Kubecost HTTP session, verifying the Kubecost server certificate using an SSL context.
+    This scopes the root CA certificate to the Kubecost HTTP session, so the AWS clients use the default CA bundle.
     """
 
-    # Creating a temp directory and defining the file name
-    tmpdir = tempfile.mkdtemp()
-    temp_file = tempfile.NamedTemporaryFile(prefix="ca_cert_", suffix=".pem", dir=tmpdir, mode="w", delete=False)
+    def __init__(self, ssl_context, **kwargs):
+        self.ssl_context = ssl_context
+        super().__init__(**kwargs)
 
-    # Ensure the file is read/write by the creator only
-    saved_umask = os.umask(0o077)
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self.ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+
+        # Ignoring CA bundle paths (such as "REQUESTS_CA_BUNDLE" environment variable), as the SSL context is used
+        if kwargs.get("verify") is not False:
+            kwargs["verify"] = True
+        return super().send(request, **kwargs)
+
+    def cert_verify(self, conn, url, verify, cert):
+        super().cert_verify(conn, url, verify, cert)
+
+        # Not loading the default CA bundle of Requests to the SSL context, so only the root CA certificate is trusted
+        if verify is True:
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
+
+
+def create_kubecost_tls_adapter(ca_cert_string):
+    """Creates the HTTP adapter of the Kubecost HTTP session, which trusts the given root CA certificate.
+    The SSL context is created once in memory from the CA certificate content, and reused by all connections.
+
+    :param ca_cert_string: The CA certificate string (not file)
+    :return: The HTTP adapter
+    """
 
-    # Writing the root CA certificate string to the file
     try:
-        temp_file.write(ca_cert_string)
-        return temp_file.name, saved_umask
-    except IOError as e:
-        logger.error(e)
+        return KubecostTLSAdapter(ssl.create_default_context(cadata=ca_cert_string))
+    except (ssl.SSLError, ValueError) as error:
+        logger.error(f"Unable to load the root CA certificate from the secret: {error}")
         sys.exit(1)
 
 
@@ -386,13 +884,6 @@ def get_s3_backfill_period_available_dates(s3_bucket_name, cluster_id, backfill_
     :return: A list of the Kubecost allocation data dates that are available as Parquet files in the S3 bucket
     """
 
-    # Removing the environment variable that is used to specify customer root CA certificate for the Kubecost API
-    # This is so that Python will use the default CA bundle
-    try:
-        del os.environ["REQUESTS_CA_BUNDLE"]
-    except KeyError:
-        pass
-
     # Extracting EKS cluster ARN, account ID and region
     cluster_name = cluster_id.split("/")[-1]
     cluster_account_id = cluster_id.split(":")[4]
@@ -418,17 +909,7 @@ def get_s3_backfill_period_available_dates(s3_bucket_name, cluster_id, backfill_
 
     # Executing the s3:ListObjectsV2 API call
     try:
-        # Client definition in case the EKS cluster and AWS Secrets Manager are in different AWS accounts.
-        # This means cross account authentication will be done, so the client contains the parent IAM role credentials
-        if assume_role_response:
-            client = boto3.client("s3", aws_access_key_id=assume_role_response["Credentials"]["AccessKeyId"],
-                                  aws_secret_access_key=assume_role_response["Credentials"]["SecretAccessKey"],
-                                  aws_session_token=assume_role_response["Credentials"]["SessionToken"])
-
-        # Client definition in case the EKS cluster and AWS Secrets Manager are in the same AWS account.
-        # This means cross account authentication isn't necessary, so IRSA credentials will be used
-        else:
-            client = boto3.client("s3")
+        client = get_aws_client("s3", assume_role_response)
         logger.info(f"Retrieving list of objects for cluster '{cluster_id}' in the last {backfill_period_days} "
                     f"days from S3 Bucket '{s3_bucket_name}'...")
         paginator = client.get_paginator("list_objects_v2")
@@ -500,126 +981,443 @@ def calc_kubecost_dates_missing_from_s3(kubecost_backfill_period_available_dates
         logger.info("All dates for Kubecost data for the backfill period, are available in S3. No collection needed")
 
 
-def execute_kubecost_allocation_api(tls_verify, root_ca_cert_path, kubecost_api_endpoint, start, end, granularity,
-                                    aggregate, connection_timeout, read_timeout, paginate, idle, split_idle,
-                                    idle_by_node, share_tenancy_costs, accumulate):
-    """Executes Kubecost Allocation API.
+def calc_kubecost_range_fetch_dates(kubecost_dates_missing_from_s3, first_date, max_days):
+    """Calculates the run of consecutive missing dates that starts at the given date, to fetch in a single API call.
+    Dates are consecutive if the window of each date starts where the window of the previous date ends.
 
-    :param tls_verify: Dictates whether TLS certificate verification is done for HTTPS connections
-    :param root_ca_cert_path: The full path to the root CA certificate file
-    :param kubecost_api_endpoint: The Kubecost API endpoint, in format of "http://<ip_or_name>:<port>"
-    :param start: The start time for calculating Kubecost Allocation API window
-    :param end: The end time for calculating Kubecost Allocation API window
-    :param granularity: The user input time granularity, to use for calculating the step (daily or hourly)
-    :param aggregate: The K8s object used for aggregation, as per Kubecost Allocation API documentation
-    :param connection_timeout: The timeout (in seconds) to wait for TCP connection establishment
-    :param read_timeout: The timeout (in seconds) to wait for the server to send an HTTP response
-    :param paginate: Dictates whether to paginate using 1-hour time ranges (relevant for "1h" step)
-    :param idle: Dictates whether to include idle costs
-    :param split_idle: Dictates if idle allocations are split (per node or cluster), or aggregated into a single idle
-    :param idle_by_node: When "split_idle" is "True", dictates if idle allocations are split by node or cluster
-    :param share_tenancy_costs: Dictates whether to include shared tenancy costs in the "sharedCost" field
-    :param accumulate: Dictates whether to return data for the entire window, or divide to time sets
-    :return: The Kubecost Allocation API "data" list from the HTTP response
+    :param kubecost_dates_missing_from_s3: The missing dates from S3, mapped to the time window
+    :param first_date: The date that starts the run
+    :param max_days: The maximum number of dates in the run
+    :return: A list of the dates in the run, starting with the given date
     """
 
-    if KUBECOST_CA_CERTIFICATE_SECRET_NAME:
-        os.environ["REQUESTS_CA_BUNDLE"] = root_ca_cert_path
+    dates = list(kubecost_dates_missing_from_s3)
+    range_fetch_dates = [first_date]
+    for date in dates[dates.index(first_date) + 1:]:
+        if len(range_fetch_dates) == max_days or kubecost_dates_missing_from_s3[date]["start"] != \
+                kubecost_dates_missing_from_s3[range_fetch_dates[-1]]["end"]:
+            break
+        range_fetch_dates.append(date)
 
-    # Setting the step
-    step = "1h" if granularity == "hourly" else "1d"
+    return range_fetch_dates
 
-    # Executing Kubecost Allocation API call
-    try:
 
-        # If the step is "1h" and pagination is true, the API call is executed for each hour in the 24-hour timeframe
-        # This is to prevent OOM in the Kubecost/Prometheus containers, and to avoid using high read-timeout value
-        if step == "1h" and paginate in ["yes", "y", "true"]:
+def kubecost_cache_key(kubecost_api_url, params):
+    """Calculates the cache key of a Kubecost API request.
+    The key is a hash of the API URL and the request parameters (window, step, aggregate, idle and sharing flags).
 
-            data = []
-            for n in range(1, 25):
+    :param kubecost_api_url: The full Kubecost API URL, in format of "http://<ip_or_name>:<port>/<path>"
+    :param params: The request parameters of the Kubecost API call
+    :return: The cache key, as a hex string
+    """
 
-                start_h = start + datetime.timedelta(hours=n - 1)
-                end_h = start + datetime.timedelta(hours=n)
+    key_material = json.dumps({"url": kubecost_api_url, "params": params}, sort_keys=True, default=str)
 
-                # Calculating the window and defining the API call requests parameters
-                window = f'{start_h.strftime("%Y-%m-%dT%H:%M:%SZ")},{end_h.strftime("%Y-%m-%dT%H:%M:%SZ")}'
-                if aggregate == "container":
-                    params = {"window": window, "accumulate": accumulate, "step": step, "idle": idle,
-                              "splitIdle": split_idle, "idleByNode": idle_by_node,
-                              "shareTenancyCosts": share_tenancy_costs}
-                else:
-                    params = {"window": window, "aggregate": aggregate, "accumulate": accumulate, "step": step,
-                              "idle": idle, "splitIdle": split_idle, "idleByNode": idle_by_node,
-                              "shareTenancyCosts": share_tenancy_costs}
-
-                # Executing the API call
-                logger.info(f"Querying Kubecost Allocation API for data between {start_h} and {end_h} "
-                            f"in {granularity.lower()} granularity...")
-                r = requests.get(f"{kubecost_api_endpoint}/model/allocation", params=params,
-                                 timeout=(connection_timeout, read_timeout), verify=tls_verify)
-
-                # Adding the hourly allocation data to the list that'll eventually contain a full 24-hour data
-                if r.status_code == 200:
-                    if list(filter(None, r.json()["data"])):
-                        data.append(r.json()["data"][0])
-                else:
-                    try:
-                        logger.error("Kubecost API returned non-200 status code, it returned status code \n"
-                                     f'Error message: {r.json()["error"]}')
-                        sys.exit(1)
-                    except KeyError:
-                        logger.error(f"Kubecost API returned non-200 status code, it returned status code "
-                                     f"{r.status_code}\nError message: {r.json()}")
-            if data:
-                return data
-            else:
-                logger.error("API response appears to be empty.\n"
-                             "This script collects data between 72 hours ago and 48 hours ago.\n"
-                             "Make sure that you have data at least within this timeframe.")
-                sys.exit()
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
 
-        # If the step is "1d", or "1h" without pagination, the API call is executed once to collect the entire timeframe
-        else:
 
-            # Calculating the window and defining the API call requests parameters
-            window = f'{start.strftime("%Y-%m-%dT%H:%M:%SZ")},{end.strftime("%Y-%m-%dT%H:%M:%SZ")}'
-            if aggregate == "container":
-                params = {"window": window, "accumulate": accumulate, "step": step, "idle": idle,
-                          "splitIdle": split_idle, "idleByNode": idle_by_node, "shareTenancyCosts": share_tenancy_costs}
-            else:
-                params = {"window": window, "aggregate": aggregate, "accumulate": accumulate, "step": step,
-                          "idle": idle, "splitIdle": split_idle, "idleByNode": idle_by_node,
-                          "shareTenancyCosts": share_tenancy_costs}
-
-            # Executing the API call
-            logger.info(f"Querying Kubecost Allocation API for data between {start} and {end} "
-                        f"in {granularity.lower()} granularity...")
-            r = requests.get(f"{kubecost_api_endpoint}/model/allocation", params=params,
-                             timeout=(connection_timeout, read_timeout), verify=tls_verify)
-
-            if r.status_code == 200:
-                if list(filter(None, r.json()["data"])):
-                    return list(filter(None, r.json()["data"]))
-                else:
-                    logger.error("API response appears to be empty.\n"
-                                 "This script collects data between 72 hours ago and 48 hours ago.\n"
-                                 "Make sure that you have data at least within this timeframe.")
-                    sys.exit()
-            else:
-                try:
-                    logger.error("Kubecost API returned non-200 status code, it returned status code \n"
-                                 f'Error message: {r.json()["error"]}')
-                    sys.exit(1)
-                except KeyError:
-                    logger.error(f"Kubecost API returned non-200 status code, it returned status code {r.status_code}\n"
-                                 f"Error message: {r.json()}")
+def kubecost_cache_evict(cache_dir, ttl_hours, max_size_mb):
+    """Evicts entries from the local Kubecost response cache.
+    Expired entries (written longer ago than the TTL) are removed first.
+    Then, the least recently used entries are removed until the cache size is within the size limit.
+    The TTL is based on the modification time (when the entry was written), and the recency on the access time.
 
-    except requests.exceptions.ConnectTimeout:
-        logger.error(f"Timed out waiting for TCP connection establishment in the given time ({connection_timeout}s). "
-                     "Consider increasing the connection timeout value.")
+    :param cache_dir: The full path to the cache directory
+    :param ttl_hours: The time (in hours) after which a cache entry expires
+    :param max_size_mb: The maximum total size (in MB) of the cache entries
+    :return:
+    """
+
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if file_name.endswith(".json.zst"):
+            path = os.path.join(cache_dir, file_name)
+            stat = os.stat(path)
+            entries.append((stat.st_atime, stat.st_mtime, stat.st_size, path))
+
+    # Removing expired entries
+    now = time.time()
+    for entry in [x for x in entries if now - x[1] > ttl_hours * 3600]:
+        os.remove(entry[3])
+        entries.remove(entry)
+
+    # Removing the least recently used entries until the cache is within the size limit
+    entries.sort()
+    cache_size = sum(x[2] for x in entries)
+    while entries and cache_size > max_size_mb * 1024 * 1024:
+        atime, mtime, size, path = entries.pop(0)
+        os.remove(path)
+        cache_size -= size
+        logger.info(f"Evicted Kubecost cache entry '{path}' to keep the cache within {max_size_mb}MB")
+
+
+def kubecost_cache_get(cache_dir, cache_key, ttl_hours, replay):
+    """Retrieves a raw Kubecost API response body from the local Kubecost response cache.
+
+    :param cache_dir: The full path to the cache directory
+    :param cache_key: The cache key of the Kubecost API request
+    :param ttl_hours: The time (in hours) after which a cache entry expires
+    :param replay: Dictates whether the cache is used in offline replay mode, where entries never expire
+    :return: The cached Kubecost API response body (bytes), or "None" if it isn't in the cache
+    """
+
+    path = os.path.join(cache_dir, f"{cache_key}.json.zst")
+    try:
+        if not replay and time.time() - os.path.getmtime(path) > ttl_hours * 3600:
+            os.remove(path)
+            return None
+        with open(path, "rb") as f:
+            entry = zstandard.ZstdDecompressor().decompress(f.read())
+
+        # Updating only the access time, so that size-based eviction removes the least recently used entries first
+        # The modification time is kept, so that entries expire by the TTL even if they're read frequently
+        if not replay:
+            os.utime(path, (time.time(), os.path.getmtime(path)))
+
+        # Each entry is a single-line JSON header (the request URL and parameters), followed by the raw response body
+        header, body = entry.split(b"\n", 1)
+
+        return body
+    except FileNotFoundError:
+        return None
+    except (zstandard.ZstdError, ValueError) as error:
+        logger.warning(f"Removing corrupt Kubecost cache entry '{path}': {error}")
+        os.remove(path)
+        return None
+
+
+def kubecost_cache_get_header(path):
+    """Reads only the header (the request URL and parameters) of a local Kubecost response cache entry.
+
+    :param path: The full path to the cache entry
+    :return: The cache entry header
+    """
+
+    with open(path, "rb") as f:
+        reader = zstandard.ZstdDecompressor().stream_reader(f)
+        header = b""
+        while b"\n" not in header:
+            chunk = reader.read(4096)
+            if not chunk:
+                break
+            header += chunk
+
+    return json.loads(header.split(b"\n", 1)[0])
+
+
+def kubecost_cache_put(cache_dir, cache_key, kubecost_api_url, params, body, ttl_hours, max_size_mb):
+    """Stores a raw Kubecost API response body in the local Kubecost response cache, compressed with zstd.
+
+    :param cache_dir: The full path to the cache directory
+    :param cache_key: The cache key of the Kubecost API request
+    :param kubecost_api_url: The full Kubecost API URL, in format of "http://<ip_or_name>:<port>/<path>"
+    :param params: The request parameters of the Kubecost API call
+    :param body: The raw Kubecost API response body (bytes)
+    :param ttl_hours: The time (in hours) after which a cache entry expires
+    :param max_size_mb: The maximum total size (in MB) of the cache entries
+    :return:
+    """
+
+    header = json.dumps({"url": kubecost_api_url, "params": params}, default=str).encode("utf-8")
+    path = os.path.join(cache_dir, f"{cache_key}.json.zst")
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+
+        # Writing to a temp file first, so that a crash never leaves a partially written cache entry
+        with tempfile.NamedTemporaryFile(dir=cache_dir, suffix=".tmp", delete=False) as f:
+            f.write(zstandard.ZstdCompressor(level=3).compress(header + b"\n" + body))
+        os.replace(f.name, path)
+
+        kubecost_cache_evict(cache_dir, ttl_hours, max_size_mb)
+    except OSError as error:
+        logger.warning(f"Unable to store Kubecost API response in the cache: {error}")
+
+
+def kubecost_cache_get_headers(cache_dir):
+    """Reads the headers (the request URL and parameters) of all entries in the local Kubecost response cache.
+
+    :param cache_dir: The full path to the cache directory
+    :return: A dictionary with the cache keys mapped to the header of their entry
+    """
+
+    return {file_name[:-len(".json.zst")]: kubecost_cache_get_header(os.path.join(cache_dir, file_name)) for file_name
+            in sorted(os.listdir(cache_dir)) if file_name.endswith(".json.zst")}
+
+
+def get_kubecost_cache_available_dates(cache_dir, aggregate, sub_window_hours):
+    """Extracts the dates that are available in the local Kubecost response cache, for offline replay mode.
+    The entries are indexed by the dates they cover, for the given aggregation:
+    1. Entries in "1d" step (a single date, or multiple dates of a multi-day API call) cover each date of their window.
+       These dates are replayed from daily rows, and a multi-day entry is split by date when it's replayed.
+    2. Entries of sub-day windows cover a date only if the date's windows are all cached: accumulated windows of
+       "sub_window_hours" hours (the "windowed" strategy), or hourly windows (the "paginated" strategy).
+       These dates are replayed with the collection strategy they were collected with.
+
+    :param cache_dir: The full path to the cache directory
+    :param aggregate: The K8s object used for aggregation, as per Kubecost Allocation API documentation
+    :param sub_window_hours: The number of hours in each sub-day window of the "windowed" strategy
+    :return: A dictionary with the dates available in the cache, mapped to the time window (and the collection strategy
+    for dates that are cached in sub-day windows)
+    """
+
+    kubecost_cache_available_dates = {}
+    sub_day_windows = {}
+    for header in kubecost_cache_get_headers(cache_dir).values():
+        params = header["params"]
+        if params.get("aggregate", "container") != aggregate:
+            continue
+        start, end = [datetime.datetime.strptime(x, "%Y-%m-%dT%H:%M:%SZ") for x in params["window"].split(",")]
+        if params["step"] == "1d" and not params["accumulate"]:
+            while start < end:
+                kubecost_cache_available_dates[start.strftime("%Y-%m-%d")] = {
+                    "start": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    "end": (start + datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")}
+                start += datetime.timedelta(days=1)
+        elif params["accumulate"] and end - start == datetime.timedelta(hours=sub_window_hours):
+            sub_day_windows.setdefault(("windowed", start.strftime("%Y-%m-%d")), set()).add(start)
+        elif not params["accumulate"] and end - start == datetime.timedelta(hours=1):
+            sub_day_windows.setdefault(("paginated", start.strftime("%Y-%m-%d")), set()).add(start)
+
+    # A date is available from sub-day windows only if none of them is missing (dates cached in "1d" step are preferred)
+    for (collection_strategy, date), window_starts in sorted(sub_day_windows.items()):
+        window_hours = sub_window_hours if collection_strategy == "windowed" else 1
+        if date not in kubecost_cache_available_dates and len(window_starts) == 24 // window_hours:
+            start = datetime.datetime.strptime(date, "%Y-%m-%d")
+            kubecost_cache_available_dates[date] = {
+                "start": start.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "end": (start + datetime.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "collection_strategy": collection_strategy}
+
+    kubecost_cache_available_dates = dict(sorted(kubecost_cache_available_dates.items()))
+    if kubecost_cache_available_dates:
+        logger.info(f"Found cached Kubecost data for dates {', '.join(kubecost_cache_available_dates)}")
+    else:
+        logger.info(f"No cached Kubecost data found in '{cache_dir}' for '{aggregate}' aggregation")
+
+    return kubecost_cache_available_dates
+
+
+def kubecost_cache_find_covering_key(cache_dir, kubecost_api_url, params):
+    """Finds a local Kubecost response cache entry in "1d" step that covers the window of a request in "1d" step.
+    This is used in offline replay mode, for replaying a single date from a multi-day API call.
+
+    :param cache_dir: The full path to the cache directory
+    :param kubecost_api_url: The full Kubecost API URL, in format of "http://<ip_or_name>:<port>/<path>"
+    :param params: The request parameters of the Kubecost API call
+    :return: The cache key of the covering entry, or "None" if there's none
+    """
+
+    if params["step"] != "1d" or params["accumulate"]:
+        return None
+
+    start, end = params["window"].split(",")
+    for cache_key, header in kubecost_cache_get_headers(cache_dir).items():
+        cached_start, cached_end = header["params"]["window"].split(",")
+        other_params = {k: v for k, v in header["params"].items() if k != "window"}
+        if header["url"] == kubecost_api_url and other_params == {
+                k: v for k, v in json.loads(json.dumps(params, default=str)).items() if k != "window"} and \
+                cached_start <= start and end <= cached_end:
+            return cache_key
+
+    return None
+
+
+def define_kubecost_allocation_projection(dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations):
+    """Defines the projection of the allocation fields that are kept when decoding Kubecost Allocation API responses.
+    The projection is a nested dict, where a "None" value means the whole subtree is kept.
+    It includes only the fields that end up in the DataFrame, so that the rest of the labels, annotations and the raw
+    per-resource breakdowns are dropped while decoding, instead of being kept in memory until the transform.
+
+    :param dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations:
+    Dictionary of DataFrame columns mapped to their NA/NaN value.
+    This is including columns for K8s label keys and annotations, the way they're represented in Kubecost.
+    :return: The allocation projection, as a nested dict
+    """
+
+    # The node labels that are renamed to "properties." fields, and the timestamps that are updated in the transform
+    allocation_fields = ["start", "end", "window", "properties.labels.node_kubernetes_io_instance_type",
+                         "properties.labels.topology_kubernetes_io_region",
+                         "properties.labels.topology_kubernetes_io_zone", "properties.labels.kubernetes_io_arch",
+                         "properties.labels.kubernetes_io_os"]
+    allocation_fields += list(dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations.keys())
+
+    projection = {}
+    for field in allocation_fields:
+
+        # The window is kept as a whole. Labels and annotations keys are split only once, as they might include dots
+        field_path = ["window"] if field.startswith("window") else field.split(".", 2)
+        subtree = projection
+        for key in field_path[:-1]:
+            subtree = subtree.setdefault(key, {})
+        subtree[field_path[-1]] = None
+
+    return projection
+
+
+def project_kubecost_allocation(allocation, projection):
+    """Keeps only the fields of an allocation that are included in the projection.
+
+    :param allocation: A single allocation from Kubecost Allocation API response
+    :param projection: The allocation projection, as a nested dict
+    :return: The projected allocation
+    """
+
+    projected_allocation = {}
+    for key, sub_projection in projection.items():
+        if key in allocation:
+            value = allocation[key]
+            if sub_projection is not None and isinstance(value, dict):
+                value = project_kubecost_allocation(value, sub_projection)
+            projected_allocation[key] = value
+
+    return projected_allocation
+
+
+def decode_kubecost_allocation_api_response(body, projection):
+    """Decodes a Kubecost Allocation API response body, projecting each allocation while decoding.
+    The JSON decoder builds objects bottom-up, so each allocation is projected as soon as it's decoded.
+    This way, the unneeded subtrees of an allocation are released immediately, and never accumulate in memory.
+
+    :param body: The raw Kubecost Allocation API response body (bytes)
+    :param projection: The allocation projection, as a nested dict. If "None", the response is decoded as is
+    :return: The decoded Kubecost Allocation API response
+    """
+
+    if not projection:
+        return json.loads(body)
+
+    def object_hook(obj):
+        if "properties" in obj and "window" in obj:
+            return project_kubecost_allocation(obj, projection)
+        return obj
+
+    return json.loads(body, object_hook=object_hook)
+
+
+def build_kubecost_allocation_filter(excluded_namespaces, excluded_controllers, allocation_filter):
+    """Builds the Kubecost Allocation API filter, used for narrowing the query server-side.
+    It uses the Kubecost filter language, where "!:" means "not equal" and "+" means "and".
+
+    :param excluded_namespaces: A comma-separated list of namespaces to exclude from the query
+    :param excluded_controllers: A comma-separated list of controller names to exclude from the query
+    :param allocation_filter: An additional raw Kubecost filter expression, as given by the user input
+    :return: The Kubecost filter expression, or an empty string if no filter is needed
+    """
+
+    filters = []
+    if excluded_namespaces:
+        filters.append("namespace!:" + ",".join(f'"{x.strip()}"' for x in excluded_namespaces.split(",")))
+    if excluded_controllers:
+        filters.append("controllerName!:" + ",".join(f'"{x.strip()}"' for x in excluded_controllers.split(",")))
+    if allocation_filter:
+        filters.append(f"({allocation_filter})" if filters else allocation_filter)
+
+    return "+".join(filters)
+
+
+def kubecost_allocation_api_params(window, aggregate, accumulate, step, idle, split_idle, idle_by_node,
+                                   share_tenancy_costs, allocation_filter):
+    """Defines the Kubecost Allocation API request parameters.
+
+    :param window: The window, in format of "<start>,<end>" where both are in "%Y-%m-%dT%H:%M:%SZ" format
+    :param aggregate: The K8s object used for aggregation, as per Kubecost Allocation API documentation
+    :param accumulate: Dictates whether to return data for the entire window, or divide to time sets
+    :param step: The step of the time sets ("1h" or "1d")
+    :param idle: Dictates whether to include idle costs
+    :param split_idle: Dictates if idle allocations are split (per node or cluster), or aggregated into a single idle
+    :param idle_by_node: When "split_idle" is "True", dictates if idle allocations are split by node or cluster
+    :param share_tenancy_costs: Dictates whether to include shared tenancy costs in the "sharedCost" field
+    :param allocation_filter: The Kubecost filter expression. If empty, no filter is used
+    :return: The request parameters dict
+    """
+
+    # The "container" aggregation is the default, so the "aggregate" parameter isn't passed for it
+    if aggregate == "container":
+        params = {"window": window, "accumulate": accumulate, "step": step, "idle": idle, "splitIdle": split_idle,
+                  "idleByNode": idle_by_node, "shareTenancyCosts": share_tenancy_costs}
+    else:
+        params = {"window": window, "aggregate": aggregate, "accumulate": accumulate, "step": step, "idle": idle,
+                  "splitIdle": split_idle, "idleByNode": idle_by_node, "shareTenancyCosts": share_tenancy_costs}
+    if allocation_filter:
+        params["filter"] = allocation_filter
+
+    return params
+
+
+def record_kubecost_api_call_telemetry(api_call_start, response_bytes):
+    """Records a Kubecost API call in the run telemetry (its duration and the size of its response body).
+
+    :param api_call_start: The start time of the Kubecost API call
+    :param response_bytes: The size of the response body (in bytes)
+    :return:
+    """
+
+    if run_telemetry:
+        run_telemetry["kubecost_api_calls"] += 1
+        run_telemetry["kubecost_api_seconds"] += time.time() - api_call_start
+        run_telemetry["kubecost_response_bytes"] += response_bytes
+
+
+def kubecost_api_get(kubecost_api_url, params, connection_timeout, read_timeout, tls_verify, projection):
+    """Executes a Kubecost API GET request, consulting the local Kubecost response cache first (if enabled).
+    Only successful responses are stored in the cache, and they're stored raw (before projection).
+
+    :param kubecost_api_url: The full Kubecost API URL, in format of "http://<ip_or_name>:<port>/<path>"
+    :param params: The request parameters of the Kubecost API call
+    :param connection_timeout: The timeout (in seconds) to wait for TCP connection establishment
+    :param read_timeout: The timeout (in seconds) to wait for the server to send an HTTP response
+    :param tls_verify: Dictates whether TLS certificate verification is done for HTTPS connections
+    :param projection: The allocation projection, as a nested dict. If "None", the response is decoded as is
+    :return: The HTTP status code and the decoded JSON response
+    """
+
+    api_call_start = time.time()
+    try:
+        if KUBECOST_CACHE_DIR:
+            cache_key = kubecost_cache_key(kubecost_api_url, params)
+            cached_body = kubecost_cache_get(KUBECOST_CACHE_DIR, cache_key, KUBECOST_CACHE_TTL_HOURS,
+                                             KUBECOST_CACHE_REPLAY)
+            if cached_body is not None:
+                logger.info(f"Using cached Kubecost API response for window {params['window']}")
+                if run_telemetry:
+                    run_telemetry["kubecost_cache_hits"] += 1
+                return 200, decode_kubecost_allocation_api_response(cached_body, projection)
+
+            # In offline replay mode, a date can also be replayed from a multi-day API call, keeping only its time set
+            covering_cache_key = kubecost_cache_find_covering_key(KUBECOST_CACHE_DIR, kubecost_api_url,
+                                                                  params) if KUBECOST_CACHE_REPLAY else None
+            if covering_cache_key:
+                logger.info(f"Using cached multi-day Kubecost API response for window {params['window']}")
+                if run_telemetry:
+                    run_telemetry["kubecost_cache_hits"] += 1
+                response = decode_kubecost_allocation_api_response(kubecost_cache_get(
+                    KUBECOST_CACHE_DIR, covering_cache_key, KUBECOST_CACHE_TTL_HOURS, True), projection)
+                start, end = params["window"].split(",")
+                response["data"] = [x for x in filter(None, response["data"]) if
+                                    start <= next(iter(x.values()))["window"]["start"] < end]
+                return 200, response
+            if KUBECOST_CACHE_REPLAY:
+                logger.error(f"No cached Kubecost API response found for window {params['window']} in replay mode")
+                sys.exit(1)
+
+        r = kubecost_session.get(kubecost_api_url, params=params, timeout=(connection_timeout, read_timeout),
+                                 verify=tls_verify)
+        record_kubecost_api_call_telemetry(api_call_start, len(r.content))
+
+        if r.status_code != 200:
+            return r.status_code, r.json()
+
+        if KUBECOST_CACHE_DIR:
+            kubecost_cache_put(KUBECOST_CACHE_DIR, cache_key, kubecost_api_url, params, r.content,
+                               KUBECOST_CACHE_TTL_HOURS, KUBECOST_CACHE_MAX_SIZE_MB)
+
+        return r.status_code, decode_kubecost_allocation_api_response(r.content, projection)
+
+    except requests.exceptions.ConnectTimeout:
+        logger.error(f"Timed out waiting for TCP connection establishment in the given time ({connection_timeout}s). "
+                     "Consider increasing the connection timeout value.")
         sys.exit(1)
-    except requests.exceptions.JSONDecodeError as error:
+    except json.JSONDecodeError as error:
         logger.error(f"Original error: '{error}'. "
                      "Check if you're using incorrect protocol in the URL "
                      "(for example, you're using 'http://..' when the API server is using HTTPS).")
@@ -643,6 +1441,138 @@ def execute_kubecost_allocation_api(tls_verify, root_ca_cert_path, kubecost_api_
         sys.exit(1)
 
 
+def execute_kubecost_allocation_api_hourly_pages(tls_verify, kubecost_api_endpoint, start, end, aggregate,
+                                                 connection_timeout, read_timeout, idle, split_idle, idle_by_node,
+                                                 share_tenancy_costs, accumulate, allocation_filter, projection,
+                                                 page_hours=1):
+    """Executes Kubecost Allocation API for each page of hours in the window, in "1h" step, yielding its time set.
+    Being a generator, only one page of allocation data is held in memory, unless the caller keeps all of them.
+
+    :param tls_verify: Dictates whether TLS certificate verification is done for HTTPS connections
+    :param kubecost_api_endpoint: The Kubecost API endpoint, in format of "http://<ip_or_name>:<port>"
+    :param start: The start time for calculating Kubecost Allocation API window
+    :param end: The end time for calculating Kubecost Allocation API window
+    :param aggregate: The K8s object used for aggregation, as per Kubecost Allocation API documentation
+    :param connection_timeout: The timeout (in seconds) to wait for TCP connection establishment
+    :param read_timeout: The timeout (in seconds) to wait for the server to send an HTTP response
+    :param idle: Dictates whether to include idle costs
+    :param split_idle: Dictates if idle allocations are split (per node or cluster), or aggregated into a single idle
+    :param idle_by_node: When "split_idle" is "True", dictates if idle allocations are split by node or cluster
+    :param share_tenancy_costs: Dictates whether to include shared tenancy costs in the "sharedCost" field
+    :param accumulate: Dictates whether to return data for the entire window, or divide to time sets
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :param projection: The allocation projection, used for dropping unneeded fields while decoding the response
+    :param page_hours: The number of hours in each page. With more than one hour, "accumulate" should be "True"
+    :return: A generator of the time set of each page with data (pages without data are skipped)
+    """
+
+    start_h = start
+    while start_h < end:
+        end_h = min(start_h + datetime.timedelta(hours=page_hours), end)
+
+        # Calculating the window and defining the API call requests parameters
+        window = f'{start_h.strftime("%Y-%m-%dT%H:%M:%SZ")},{end_h.strftime("%Y-%m-%dT%H:%M:%SZ")}'
+        params = kubecost_allocation_api_params(window, aggregate, accumulate, "1h", idle, split_idle, idle_by_node,
+                                                share_tenancy_costs, allocation_filter)
+
+        # Executing the API call
+        logger.info(f"Querying Kubecost Allocation API for data between {start_h} and {end_h} in "
+                    f"{'hourly' if page_hours == 1 else 'accumulated'} granularity...")
+        status_code, response = kubecost_api_get(f"{kubecost_api_endpoint}/model/allocation", params,
+                                                 connection_timeout, read_timeout, tls_verify, projection)
+
+        if status_code == 200:
+            if list(filter(None, response["data"])):
+                yield response["data"][0]
+        else:
+            try:
+                logger.error("Kubecost API returned non-200 status code, it returned status code \n"
+                             f'Error message: {response["error"]}')
+                sys.exit(1)
+            except KeyError:
+                logger.error(f"Kubecost API returned non-200 status code, it returned status code "
+                             f"{status_code}\nError message: {response}")
+
+        start_h = end_h
+
+
+def execute_kubecost_allocation_api(tls_verify, kubecost_api_endpoint, start, end, granularity, aggregate,
+                                    connection_timeout, read_timeout, paginate, idle, split_idle, idle_by_node,
+                                    share_tenancy_costs, accumulate, allocation_filter, projection):
+    """Executes Kubecost Allocation API.
+
+    :param tls_verify: Dictates whether TLS certificate verification is done for HTTPS connections
+    :param kubecost_api_endpoint: The Kubecost API endpoint, in format of "http://<ip_or_name>:<port>"
+    :param start: The start time for calculating Kubecost Allocation API window
+    :param end: The end time for calculating Kubecost Allocation API window
+    :param granularity: The user input time granularity, to use for calculating the step (daily or hourly)
+    :param aggregate: The K8s object used for aggregation, as per Kubecost Allocation API documentation
+    :param connection_timeout: The timeout (in seconds) to wait for TCP connection establishment
+    :param read_timeout: The timeout (in seconds) to wait for the server to send an HTTP response
+    :param paginate: Dictates whether to paginate using 1-hour time ranges (relevant for "1h" step)
+    :param idle: Dictates whether to include idle costs
+    :param split_idle: Dictates if idle allocations are split (per node or cluster), or aggregated into a single idle
+    :param idle_by_node: When "split_idle" is "True", dictates if idle allocations are split by node or cluster
+    :param share_tenancy_costs: Dictates whether to include shared tenancy costs in the "sharedCost" field
+    :param accumulate: Dictates whether to return data for the entire window, or divide to time sets
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :param projection: The allocation projection, used for dropping unneeded fields while decoding the response
+    :return: The Kubecost Allocation API "data" list from the HTTP response
+    """
+
+    # Setting the step
+    step = "1h" if granularity == "hourly" else "1d"
+
+    # If the step is "1h" and pagination is true, the API call is executed for each hour in the 24-hour timeframe
+    # This is to prevent OOM in the Kubecost/Prometheus containers, and to avoid using high read-timeout value
+    if step == "1h" and paginate in ["yes", "y", "true"]:
+
+        # Collecting the hourly allocation data to a list that'll eventually contain a full 24-hour data
+        data = list(execute_kubecost_allocation_api_hourly_pages(tls_verify, kubecost_api_endpoint, start,
+                                                                 start + datetime.timedelta(hours=24), aggregate,
+                                                                 connection_timeout, read_timeout, idle, split_idle,
+                                                                 idle_by_node, share_tenancy_costs, accumulate,
+                                                                 allocation_filter, projection))
+        if data:
+            return data
+        else:
+            logger.error("API response appears to be empty.\n"
+                         "This script collects data between 72 hours ago and 48 hours ago.\n"
+                         "Make sure that you have data at least within this timeframe.")
+            sys.exit()
+
+    # If the step is "1d", or "1h" without pagination, the API call is executed once to collect the entire timeframe
+    else:
+
+        # Calculating the window and defining the API call requests parameters
+        window = f'{start.strftime("%Y-%m-%dT%H:%M:%SZ")},{end.strftime("%Y-%m-%dT%H:%M:%SZ")}'
+        params = kubecost_allocation_api_params(window, aggregate, accumulate, step, idle, split_idle, idle_by_node,
+                                                share_tenancy_costs, allocation_filter)
+
+        # Executing the API call
+        logger.info(f"Querying Kubecost Allocation API for data between {start} and {end} "
+                    f"in {granularity.lower()} granularity...")
+        status_code, response = kubecost_api_get(f"{kubecost_api_endpoint}/model/allocation", params,
+                                                 connection_timeout, read_timeout, tls_verify, projection)
+
+        if status_code == 200:
+            if list(filter(None, response["data"])):
+                return list(filter(None, response["data"]))
+            else:
+                logger.error("API response appears to be empty.\n"
+                             "This script collects data between 72 hours ago and 48 hours ago.\n"
+                             "Make sure that you have data at least within this timeframe.")
+                sys.exit()
+        else:
+            try:
+                logger.error("Kubecost API returned non-200 status code, it returned status code \n"
+                             f'Error message: {response["error"]}')
+                sys.exit(1)
+            except KeyError:
+                logger.error(f"Kubecost API returned non-200 status code, it returned status code {status_code}\n"
+                             f"Error message: {response}")
+
+
 def kubecost_allocation_data_add_cluster_id_and_name(allocation_data, cluster_id):
     """Adds the cluster unique ID and name from the CLUSTER_ID input, to each allocation.
     The cluster ID is needed in case we'd like to identify the unique cluster ID in the dataset.
@@ -689,11 +1619,10 @@ def kubecost_allocation_data_timestamp_update(allocation_data):
     return allocation_data_with_updated_timestamps
 
 
-def kubecost_allocation_data_to_parquet(allocation_data,
-                                        dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations,
-                                        kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations,
-                                        date, cluster_id):
-    """Converting Kubecost Allocation data to Parquet.
+def kubecost_allocation_data_to_dataframe(allocation_data,
+                                          dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations,
+                                          kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations):
+    """Converting Kubecost Allocation data to Pandas DataFrame.
 
     :param allocation_data: Kubecost's Allocation data after:
      1. Transforming to a nested list
@@ -703,9 +1632,7 @@ def kubecost_allocation_data_to_parquet(allocation_data,
     This is including columns for K8s label keys, the way they're represented in Kubecost.
     :param kubecost_labels_to_orig_labels: A dict mapping the Kubecost K8s labels keys, to the original K8s labels keys
     :param kubecost_annotations_to_orig_annotations: A dict of Kubecost K8s annotations, to original K8s annotations
-    :param date: The date to use in the Parquet file name
-    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
-    :return: The path to the parquet file and the saved umask
+    :return: The DataFrame, with the final columns and data types
     """
 
     # Converting Kubecost's Allocation data to Pandas DataFrame
@@ -773,137 +1700,1946 @@ def kubecost_allocation_data_to_parquet(allocation_data,
         if kubecost_annotations_to_orig_annotations_only_renamed:
             df = df.rename(columns=kubecost_annotations_to_orig_annotations_only_renamed)
 
-    #                      #
-    # DataFrame to Parquet #
-    #                      #
+    return df
 
-    # Extracting cluster name from the cluster ID
-    cluster_name = cluster_id.split("/")[-1]
 
-    # Creating a temp directory and defining the file name
-    tmpdir = tempfile.mkdtemp()
-    s3_file_name = f"{date}_{cluster_name}.snappy.parquet"
+def accumulate_kubecost_allocation_dataframe(daily_df, df):
+    """Accumulates the DataFrame of a sub-day window into the DataFrame of daily rows, by the allocation name.
+    The additive fields except the minutes are summed, and the request and usage averages are summed weighted by
+    minutes.
+    The minutes are the span from the earliest allocation start to the latest allocation end, the same as in Kubecost's
+    accumulation, so an allocation that is missing from some of the windows spans the gap between them.
+    The other fields are taken from the latest window. The derived fields are recomputed when finalizing the day.
 
-    # Ensure the file is read/write by the creator only
-    saved_umask = os.umask(0o077)
+    :param daily_df: The DataFrame of daily rows accumulated so far, or "None" for the first window
+    :param df: The DataFrame of the sub-day window (or a chunk of it), with the allocation "start" and "end" columns
+    :return: The DataFrame of daily rows, with a single row per allocation name
+    """
 
-    # Full path definition
-    path = os.path.join(tmpdir, s3_file_name)
-    try:
-        # Transforming the DataFrame to a Parquet and creating the Parquet file locally
-        df.to_parquet(path, engine="pyarrow")
-        return path, saved_umask
-    except IOError as e:
-        logger.error(e)
-        sys.exit(1)
+    df = df.assign(**{x: df[x] * df["minutes"] for x in KUBECOST_MINUTE_WEIGHTED_COLUMNS})
+    if daily_df is not None:
+        df = pd.concat([daily_df, df], ignore_index=True)
 
+    sum_columns = [x for x in KUBECOST_ADDITIVE_COLUMNS if x != "minutes"] + KUBECOST_MINUTE_WEIGHTED_COLUMNS
+    last_columns = [x for x in df.columns if x not in sum_columns + ["name", "minutes", "start", "end"]]
+    grouped = df.groupby("name", sort=False)
+    daily_df = pd.concat([grouped[sum_columns].sum(), grouped["start"].min(), grouped["end"].max(),
+                          grouped[last_columns].last()], axis=1).reset_index()
+    daily_df["minutes"] = (daily_df["end"] - daily_df["start"]).dt.total_seconds() / 60
 
-def upload_kubecost_allocation_parquet_to_s3(s3_bucket_name, cluster_id, month, year, assume_role_response,
-                                             parquet_file_path):
-    """Compresses and uploads the Kubecost Allocation Parquet to an S3 bucket.
+    return daily_df[df.columns]
 
-    :param s3_bucket_name: The S3 bucket name to use
-    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
-    :param month: The month to use as part of the S3 bucket prefix
-    :param year: The year to use as part of the S3 bucket prefix
-    :param assume_role_response: The Assume Role API call response
-    :param parquet_file_path: The full path to the Parquet file
-    :return:
+
+def recompute_kubecost_allocation_derived_columns(df):
+    """Recomputes the derived fields of combined allocations, the way Kubecost computes them when combining allocations.
+    The request and usage averages are expected to be summed weighted by minutes, and they're divided by the minutes.
+
+    :param df: The DataFrame of the combined allocations
+    :return: The DataFrame, with the averages and the derived fields recomputed
     """
 
-    # Removing the "REQUESTS_CA_BUNDLE" environment variable, if exists for the Kubecost API calls
-    # This is so that Boto3 will use the default CA bundle to make the TLS connection to AWS API
-    try:
-        del os.environ["REQUESTS_CA_BUNDLE"]
-    except KeyError:
-        pass
+    minutes = df["minutes"]
+    hours = minutes / 60
+    for column in KUBECOST_MINUTE_WEIGHTED_COLUMNS:
+        df[column] = (df[column] / minutes).where(minutes > 0, 0.0)
+    for column, hours_column in [("cpuCores", "cpuCoreHours"), ("gpuCount", "gpuHours"), ("pvBytes", "pvByteHours"),
+                                 ("ramBytes", "ramByteHours")]:
+        df[column] = (df[hours_column] / hours).where(hours > 0, 0.0)
+
+    # If there's usage without a request, the efficiency is 100% (as in Kubecost)
+    for resource, request, usage in [("cpu", "cpuCoreRequestAverage", "cpuCoreUsageAverage"),
+                                     ("ram", "ramByteRequestAverage", "ramByteUsageAverage")]:
+        df[f"{resource}Efficiency"] = (df[usage] / df[request]).where(
+            df[request] > 0, ((df[usage] > 0) & (df[f"{resource}Cost"] > 0)).astype("float64"))
+
+    # The total efficiency is the CPU and RAM efficiencies, weighted by their cost (including adjustments)
+    cpu_cost = df["cpuCost"] + df["cpuCostAdjustment"]
+    ram_cost = df["ramCost"] + df["ramCostAdjustment"]
+    df["totalEfficiency"] = ((df["cpuEfficiency"] * cpu_cost + df["ramEfficiency"] * ram_cost) / (
+        cpu_cost + ram_cost)).where(cpu_cost + ram_cost > 0, 0.0)
+
+    return df
+
+
+def finalize_kubecost_allocation_daily_dataframe(df, date):
+    """Finalizes the DataFrame of daily rows accumulated from sub-day windows.
+    The request and usage averages are divided by the minutes (the span of the allocation), and the derived fields are
+    recomputed. The allocation "start" and "end" columns are dropped, and the window is set to the whole day.
+
+    :param df: The DataFrame of daily rows, as accumulated by "accumulate_kubecost_allocation_dataframe"
+    :param date: The date of the DataFrame, in format of "YYYY-MM-DD"
+    :return: The final DataFrame of daily rows
+    """
 
-    cluster_account_id = cluster_id.split(":")[4]
-    cluster_region_code = cluster_id.split(":")[3]
+    df = recompute_kubecost_allocation_derived_columns(df.drop(columns=["start", "end"]))
+    df["window.start"] = pd.Timestamp(date)
+    df["window.end"] = pd.Timestamp(date) + pd.Timedelta(days=1)
 
-    # S3 file name and prefix definition
-    s3_file_name = parquet_file_path.split("/")[-1]
-    s3_bucket_prefix = f"account_id={cluster_account_id}/region={cluster_region_code}/year={year}/month={month}"
+    return df
 
-    # Uploading the Parquet file to the S3 bucket
-    try:
-        # Client definition in case the EKS cluster and S3 bucket are in different AWS accounts.
-        # This means cross account authentication will be done, so the client contains the parent IAM role credentials
-        if assume_role_response:
-            session = boto3.Session(aws_access_key_id=assume_role_response["Credentials"]["AccessKeyId"],
-                                    aws_secret_access_key=assume_role_response["Credentials"]["SecretAccessKey"],
-                                    aws_session_token=assume_role_response["Credentials"]["SessionToken"])
-            s3 = session.client("s3")
 
-        # Client definition in case the EKS cluster and S3 bucket are in the same AWS account.
-        # This means cross account authentication isn't necessary, so IRSA credentials will be used
-        else:
-            session = boto3.Session()
-            s3 = session.client("s3")
+def fold_kubecost_long_tail_allocations(df, folded_df):
+    """Folds the long-tail allocations of a DataFrame (below the cost or minutes threshold), to cut the row count.
+    The folded allocations are combined per Namespace (or controller) and window, into the DataFrame of the folded
+    allocations, which is finalized to synthetic rows once all chunks were folded. So there's a single synthetic row
+    per Namespace (or controller) and window, even if the allocations are transformed in chunks.
+    The additive fields except the minutes are summed, so the totals of the hours, costs and bytes reconcile with the
+    unfolded data. The minutes are the longest minutes among the folded allocations, so they don't reconcile.
+    Kubecost's special allocations (such as idle allocations) are never folded.
 
-        logger.info(f"Uploading file '{s3_file_name}' to S3 Bucket '{s3_bucket_name}'...")
-        s3.upload_file(parquet_file_path, s3_bucket_name, f"{s3_bucket_prefix}/{s3_file_name}")
-    except boto3.exceptions.S3UploadFailedError as error:
-        logger.error(f"Unable to upload file {s3_file_name} to S3 Bucket '{s3_bucket_name}': {error}")
-        sys.exit(1)
-    except botocore.exceptions.ClientError as error:
-        logger.error(error)
-        sys.exit(1)
+    :param df: The DataFrame of the allocations (or a chunk of them)
+    :param folded_df: The DataFrame of the allocations folded so far, or "None" if none were folded yet
+    :return: The DataFrame without the folded allocations, and the DataFrame of the folded allocations
+    """
 
+    fold_mask = pd.Series(False, index=df.index)
+    if LONG_TAIL_FOLD_COST_THRESHOLD:
+        fold_mask |= df["totalCost"] < LONG_TAIL_FOLD_COST_THRESHOLD
+    if LONG_TAIL_FOLD_MINUTES_THRESHOLD:
+        fold_mask |= df["minutes"] < LONG_TAIL_FOLD_MINUTES_THRESHOLD
+    fold_mask &= ~df["name"].str.contains(KUBECOST_SPECIAL_ALLOCATION_PATTERN)
+
+    if fold_mask.any():
+        folded = df.loc[fold_mask]
+        folded = folded.assign(**{x: folded[x] * folded["minutes"] for x in KUBECOST_MINUTE_WEIGHTED_COLUMNS},
+                               foldedAllocations=1)
+        if folded_df is not None:
+            folded = pd.concat([folded_df, folded[folded_df.columns]], ignore_index=True)
+
+        # The folded allocations run concurrently, so their combined minutes are the longest minutes among them.
+        # Summing them would overstate the duration of the synthetic row, and understate its averages
+        key_columns = LONG_TAIL_FOLD_KEY_COLUMNS[LONG_TAIL_FOLD_BY]
+        sum_columns = [x for x in KUBECOST_ADDITIVE_COLUMNS if x != "minutes"] + KUBECOST_MINUTE_WEIGHTED_COLUMNS + [
+            "foldedAllocations"]
+        grouped = folded.groupby(key_columns, sort=False)
+        folded_df = pd.concat([grouped[sum_columns].sum(), grouped["minutes"].max()], axis=1).reset_index()
+        df = df.loc[~fold_mask]
+
+    return df.assign(foldedAllocations=0), folded_df
+
+
+def finalize_kubecost_folded_allocations_dataframe(folded_df, columns):
+    """Finalizes the DataFrame of the folded long-tail allocations, to a synthetic row per Namespace (or controller)
+    and window. The averages and the derived fields are recomputed, and the other fields are left empty.
+    The synthetic rows are named "__folded__/<namespace>" (or "__folded__/<namespace>/<controller>"), and their
+    "foldedAllocations" column is the number of allocations that were folded into them.
+
+    :param folded_df: The DataFrame of the folded allocations, as combined by "fold_kubecost_long_tail_allocations"
+    :param columns: The columns of the DataFrame of the allocations (including the "foldedAllocations" column)
+    :return: The DataFrame of the synthetic rows
+    """
 
-def main():
+    # All numeric columns are summed or recomputed, so the remaining columns are the string columns
+    string_columns = [x for x in columns if x not in folded_df.columns]
+    df = recompute_kubecost_allocation_derived_columns(folded_df).reindex(columns=columns, fill_value="")
+    df[string_columns] = df[string_columns].astype("string")
 
-    ################
-    # Preparations #
-    ################
+    df["name"] = "__folded__/" + df["properties.namespace"]
+    if LONG_TAIL_FOLD_BY == "controller":
+        df["name"] = df["name"] + "/" + df["properties.controller"]
+    df["properties.pod"] = "__folded__"
 
-    # The below set of functions are used to prepare things needed to execute other logic, as follows:
-    # 1. Define the DataFrame columns
-    # 2. Assume IAM Role to be used in all other AWS API calls
-    # 3. Optionally, retrieve Kubecost root CA certificate from AWS Secrets Manager
+    return df
 
-    # Creating a mapping of Kubecost K8s labels and annotations to original K8s labels and annotations
-    kubecost_labels_to_orig_labels = create_kubecost_labels_to_k8s_labels_mapping(LABELS)
-    kubecost_annotations_to_orig_annotations = create_kubecost_annotations_to_k8s_annotations_mapping(ANNOTATIONS)
 
-    # Defining a mapping of the DataFrame columns to their NA/NaN value
-    dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations = define_dataframe_columns(
-        kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations)
+def check_parquet_columns(schema):
+    """Checks that the sort and bloom filter columns exist in the data, and exits if they don't.
 
-    # In case the EKS cluster and target services (AWS Secret Manager and S3) are in different account:
-    # Assume IAM Role once, to be used in all other AWS API calls
-    # Content of "assume_role_response" will be the sts:AssumeRole API response
-    # Otherwise:
-    # Sets "assume_role_response" to "None"
-    # Functions executing AWS API calls conditionally set their credentials as follows:
-    # If "assume_role_response" has content, using the assumed role credentials
-    # If "assume_role_response" is "None", they won't pass credentials, but will use the IRSA credentials
-    if IRSA_PARENT_IAM_ROLE_ARN:
-        assume_role_response = iam_assume_role(IRSA_PARENT_IAM_ROLE_ARN, "kubecost-s3-exporter")
-    else:
-        assume_role_response = None
+    :param schema: The Arrow schema of the data
+    :return:
+    """
 
-    # If the user gave a secret name as an input to the "KUBECOST_CA_CERTIFICATE_SECRET_NAME" environment variable
-    # 1. The secret with the given name will be retrieved from AWS Secrets Manager
-    # 2. A file will be created from the content of the CA certificate
-    # 3. The "REQUESTS_CA_BUNDLE" will be set with the file path
-    root_ca_cert_path = ""
-    root_ca_cert_saved_umask = ""
-    if KUBECOST_CA_CERTIFICATE_SECRET_NAME:
-        kubecost_ca_cert = secrets_manager_get_secret_value(KUBECOST_CA_CERTIFICATE_SECRET_NAME,
-                                                            KUBECOST_CA_CERTIFICATE_SECRET_REGION, assume_role_response)
-        root_ca_cert_path, root_ca_cert_saved_umask = create_ca_cert_file(kubecost_ca_cert)
+    missing_columns = [x for x in PARQUET_SORT_COLUMNS + PARQUET_BLOOM_FILTER_COLUMNS if x not in schema.names]
+    if missing_columns:
+        logger.error(f"The following sort or bloom filter columns don't exist in the data: "
+                     f"{', '.join(missing_columns)}")
+        sys.exit(1)
 
-    ##################
-    # Backfill logic #
-    ##################
 
-    # The below set of functions is used to calculate which dates should be collected from Kubecost.
-    # This is based on a backfill period in days that is given as an input (default is 15 days).
-    # The logic is as follows:
+def create_parquet_writer(path, schema, bloom_filter_ndv):
+    """Creates the Parquet writer, with the sorting columns, page index and bloom filters settings.
+    The sorting columns are recorded in the row groups metadata, as the file is written sorted.
 
-    # Based on the given backfill period, the following is done:
-    # 1. The window for the Kubecost API call is defined, based on the backfill period.
+    :param path: The full path to the Parquet file
+    :param schema: The Arrow schema of the Parquet file
+    :param bloom_filter_ndv: A dict of the bloom filter columns, mapped to their number of distinct values
+    :return: The Parquet writer
+    """
+
+    check_parquet_columns(schema)
+
+    return pq.ParquetWriter(
+        path, schema, write_page_index=PARQUET_PAGE_INDEX,
+        sorting_columns=pq.SortingColumn.from_ordering(
+            schema, [(x, "ascending") for x in PARQUET_SORT_COLUMNS]) if PARQUET_SORT_COLUMNS else None,
+        bloom_filter_options={x: {"ndv": bloom_filter_ndv[x], "fpp": PARQUET_BLOOM_FILTER_FPP} for x in
+                              PARQUET_BLOOM_FILTER_COLUMNS} or None)
+
+
+def write_dataframe_to_parquet(writer, path, df, run_rows):
+    """Writes a DataFrame to the spill Parquet file, as a sorted run, creating the Parquet writer on the first write.
+    The runs are merged to the final Parquet file once all of them were written (see "write_sorted_parquet").
+
+    :param writer: The Parquet writer of the spill file, or "None" if nothing was written yet
+    :param path: The full path to the spill Parquet file
+    :param df: The DataFrame to write
+    :param run_rows: The row counts of the runs written so far, to which the row count of this run is added
+    :return: The Parquet writer of the spill file
+    """
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if writer is None:
+        check_parquet_columns(table.schema)
+        writer = pq.ParquetWriter(path, table.schema)
+    if PARQUET_SORT_COLUMNS:
+        table = table.sort_by([(x, "ascending") for x in PARQUET_SORT_COLUMNS])
+    writer.write_table(table.cast(writer.schema), row_group_size=PARQUET_ROW_GROUP_SIZE)
+    run_rows.append(len(table))
+
+    return writer
+
+
+def split_parquet_runs(parquet_file, run_rows):
+    """Splits the row groups of a spill Parquet file to its sorted runs.
+    Each run was written as one or more whole row groups, so the runs are found by their row counts.
+
+    :param parquet_file: The spill Parquet file
+    :param run_rows: The row counts of the runs, in the order they were written
+    :return: A list of runs, each a tuple of the Parquet file and the indices of its row groups
+    """
+
+    runs = []
+    row_group = 0
+    for rows in run_rows:
+        row_groups = []
+        while rows > 0:
+            rows -= parquet_file.metadata.row_group(row_group).num_rows
+            row_groups.append(row_group)
+            row_group += 1
+        runs.append((parquet_file, row_groups))
+
+    return runs
+
+
+def conform_table_to_schema(table, schema):
+    """Conforms an Arrow table to a schema, adding the columns it doesn't have as nulls.
+
+    :param table: The Arrow table
+    :param schema: The Arrow schema to conform to (a superset of the table columns)
+    :return: The conformed Arrow table
+    """
+
+    if table.schema.equals(schema):
+        return table
+
+    return pa.Table.from_arrays([table[x.name].cast(x.type) if x.name in table.column_names else pa.nulls(
+        len(table), x.type) for x in schema], schema=schema)
+
+
+def write_sorted_parquet(path, runs, schema, metadata):
+    """Writes sorted runs of rows to the final Parquet file, sorted as a whole (a k-way merge of the runs).
+    Only the sort columns of all rows are read at once, to find the global order of the rows.
+    The rows themselves are streamed from each run in batches, so only a few row groups of rows are in memory.
+    The rows of a run are contiguous within each row group of the final file (the runs are sorted, and the global
+    sort is stable), so each row group is assembled from consecutive slices of the runs.
+    The bloom filters are sized by the number of distinct values of their column (up to the row group size).
+
+    :param path: The full path to the final Parquet file
+    :param runs: A list of runs, each a tuple of a Parquet file and the indices of the row groups of the run
+    :param schema: The Arrow schema of the final Parquet file (the runs may lack some of its columns)
+    :param metadata: The key-value metadata to add to the final Parquet file
+    :return:
+    """
+
+    bloom_filter_ndv = {}
+    for column in PARQUET_BLOOM_FILTER_COLUMNS:
+        values = [x.read_row_groups(row_groups, columns=[column])[column] for x, row_groups in runs if
+                  column in x.schema_arrow.names]
+        distinct_values = pc.count_distinct(pa.chunked_array(
+            [y for x in values for y in x.cast(schema.field(column).type).chunks],
+            schema.field(column).type)).as_py()
+        bloom_filter_ndv[column] = max(1, min(distinct_values, PARQUET_ROW_GROUP_SIZE))
+
+    # The batches are small enough that a batch of every run fits in about a row group, but not tiny
+    writer = create_parquet_writer(path, schema, bloom_filter_ndv)
+    batch_size = max(PARQUET_ROW_GROUP_SIZE // len(runs), min(PARQUET_ROW_GROUP_SIZE, 1024))
+    run_batches = [x.iter_batches(batch_size=batch_size, row_groups=row_groups) for x, row_groups in runs]
+
+    if not PARQUET_SORT_COLUMNS or len(runs) == 1:
+        for batches in run_batches:
+            for batch in batches:
+                writer.write_table(conform_table_to_schema(pa.Table.from_batches([batch]), schema),
+                                   row_group_size=PARQUET_ROW_GROUP_SIZE)
+    else:
+
+        # The global order of the rows, as the index of the run of each row
+        sort_schema = pa.schema([schema.field(x) for x in PARQUET_SORT_COLUMNS])
+        sort_keys = pa.concat_tables([conform_table_to_schema(x.read_row_groups(
+            row_groups, columns=PARQUET_SORT_COLUMNS), sort_schema) for x, row_groups in runs])
+        run_indices = np.repeat(np.arange(len(runs)), [sum(x.metadata.row_group(y).num_rows for y in row_groups)
+                                                        for x, row_groups in runs])
+        run_order = run_indices[pc.sort_indices(sort_keys, sort_keys=[(x, "ascending") for x in
+                                                                      PARQUET_SORT_COLUMNS]).to_numpy()]
+        del sort_keys, run_indices
+
+        run_buffers = [schema.empty_table() for _ in runs]
+        for start in range(0, len(run_order), PARQUET_ROW_GROUP_SIZE):
+            row_group_runs = run_order[start:start + PARQUET_ROW_GROUP_SIZE]
+
+            # Taking the next rows of each run, then interleaving them by the global order
+            slices = []
+            run_rows = np.bincount(row_group_runs, minlength=len(runs))
+            for i in np.flatnonzero(run_rows):
+                rows = run_rows[i]
+                while run_buffers[i].num_rows < rows:
+                    run_buffers[i] = pa.concat_tables([run_buffers[i], conform_table_to_schema(
+                        pa.Table.from_batches([next(run_batches[i])]), schema)])
+                slices.append(run_buffers[i].slice(0, rows))
+                run_buffers[i] = run_buffers[i].slice(rows)
+            slices_order = np.argsort(row_group_runs, kind="stable")
+            take_indices = np.empty_like(slices_order)
+            take_indices[slices_order] = np.arange(len(slices_order))
+            writer.write_table(pa.concat_tables(slices).take(take_indices), row_group_size=PARQUET_ROW_GROUP_SIZE)
+
+    writer.add_key_value_metadata(metadata)
+    writer.close()
+
+
+def remove_parquet_file(path, saved_umask):
+    """Removes a temp Parquet file (with its temp directory), and restores the umask that was saved when it was created.
+
+    :param path: The path to the Parquet file
+    :param saved_umask: The umask to restore
+    :return:
+    """
+
+    shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    os.umask(saved_umask)
+
+
+def kubecost_allocation_data_to_parquet(allocation_data_batches,
+                                        dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations,
+                                        kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations,
+                                        date, cluster_id, chunk_size, collection_strategy):
+    """Converting Kubecost Allocation data to Parquet.
+    The data is given in batches (one per Kubecost Allocation API call), and each batch is transformed in chunks.
+    Each chunk is written to the Parquet file as soon as it's transformed, so only one chunk's DataFrame is in memory.
+    In the "windowed" strategy, each batch is a sub-day window, and the chunks are accumulated into daily rows instead.
+    The daily rows are written once all windows were accumulated, so the file has the same shape as a daily collection.
+    If long-tail folding is enabled, the long-tail allocations are folded before writing, and the synthetic rows of the
+    folded allocations are written once all chunks were folded.
+    The collection strategy and the maximum number of allocations per API call are added to the file metadata.
+    They're used by the memory governor in the next runs, as the allocations count history.
+
+    :param allocation_data_batches: An iterable of Kubecost's Allocation data batches, each after:
+     1. Transforming to a nested list
+     2. Updating timestamps
+    :param dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations:
+    Dictionary of DataFrame columns mapped to their NA/NaN value.
+    This is including columns for K8s label keys, the way they're represented in Kubecost.
+    :param kubecost_labels_to_orig_labels: A dict mapping the Kubecost K8s labels keys, to the original K8s labels keys
+    :param kubecost_annotations_to_orig_annotations: A dict of Kubecost K8s annotations, to original K8s annotations
+    :param date: The date to use in the Parquet file name
+    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
+    :param chunk_size: The maximum number of allocations to transform at once. If "None", each batch is transformed
+    at once
+    :param collection_strategy: The collection strategy used for collecting the data
+    :return: The path to the parquet file, the saved umask and the maximum number of allocations in a single batch
+    """
+
+    # Extracting cluster name from the cluster ID
+    cluster_name = cluster_id.split("/")[-1]
+
+    # Creating a temp directory and defining the file name
+    tmpdir = tempfile.mkdtemp()
+    s3_file_name = f"{date}_{cluster_name}.snappy.parquet"
+
+    # Ensure the file is read/write by the creator only
+    saved_umask = os.umask(0o077)
+
+    # Full path definition
+    # The chunks are written as sorted runs to a spill file, which is merged to the final file once it's complete
+    path = os.path.join(tmpdir, s3_file_name)
+    spill_path = f"{path}.spill"
+    run_rows = []
+    writer = None
+    daily_df = None
+    folded_df = None
+    long_tail_fold = bool(LONG_TAIL_FOLD_COST_THRESHOLD or LONG_TAIL_FOLD_MINUTES_THRESHOLD)
+    max_allocations_per_batch = 0
+    written = False
+    try:
+        for allocation_data in allocation_data_batches:
+            allocations = [allocation for time_set in allocation_data for allocation in time_set]
+            max_allocations_per_batch = max(max_allocations_per_batch, len(allocations))
+            for i in range(0, len(allocations), chunk_size or len(allocations) or 1):
+                chunk = allocations[i:i + chunk_size] if chunk_size else allocations
+                df = kubecost_allocation_data_to_dataframe(
+                    [chunk], dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations,
+                    kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations)
+
+                # The allocation start and end are kept until the day is finalized, for calculating the span minutes
+                if collection_strategy == "windowed":
+                    df["start"] = pd.to_datetime([x["start"] for x in chunk], format="%Y-%m-%d %H:%M:%S.%f")
+                    df["end"] = pd.to_datetime([x["end"] for x in chunk], format="%Y-%m-%d %H:%M:%S.%f")
+                    daily_df = accumulate_kubecost_allocation_dataframe(daily_df, df)
+                    del df
+                    continue
+
+                if long_tail_fold:
+                    df, folded_df = fold_kubecost_long_tail_allocations(df, folded_df)
+                    dataframe_columns = df.columns
+                if len(df):
+                    writer = write_dataframe_to_parquet(writer, spill_path, df, run_rows)
+                del df
+
+        if daily_df is not None:
+            df = finalize_kubecost_allocation_daily_dataframe(daily_df, date)
+            del daily_df
+            if long_tail_fold:
+                df, folded_df = fold_kubecost_long_tail_allocations(df, folded_df)
+                dataframe_columns = df.columns
+            if len(df):
+                writer = write_dataframe_to_parquet(writer, spill_path, df, run_rows)
+            del df
+
+        # The synthetic rows of the folded allocations are written last, so there's one per group and window
+        folded_allocations = 0
+        if folded_df is not None:
+            folded_allocations = int(folded_df["foldedAllocations"].sum())
+            writer = write_dataframe_to_parquet(writer, spill_path, finalize_kubecost_folded_allocations_dataframe(
+                folded_df, dataframe_columns), run_rows)
+            del folded_df
+
+        if writer is None:
+            logger.error("API response appears to be empty.\n"
+                         "This script collects data between 72 hours ago and 48 hours ago.\n"
+                         "Make sure that you have data at least within this timeframe.")
+            sys.exit()
+
+        collection_metadata = {"collection_strategy": collection_strategy,
+                               "max_allocations_per_query": max_allocations_per_batch}
+        if long_tail_fold:
+            collection_metadata["folded_allocations"] = folded_allocations
+        writer.close()
+        spill_file = pq.ParquetFile(spill_path)
+        write_sorted_parquet(path, split_parquet_runs(spill_file, run_rows), spill_file.schema_arrow,
+                             {"kubecost_s3_exporter": json.dumps(collection_metadata)})
+        spill_file.close()
+        os.remove(spill_path)
+        written = True
+
+        return path, saved_umask, max_allocations_per_batch
+    except IOError as e:
+        logger.error(e)
+        sys.exit(1)
+    finally:
+
+        # If the conversion failed (including the exit on an empty response), the partial file is removed
+        if not written:
+            if writer is not None:
+                writer.close()
+            remove_parquet_file(path, saved_umask)
+
+
+def get_cgroup_memory_limit_and_usage():
+    """Reads the memory limit and the current memory usage of the container, from its cgroup (v2 or v1).
+
+    :return: The memory limit and the memory usage, in bytes.
+    The limit is "None" if there's no limit, and both are "None" if the cgroup files aren't available.
+    """
+
+    cgroup_files = [("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current"),
+                    ("/sys/fs/cgroup/memory/memory.limit_in_bytes", "/sys/fs/cgroup/memory/memory.usage_in_bytes")]
+    for limit_file, usage_file in cgroup_files:
+        try:
+            with open(limit_file) as f:
+                memory_limit = f.read().strip()
+            with open(usage_file) as f:
+                memory_usage = int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+
+        # cgroup v2 uses "max" when there's no limit, and cgroup v1 uses a very large number
+        if memory_limit == "max" or int(memory_limit) >= 2 ** 62:
+            return None, memory_usage
+        return int(memory_limit), memory_usage
+
+    return None, None
+
+
+def get_kubecost_allocations_history_from_s3(s3_bucket_name, cluster_id, date, assume_role_response):
+    """Retrieves the allocations count of a previous collection, from the footer of its Parquet file in S3.
+    The collection strategy and the maximum number of allocations per API call are in the file metadata.
+    For files without this metadata, the row count is used, as they were collected in a single daily API call.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
+    :param date: The date of the Parquet file to read
+    :param assume_role_response: The Assume Role API call response
+    :return: A dict with the allocations per day or per hour and the source, or "None" if it isn't available
+    """
+
+    cluster_name = cluster_id.split("/")[-1]
+    cluster_account_id = cluster_id.split(":")[4]
+    cluster_region_code = cluster_id.split(":")[3]
+    year, month = date.split("-")[0:2]
+    s3_key = (f"account_id={cluster_account_id}/region={cluster_region_code}/year={year}/month={month}/"
+              f"{date}_{cluster_name}.snappy.parquet")
+
+    try:
+        client = get_aws_client("s3", assume_role_response)
+
+        metadata = read_s3_parquet_footer(client, s3_bucket_name, s3_key)
+    except (botocore.exceptions.ClientError, ValueError, OSError) as error:
+        logger.info(f"Unable to read the allocations count history from '{s3_key}': {error}")
+        return None
+
+    collection_metadata = json.loads((metadata.metadata or {}).get(b"kubecost_s3_exporter", b"{}"))
+    if collection_metadata.get("collection_strategy") == "paginated":
+        return {"allocations_per_hour": collection_metadata["max_allocations_per_query"],
+                "source": f"the Parquet file of {date}"}
+
+    # In the windowed strategy, the file has daily rows, and each API call is a sub-day window (at least an hour)
+    # The folded long-tail allocations are added to the rows, as they're accumulated before they're folded
+    if collection_metadata.get("collection_strategy") == "windowed":
+        return {"allocations_per_day": metadata.num_rows + collection_metadata.get("folded_allocations", 0),
+                "allocations_per_hour": collection_metadata["max_allocations_per_query"],
+                "source": f"the Parquet file of {date}"}
+
+    return {"allocations_per_day": collection_metadata.get("max_allocations_per_query", metadata.num_rows),
+            "source": f"the Parquet file of {date}"}
+
+
+def probe_kubecost_allocations_count(tls_verify, kubecost_api_endpoint, end, aggregate, connection_timeout,
+                                     read_timeout, allocation_filter):
+    """Probes the number of allocations, by querying Kubecost Allocation API for the last hour of the window only.
+    This is much cheaper than querying the whole day, and it's used when there's no allocations count history.
+
+    :param tls_verify: Dictates whether TLS certificate verification is done for HTTPS connections
+    :param kubecost_api_endpoint: The Kubecost API endpoint, in format of "http://<ip_or_name>:<port>"
+    :param end: The end time of the window
+    :param aggregate: The K8s object used for aggregation, as per Kubecost Allocation API documentation
+    :param connection_timeout: The timeout (in seconds) to wait for TCP connection establishment
+    :param read_timeout: The timeout (in seconds) to wait for the server to send an HTTP response
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :return: A dict with the allocations per hour and the source, or "None" if the probe returned no allocations
+    """
+
+    start = end - datetime.timedelta(hours=1)
+    window = f'{start.strftime("%Y-%m-%dT%H:%M:%SZ")},{end.strftime("%Y-%m-%dT%H:%M:%SZ")}'
+    params = kubecost_allocation_api_params(window, aggregate, True, "1h", True, True, True, True, allocation_filter)
+
+    # Only the allocation names are kept while decoding, as only the count is needed
+    logger.info(f"Probing Kubecost Allocation API for the allocations count between {start} and {end}...")
+    status_code, response = kubecost_api_get(f"{kubecost_api_endpoint}/model/allocation", params, connection_timeout,
+                                             read_timeout, tls_verify, {"name": None})
+    allocations_per_hour = sum(len(x) for x in filter(None, response.get("data") or [])) if status_code == 200 else 0
+
+    # An empty response can't be told apart from a failed probe, so both leave the allocations count unknown
+    if not allocations_per_hour:
+        logger.warning(f"The allocations count probe returned no allocations (status code {status_code})")
+        return None
+
+    return {"allocations_per_hour": allocations_per_hour, "source": f"a probe of the hour before {end}"}
+
+
+def get_kubecost_namespaces(start, end, allocation_filter):
+    """Retrieves the Namespaces with allocations in the window, using a single accumulated Kubecost Allocation API call.
+    The call is aggregated by Namespace, so its response is small, and only the Namespace names are kept while decoding.
+
+    :param start: The start time of the window
+    :param end: The end time of the window
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :return: A sorted list of the Namespace names (without Kubecost's special allocations, such as "__idle__")
+    """
+
+    allocation_data = execute_kubecost_allocation_api(
+        TLS_VERIFY, KUBECOST_API_ENDPOINT, start, end, "daily", "namespace", CONNECTION_TIMEOUT,
+        KUBECOST_ALLOCATION_API_READ_TIMEOUT, "No", False, False, False, True, True, allocation_filter, {"name": None})
+
+    return sorted({x for time_set in allocation_data for x in time_set if not x.startswith("__")})
+
+
+def build_kubecost_shard_filter(allocation_filter, namespaces, shard_index, shard_count, shard_namespaces):
+    """Builds the Kubecost Allocation API filter of a shard, in sharded collection.
+    The Namespaces are assigned to shards 1 to N-1 by the given lists, or by a hash of the Namespace name.
+    The first shard (0) collects all other Namespaces, using a "not equal" filter.
+    This way, the first shard also collects the allocations without a Namespace (such as idle allocations).
+    So the shards don't overlap and don't miss allocations, even if the Namespace lists are incomplete.
+
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :param namespaces: The Namespaces to assign to shards by hash (not used if Namespace lists are given)
+    :param shard_index: The index of the shard of this worker
+    :param shard_count: The number of shards
+    :param shard_namespaces: The Namespace lists of shards 1 to N-1. If "None", the Namespaces are assigned by hash
+    :return: The Kubecost filter expression of the shard, or "None" if no Namespace is assigned to the shard
+    """
+
+    # A cryptographic hash is used instead of Python's hash(), as the latter isn't stable across processes
+    if not shard_namespaces:
+        shard_namespaces = [[x for x in namespaces if
+                             int(hashlib.sha256(x.encode()).hexdigest(), 16) % shard_count == i] for i in
+                            range(1, shard_count)]
+
+    if shard_index == 0:
+        excluded_namespaces = [x for namespaces_list in shard_namespaces for x in namespaces_list]
+        shard_filter = "namespace!:" + ",".join(f'"{x}"' for x in excluded_namespaces) if excluded_namespaces else ""
+    elif shard_namespaces[shard_index - 1]:
+        shard_filter = "namespace:" + ",".join(f'"{x}"' for x in shard_namespaces[shard_index - 1])
+    else:
+        return None
+
+    if shard_filter and allocation_filter:
+        return f"{shard_filter}+({allocation_filter})"
+    return shard_filter or allocation_filter
+
+
+def choose_collection_strategy(memory_limit, memory_usage, allocations_history, headroom_percent, chunk_size,
+                               collection_strategies):
+    """Chooses the collection strategy, so that the estimated memory footprint stays under the memory limit.
+    The strategies are tried by order of preference, and the first one that fits the memory budget is chosen.
+    The estimated footprint of each strategy is based on the estimated allocations count of a single API call:
+    1. "single": a single daily API call, transformed at once
+    2. "chunked": a single daily API call, transformed in chunks
+    3. "windowed": an API call per sub-day window, transformed in chunks and accumulated into daily rows
+    4. "paginated": an API call per hour (resulting in hourly rows), transformed in chunks
+    The "paginated" strategy changes the granularity of the dataset, so it's only used if explicitly chosen, and isn't
+    one of the collection strategies to choose from here
+
+    :param memory_limit: The memory limit of the container (in bytes)
+    :param memory_usage: The current memory usage of the container (in bytes)
+    :param allocations_history: A dict with the allocations per day and/or per hour. If "None", the allocations count
+    is unknown, and the last (most memory-safe) collection strategy is chosen, which keeps the daily rows
+    :param headroom_percent: The percentage of the memory limit to keep free
+    :param chunk_size: The maximum number of allocations to transform at once, in the chunked strategies
+    :param collection_strategies: The collection strategies to choose from, by order of preference
+    :return: The chosen collection strategy
+    """
+
+    if allocations_history is None:
+        logger.warning(f"The allocations count is unknown, so the footprint of the collection strategies can't be "
+                       f"estimated. Using the most memory-safe collection strategy '{collection_strategies[-1]}'")
+        return collection_strategies[-1]
+
+    # If one of the allocations counts is unknown, it's estimated from the other one
+    # The hourly count is assumed to be as large as the daily count (for clusters where all pods run all day)
+    # The daily count is assumed to be twice as large as the hourly count (for clusters with short-lived pods)
+    allocations_per_day = allocations_history.get("allocations_per_day") or 2 * allocations_history[
+        "allocations_per_hour"]
+    allocations_per_hour = allocations_history.get("allocations_per_hour") or allocations_per_day
+    allocations_per_window = min(allocations_per_day, allocations_per_hour * KUBECOST_SUB_WINDOW_HOURS)
+
+    estimates = {
+        "single": allocations_per_day * (KUBECOST_RESPONSE_BYTES_PER_ALLOCATION + TRANSFORM_BYTES_PER_ALLOCATION),
+        "chunked": allocations_per_day * KUBECOST_RESPONSE_BYTES_PER_ALLOCATION + min(
+            chunk_size, allocations_per_day) * TRANSFORM_BYTES_PER_ALLOCATION,
+        "windowed": allocations_per_window * KUBECOST_RESPONSE_BYTES_PER_ALLOCATION + min(
+            chunk_size, allocations_per_window) * TRANSFORM_BYTES_PER_ALLOCATION + 2 * allocations_per_day *
+        DAILY_ROW_BYTES_PER_ALLOCATION,
+    }
+    memory_budget = memory_limit * (1 - headroom_percent / 100) - memory_usage
+
+    fitting_strategies = [x for x in collection_strategies if estimates[x] <= memory_budget]
+    if fitting_strategies:
+        collection_strategy = fitting_strategies[0]
+    else:
+        collection_strategy = min(collection_strategies, key=lambda x: estimates[x])
+        logger.warning("None of the collection strategies fit the memory budget, using the smallest one")
+
+    logger.info(f"Memory governor: limit {memory_limit / 2 ** 20:.0f}MiB, usage {memory_usage / 2 ** 20:.0f}MiB, "
+                f"budget {memory_budget / 2 ** 20:.0f}MiB ({headroom_percent}% headroom). "
+                f"Estimated allocations per day {allocations_per_day}, per hour {allocations_per_hour} "
+                f"(based on {allocations_history['source']}). "
+                "Estimated footprint: " + ", ".join(f"{x} {estimates[x] / 2 ** 20:.0f}MiB" for x in
+                                                    collection_strategies) +
+                f". Chosen collection strategy: '{collection_strategy}'")
+
+    return collection_strategy
+
+
+def calc_kubecost_range_fetch_max_days(memory_limit, memory_usage, allocations_history, headroom_percent, chunk_size,
+                                       collection_strategy, max_days):
+    """Calculates the maximum number of dates to fetch in a single API call, so that the response fits in memory.
+    The response of all dates is held in memory, while the dates are transformed one by one.
+
+    :param memory_limit: The memory limit of the container (in bytes). If "None", only "max_days" applies
+    :param memory_usage: The current memory usage of the container (in bytes)
+    :param allocations_history: A dict with the allocations per day and/or per hour. If "None", a single date is fetched
+    :param headroom_percent: The percentage of the memory limit to keep free
+    :param chunk_size: The maximum number of allocations to transform at once, in the chunked strategies
+    :param collection_strategy: The collection strategy used for transforming each date ("single" or "chunked")
+    :param max_days: The maximum number of dates to fetch in a single API call
+    :return: The maximum number of dates to fetch in a single API call
+    """
+
+    if memory_limit is None:
+        return max_days
+    if allocations_history is None:
+        return 1
+
+    allocations_per_day = allocations_history.get("allocations_per_day") or 2 * allocations_history[
+        "allocations_per_hour"]
+    transform_footprint = (allocations_per_day if collection_strategy == "single" else min(
+        chunk_size, allocations_per_day)) * TRANSFORM_BYTES_PER_ALLOCATION
+    memory_budget = memory_limit * (1 - headroom_percent / 100) - memory_usage
+    range_fetch_days = int((memory_budget - transform_footprint) //
+                           max(allocations_per_day * KUBECOST_RESPONSE_BYTES_PER_ALLOCATION, 1))
+
+    return max(1, min(max_days, range_fetch_days))
+
+
+def fetch_kubecost_allocation_data_range(start, end, allocation_filter, projection):
+    """Fetches Kubecost Allocation data for multiple consecutive dates in a single API call in "1d" step.
+    The time sets of the response are split locally by date, so that each date is transformed to its own Parquet file.
+
+    :param start: The start time of the window of the first date
+    :param end: The end time of the window of the last date
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :param projection: The allocation projection, used for dropping unneeded fields while decoding the response
+    :return: A dictionary with the dates mapped to their time set
+    """
+
+    allocation_data = execute_kubecost_allocation_api(
+        TLS_VERIFY, KUBECOST_API_ENDPOINT, start, end, "daily", AGGREGATION, CONNECTION_TIMEOUT,
+        KUBECOST_ALLOCATION_API_READ_TIMEOUT, "No", True, True, True, True, False, allocation_filter, projection)
+
+    return {time_set[next(iter(time_set))]["window"]["start"].split("T")[0]: time_set for time_set in allocation_data}
+
+
+def collect_kubecost_allocation_data_batches(collection_strategy, start, end, allocation_filter, projection,
+                                             time_set=None):
+    """Collects Kubecost Allocation data for a date, in batches according to the collection strategy.
+    In the "paginated" strategy, each batch is an hour, and it's collected only when the previous one was consumed.
+    In the "windowed" strategy, each batch is an accumulated sub-day window, collected the same way.
+    In the other strategies, there's a single batch for the whole day.
+    Each batch includes the real cluster ID and name, and updated timestamps.
+
+    :param collection_strategy: The collection strategy
+    :param start: The start time of the window
+    :param end: The end time of the window
+    :param allocation_filter: The Kubecost filter expression, used for narrowing the query server-side
+    :param projection: The allocation projection, used for dropping unneeded fields while decoding the response
+    :param time_set: The time set of the date, if it was already fetched in a multi-day API call
+    :return: A generator of Kubecost Allocation data batches
+    """
+
+    if time_set is not None:
+        yield kubecost_allocation_data_timestamp_update(
+            kubecost_allocation_data_add_cluster_id_and_name([time_set], CLUSTER_ID))
+    elif collection_strategy == "paginated":
+        for time_set in execute_kubecost_allocation_api_hourly_pages(
+                TLS_VERIFY, KUBECOST_API_ENDPOINT, start, end, AGGREGATION, CONNECTION_TIMEOUT,
+                KUBECOST_ALLOCATION_API_READ_TIMEOUT, True, True, True, True, False, allocation_filter, projection):
+            yield kubecost_allocation_data_timestamp_update(
+                kubecost_allocation_data_add_cluster_id_and_name([time_set], CLUSTER_ID))
+    elif collection_strategy == "windowed":
+        for time_set in execute_kubecost_allocation_api_hourly_pages(
+                TLS_VERIFY, KUBECOST_API_ENDPOINT, start, end, AGGREGATION, CONNECTION_TIMEOUT,
+                KUBECOST_ALLOCATION_API_READ_TIMEOUT, True, True, True, True, True, allocation_filter, projection,
+                KUBECOST_SUB_WINDOW_HOURS):
+            yield kubecost_allocation_data_timestamp_update(
+                kubecost_allocation_data_add_cluster_id_and_name([time_set], CLUSTER_ID))
+    else:
+        yield kubecost_allocation_data_timestamp_update(kubecost_allocation_data_add_cluster_id_and_name(
+            execute_kubecost_allocation_api(TLS_VERIFY, KUBECOST_API_ENDPOINT, start, end, "daily", AGGREGATION,
+                                            CONNECTION_TIMEOUT, KUBECOST_ALLOCATION_API_READ_TIMEOUT,
+                                            KUBECOST_ALLOCATION_API_PAGINATE, True, True, True, True, False,
+                                            allocation_filter, projection), CLUSTER_ID))
+
+
+def upload_kubecost_allocation_parquet_to_s3(s3_bucket_name, cluster_id, month, year, assume_role_response,
+                                             parquet_file_path):
+    """Compresses and uploads the Kubecost Allocation Parquet to an S3 bucket.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
+    :param month: The month to use as part of the S3 bucket prefix
+    :param year: The year to use as part of the S3 bucket prefix
+    :param assume_role_response: The Assume Role API call response
+    :param parquet_file_path: The full path to the Parquet file
+    :return:
+    """
+
+    cluster_account_id = cluster_id.split(":")[4]
+    cluster_region_code = cluster_id.split(":")[3]
+
+    # S3 file name and prefix definition
+    s3_file_name = parquet_file_path.split("/")[-1]
+    s3_bucket_prefix = f"account_id={cluster_account_id}/region={cluster_region_code}/year={year}/month={month}"
+
+    # Uploading the Parquet file to the S3 bucket
+    try:
+        s3 = get_aws_client("s3", assume_role_response)
+        logger.info(f"Uploading file '{s3_file_name}' to S3 Bucket '{s3_bucket_name}'...")
+        s3.upload_file(parquet_file_path, s3_bucket_name, f"{s3_bucket_prefix}/{s3_file_name}")
+    except boto3.exceptions.S3UploadFailedError as error:
+        logger.error(f"Unable to upload file {s3_file_name} to S3 Bucket '{s3_bucket_name}': {error}")
+        sys.exit(1)
+    except botocore.exceptions.ClientError as error:
+        logger.error(error)
+        sys.exit(1)
+
+
+def s3_lease_key(lease_prefix, cluster_id, date):
+    """Defines the S3 key of the lease of a cluster and date (and of the shard of this worker, in sharded collection).
+    The leases are kept outside of the data prefixes, so that they're never listed or read as data.
+
+    :param lease_prefix: The S3 prefix of the leases
+    :param cluster_id: The cluster ID
+    :param date: The date of the lease
+    :return: The S3 key of the lease
+    """
+
+    cluster_name = cluster_id.split("/")[-1]
+    cluster_account_id = cluster_id.split(":")[4]
+    cluster_region_code = cluster_id.split(":")[3]
+
+    return (f"{lease_prefix}/account_id={cluster_account_id}/region={cluster_region_code}/"
+            f"{date}_{cluster_name}{kubecost_shard_suffix(SHARD_INDEX, SHARD_COUNT)}.json")
+
+
+def s3_lease_body(lease_owner, duration_minutes):
+    """Defines the body of a lease object, with the owner and the expiry time (in seconds since the epoch).
+
+    :param lease_owner: The lease owner (the host name and process ID of this runner)
+    :param duration_minutes: The lease duration in minutes
+    :return: The body of the lease object
+    """
+
+    return json.dumps({"owner": lease_owner, "expires": int(time.time()) + duration_minutes * 60}).encode()
+
+
+def acquire_s3_lease(s3_bucket_name, lease_key, lease_owner, duration_minutes, assume_role_response):
+    """Acquires a lease, using S3 conditional writes.
+    The lease object is created only if it doesn't exist ("If-None-Match: *").
+    If it exists, it's taken over only if it expired (or it's owned by this runner, from a previous run in daemon mode).
+    The take-over is conditioned on the ETag of the expired lease ("If-Match"), so that only one runner wins it.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param lease_key: The S3 key of the lease
+    :param lease_owner: The lease owner (the host name and process ID of this runner)
+    :param duration_minutes: The lease duration in minutes
+    :param assume_role_response: The Assume Role API call response
+    :return: The ETag of the lease object if the lease was acquired, or "None" if it's held by another runner
+    """
+
+    client = get_aws_client("s3", assume_role_response)
+    try:
+        return client.put_object(Bucket=s3_bucket_name, Key=lease_key, IfNoneMatch="*",
+                                 Body=s3_lease_body(lease_owner, duration_minutes))["ETag"]
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] not in ["PreconditionFailed", "ConditionalRequestConflict"]:
+            logger.error(error)
+            sys.exit(1)
+
+    try:
+        response = client.get_object(Bucket=s3_bucket_name, Key=lease_key)
+        lease = json.loads(response["Body"].read())
+        if lease["owner"] != lease_owner and lease["expires"] > time.time():
+            return None
+        logger.info(f"Taking over the lease '{lease_key}' of '{lease['owner']}'")
+        return client.put_object(Bucket=s3_bucket_name, Key=lease_key, IfMatch=response["ETag"],
+                                 Body=s3_lease_body(lease_owner, duration_minutes))["ETag"]
+    except botocore.exceptions.ClientError as error:
+        # The lease was released or taken over by another runner in the meantime
+        if error.response["Error"]["Code"] in ["NoSuchKey", "PreconditionFailed", "ConditionalRequestConflict"]:
+            return None
+        logger.error(error)
+        sys.exit(1)
+
+
+def renew_s3_lease(s3_bucket_name, lease_key, lease_etag, lease_owner, duration_minutes, assume_role_response):
+    """Renews a lease, extending its expiry time. The renewal is conditioned on the ETag of the lease ("If-Match").
+    If the lease expired and was taken over by another runner, the renewal fails.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param lease_key: The S3 key of the lease
+    :param lease_etag: The ETag of the lease object
+    :param lease_owner: The lease owner (the host name and process ID of this runner)
+    :param duration_minutes: The lease duration in minutes
+    :param assume_role_response: The Assume Role API call response
+    :return: The new ETag of the lease object, or "None" if the lease is no longer held. If the renewal fails for any
+    other reason (such as throttling), the held ETag is returned, so that the next renewal retries
+    """
+
+    # The renewal runs in the leases heartbeat thread too, where "sys.exit" would only end the thread silently, and the
+    # leases would expire during the collection. The lease duration allows several renewals, so a failure is retried
+    try:
+        return get_aws_client("s3", assume_role_response).put_object(
+            Bucket=s3_bucket_name, Key=lease_key, IfMatch=lease_etag,
+            Body=s3_lease_body(lease_owner, duration_minutes))["ETag"]
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] in ["NoSuchKey", "PreconditionFailed", "ConditionalRequestConflict"]:
+            return None
+        logger.warning(f"Unable to renew the lease '{lease_key}', retrying on the next renewal: {error}")
+        return lease_etag
+    except botocore.exceptions.BotoCoreError as error:
+        logger.warning(f"Unable to renew the lease '{lease_key}', retrying on the next renewal: {error}")
+        return lease_etag
+
+
+def release_s3_lease(s3_bucket_name, lease_key, lease_etag, assume_role_response):
+    """Releases a lease, by deleting the lease object. The deletion is conditioned on its ETag ("If-Match").
+    If the lease was taken over by another runner, it's left as is.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param lease_key: The S3 key of the lease
+    :param lease_etag: The ETag of the lease object
+    :param assume_role_response: The Assume Role API call response
+    :return:
+    """
+
+    try:
+        get_aws_client("s3", assume_role_response).delete_object(Bucket=s3_bucket_name, Key=lease_key,
+                                                                 IfMatch=lease_etag)
+    except botocore.exceptions.ClientError as error:
+        if error.response["Error"]["Code"] not in ["NoSuchKey", "PreconditionFailed"]:
+            logger.warning(f"Unable to release the lease '{lease_key}': {error}")
+
+
+def acquire_kubecost_dates_leases(s3_bucket_name, lease_prefix, cluster_id, dates, lease_owner, duration_minutes,
+                                  wait_minutes, assume_role_response):
+    """Acquires the leases of the given dates, so that dates that are collected by another runner are skipped.
+    If a wait time is given, the leases that are held by another runner are retried until the wait time passes.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param lease_prefix: The S3 prefix of the leases
+    :param cluster_id: The cluster ID
+    :param dates: The dates to acquire leases for
+    :param lease_owner: The lease owner (the host name and process ID of this runner)
+    :param duration_minutes: The lease duration in minutes
+    :param wait_minutes: The time to wait for leases that are held by another runner, in minutes
+    :param assume_role_response: The Assume Role API call response
+    :return: A dictionary with the dates whose lease was acquired, mapped to the ETag of the lease object
+    """
+
+    leases = {}
+    wait_deadline = time.time() + wait_minutes * 60
+    while True:
+        for date in dates:
+            if date not in leases:
+                lease_etag = acquire_s3_lease(s3_bucket_name, s3_lease_key(lease_prefix, cluster_id, date),
+                                              lease_owner, duration_minutes, assume_role_response)
+                if lease_etag:
+                    leases[date] = lease_etag
+
+        held_dates = [x for x in dates if x not in leases]
+        if not held_dates or time.time() >= wait_deadline:
+            break
+        logger.info(f"Waiting for the leases of dates {', '.join(held_dates)}, held by another runner...")
+        time.sleep(min(30, max(0, wait_deadline - time.time())))
+
+    if held_dates:
+        logger.info(f"Skipping dates {', '.join(held_dates)}, as they're being collected by another runner")
+
+    return {x: leases[x] for x in dates if x in leases}
+
+
+def renew_kubecost_dates_leases(s3_bucket_name, lease_prefix, cluster_id, dates, leases, leases_lock, lease_owner,
+                                duration_minutes, assume_role_response):
+    """Renews the held leases of the given dates (or of all held dates), using conditional writes on their ETags.
+    The leases that expired and were taken over by another runner are removed from the held leases.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param lease_prefix: The S3 prefix of the leases
+    :param cluster_id: The cluster ID
+    :param dates: The dates whose leases to renew, or "None" for all held dates
+    :param leases: A dictionary with the dates whose lease is held, mapped to the ETag of the lease object
+    :param leases_lock: The lock of the held leases, shared with the leases heartbeat
+    :param lease_owner: The lease owner (the host name and process ID of this runner)
+    :param duration_minutes: The lease duration in minutes
+    :param assume_role_response: The Assume Role API call response
+    :return: "True" if the leases of all the given dates are still held, otherwise "False"
+    """
+
+    with leases_lock:
+        dates = list(leases) if dates is None else dates
+        for date in [x for x in dates if x in leases]:
+            lease_etag = renew_s3_lease(s3_bucket_name, s3_lease_key(lease_prefix, cluster_id, date), leases[date],
+                                        lease_owner, duration_minutes, assume_role_response)
+            if lease_etag:
+                leases[date] = lease_etag
+            else:
+                logger.warning(f"The lease of date {date} was taken over by another runner")
+                del leases[date]
+
+        return all(x in leases for x in dates)
+
+
+def kubecost_dates_leases_heartbeat(stop_event, interval_seconds, s3_bucket_name, lease_prefix, cluster_id, leases,
+                                    leases_lock, lease_owner, duration_minutes, assume_role_response):
+    """Renews all held leases periodically, until the stop event is set.
+    It runs in a background thread during the collection, so that the leases don't expire while a date that takes
+    longer than the lease duration is collected and uploaded (and the dates waiting for their turn stay held).
+
+    :param stop_event: The event that stops the heartbeat
+    :param interval_seconds: The time between renewals, in seconds
+    :param s3_bucket_name: The S3 bucket name to use
+    :param lease_prefix: The S3 prefix of the leases
+    :param cluster_id: The cluster ID
+    :param leases: A dictionary with the dates whose lease is held, mapped to the ETag of the lease object
+    :param leases_lock: The lock of the held leases, shared with the collection
+    :param lease_owner: The lease owner (the host name and process ID of this runner)
+    :param duration_minutes: The lease duration in minutes
+    :param assume_role_response: The Assume Role API call response
+    :return:
+    """
+
+    while not stop_event.wait(interval_seconds):
+        renew_kubecost_dates_leases(s3_bucket_name, lease_prefix, cluster_id, None, leases, leases_lock, lease_owner,
+                                    duration_minutes, assume_role_response)
+
+
+def kubecost_shard_suffix(shard_index, shard_count):
+    """Defines the suffix of the file names of a shard, in sharded collection.
+
+    :param shard_index: The index of the shard
+    :param shard_count: The number of shards
+    :return: The suffix of the file names of the shard, or an empty string if sharded collection isn't used
+    """
+
+    return f".shard-{shard_index}-of-{shard_count}" if shard_count > 1 else ""
+
+
+def kubecost_shard_s3_key(shard_prefix, cluster_id, date, shard_index, shard_count):
+    """Defines the S3 key of the Parquet file of a shard of a date.
+    The shards are kept outside of the data prefixes, so that they're never listed or read as data.
+
+    :param shard_prefix: The S3 prefix of the shards
+    :param cluster_id: The cluster ID
+    :param date: The date of the shard
+    :param shard_index: The index of the shard
+    :param shard_count: The number of shards
+    :return: The S3 key of the Parquet file of the shard
+    """
+
+    cluster_name = cluster_id.split("/")[-1]
+    cluster_account_id = cluster_id.split(":")[4]
+    cluster_region_code = cluster_id.split(":")[3]
+    year, month = date.split("-")[0:2]
+
+    return (f"{shard_prefix}/account_id={cluster_account_id}/region={cluster_region_code}/year={year}/month={month}/"
+            f"{date}_{cluster_name}{kubecost_shard_suffix(shard_index, shard_count)}.snappy.parquet")
+
+
+def list_kubecost_shards(s3_bucket_name, shard_prefix, cluster_id, date, shard_count, assume_role_response):
+    """Lists the shards of a date that were uploaded to S3.
+    Shards of a different shard count (from before the shard count was changed) are ignored.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param shard_prefix: The S3 prefix of the shards
+    :param cluster_id: The cluster ID
+    :param date: The date of the shards
+    :param shard_count: The number of shards
+    :param assume_role_response: The Assume Role API call response
+    :return: A dictionary with the index of each uploaded shard, mapped to its S3 key
+    """
+
+    s3_key_prefix = kubecost_shard_s3_key(shard_prefix, cluster_id, date, 0, shard_count).split(".shard-")[0]
+    try:
+        paginator = get_aws_client("s3", assume_role_response).get_paginator("list_objects_v2")
+        s3_keys = [x["Key"] for page in paginator.paginate(Bucket=s3_bucket_name, Prefix=f"{s3_key_prefix}.shard-")
+                   for x in page.get("Contents", [])]
+    except botocore.exceptions.ClientError as error:
+        logger.error(error)
+        sys.exit(1)
+
+    uploaded_shards = {}
+    for s3_key in s3_keys:
+        match = re.search(r"\.shard-(\d+)-of-(\d+)\.", s3_key)
+        if match and int(match.group(2)) == shard_count:
+            uploaded_shards[int(match.group(1))] = s3_key
+
+    return uploaded_shards
+
+
+def upload_kubecost_shard_to_s3(s3_bucket_name, s3_key, assume_role_response, parquet_file_path):
+    """Uploads the Parquet file of a shard to S3.
+    If no file is given, an empty marker object is uploaded instead, for a shard without any Namespace.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param s3_key: The S3 key of the Parquet file of the shard
+    :param assume_role_response: The Assume Role API call response
+    :param parquet_file_path: The full path to the Parquet file, or "None" for an empty shard
+    :return:
+    """
+
+    try:
+        client = get_aws_client("s3", assume_role_response)
+        if parquet_file_path:
+            logger.info(f"Uploading shard '{s3_key}' to S3 Bucket '{s3_bucket_name}'...")
+            client.upload_file(parquet_file_path, s3_bucket_name, s3_key)
+        else:
+            logger.info(f"Uploading empty shard marker '{s3_key}.empty' to S3 Bucket '{s3_bucket_name}'...")
+            client.put_object(Bucket=s3_bucket_name, Key=f"{s3_key}.empty", Body=b"")
+    except boto3.exceptions.S3UploadFailedError as error:
+        logger.error(f"Unable to upload shard '{s3_key}' to S3 Bucket '{s3_bucket_name}': {error}")
+        sys.exit(1)
+    except botocore.exceptions.ClientError as error:
+        logger.error(error)
+        sys.exit(1)
+
+
+def merge_kubecost_shards_parquet(s3_bucket_name, uploaded_shards, date, cluster_id, assume_role_response):
+    """Merges the Parquet files of all shards of a date, to the Parquet file of the date.
+    The shards are downloaded, and as each shard is sorted, they're merged as sorted runs (see "write_sorted_parquet").
+    The collection metadata of the merged file has the largest number of allocations in a single shard API call.
+    That's because the merged file is used as the allocations count history of each shard, in the next runs.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param uploaded_shards: A dictionary with the index of each shard, mapped to its S3 key
+    :param date: The date to use in the Parquet file name
+    :param cluster_id: The cluster ID to use for the Parquet file name
+    :param assume_role_response: The Assume Role API call response
+    :return: The path to the merged Parquet file and the saved umask,
+    or "None" if a shard was removed in the meantime (because another worker merged the date)
+    """
+
+    cluster_name = cluster_id.split("/")[-1]
+    tmpdir = tempfile.mkdtemp()
+    saved_umask = os.umask(0o077)
+    path = os.path.join(tmpdir, f"{date}_{cluster_name}.snappy.parquet")
+
+    # Downloading the shards (empty shard markers are skipped)
+    shard_paths = []
+    try:
+        client = get_aws_client("s3", assume_role_response)
+        for shard_index, s3_key in sorted(uploaded_shards.items()):
+            if s3_key.endswith(".empty"):
+                continue
+            shard_paths.append(os.path.join(tmpdir, f"shard-{shard_index}.parquet"))
+            client.download_file(s3_bucket_name, s3_key, shard_paths[-1])
+    except botocore.exceptions.ClientError as error:
+        remove_parquet_file(path, saved_umask)
+        if error.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            logger.info(f"A shard of date {date} was removed, as the date was merged by another worker")
+            return None
+        logger.error(error)
+        sys.exit(1)
+
+    # Merging the shards to a single Parquet file, with a schema that includes the columns of all shards
+    logger.info(f"Merging {len(uploaded_shards)} shards of date {date}...")
+    shard_files = [pq.ParquetFile(x) for x in shard_paths]
+    shard_metadata = [json.loads((x.metadata.metadata or {}).get(b"kubecost_s3_exporter", b"{}")) for x in
+                      shard_files]
+    collection_strategies = [x.get("collection_strategy") for x in shard_metadata]
+    write_sorted_parquet(path, [(x, list(range(x.num_row_groups))) for x in shard_files],
+                         pa.unify_schemas([x.schema_arrow for x in shard_files]), {"kubecost_s3_exporter": json.dumps(
+                             {"collection_strategy": "paginated" if "paginated" in collection_strategies else
+                              collection_strategies[0],
+                              "max_allocations_per_query": max(x.get("max_allocations_per_query", 0) for x in
+                                                               shard_metadata),
+                              "folded_allocations": sum(x.get("folded_allocations", 0) for x in shard_metadata),
+                              "shards": len(uploaded_shards)})})
+
+    for shard_file, shard_path in zip(shard_files, shard_paths):
+        shard_file.close()
+        os.remove(shard_path)
+
+    return path, saved_umask
+
+
+def delete_kubecost_shards(s3_bucket_name, uploaded_shards, assume_role_response):
+    """Deletes the shards of a date from S3, after they were merged.
+    Failing to delete them isn't fatal, as they're outside of the data prefixes.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param uploaded_shards: A dictionary with the index of each shard, mapped to its S3 key
+    :param assume_role_response: The Assume Role API call response
+    :return:
+    """
+
+    try:
+        get_aws_client("s3", assume_role_response).delete_objects(
+            Bucket=s3_bucket_name, Delete={"Objects": [{"Key": x} for x in uploaded_shards.values()], "Quiet": True})
+    except botocore.exceptions.ClientError as error:
+        logger.warning(f"Unable to delete the merged shards: {error}")
+
+
+def read_s3_parquet_footer(client, s3_bucket_name, s3_key):
+    """Reads only the footer (the file metadata) of a Parquet object in S3, using ranged GETs.
+    The last 64KB of the object are fetched first, which usually includes the whole footer.
+    If the footer is larger, a second ranged GET is done for the exact footer size.
+
+    :param client: The S3 client to use
+    :param s3_bucket_name: The S3 bucket name to use
+    :param s3_key: The S3 key of the Parquet object
+    :return: The Parquet file metadata
+    """
+
+    tail = client.get_object(Bucket=s3_bucket_name, Key=s3_key, Range="bytes=-65536")["Body"].read()
+    if len(tail) < 12 or tail[-4:] != b"PAR1":
+        raise ValueError("the object doesn't end with the Parquet magic bytes (it might be corrupt or partial)")
+
+    # The last 8 bytes of a Parquet file are the footer length (4 bytes, little-endian) and the "PAR1" magic bytes
+    footer_length = int.from_bytes(tail[-8:-4], "little")
+    if footer_length + 8 > len(tail):
+        tail = client.get_object(Bucket=s3_bucket_name, Key=s3_key,
+                                 Range=f"bytes=-{footer_length + 8}")["Body"].read()
+
+    # The reader expects the "PAR1" magic bytes at the beginning of the file, but doesn't read the column chunks
+    return pq.read_metadata(pa.BufferReader(b"PAR1" + tail[-(footer_length + 8):]))
+
+
+def summarize_parquet_metadata(metadata):
+    """Summarizes the properties of a Parquet file that are verified: row count, schema and window timestamps.
+    The minimum and maximum window timestamps are taken from the row groups statistics, so no data is read.
+
+    :param metadata: The Parquet file metadata
+    :return: A dict with the row count, the Arrow schema, and the minimum and maximum window timestamps
+    """
+
+    column_index = {metadata.schema.column(i).path: i for i in range(metadata.num_columns)}
+    window_start_min = None
+    window_end_max = None
+    for i in range(metadata.num_row_groups):
+        row_group = metadata.row_group(i)
+        if "window.start" in column_index:
+            statistics = row_group.column(column_index["window.start"]).statistics
+            if statistics is not None and statistics.has_min_max:
+                if window_start_min is None or statistics.min < window_start_min:
+                    window_start_min = statistics.min
+        if "window.end" in column_index:
+            statistics = row_group.column(column_index["window.end"]).statistics
+            if statistics is not None and statistics.has_min_max:
+                if window_end_max is None or statistics.max > window_end_max:
+                    window_end_max = statistics.max
+
+    return {"num_rows": metadata.num_rows, "schema": metadata.schema.to_arrow_schema().remove_metadata(),
+            "window_start_min": window_start_min, "window_end_max": window_end_max}
+
+
+def compare_parquet_schemas(schema, previous_schema):
+    """Compares two Parquet schemas, to detect schema drift (for example, changed labels columns between days).
+
+    :param schema: The Arrow schema of the Parquet file
+    :param previous_schema: The Arrow schema of the previous Parquet file to compare to
+    :return: A list of the differences, as human-readable strings
+    """
+
+    differences = []
+    added_columns = [x for x in schema.names if x not in previous_schema.names]
+    removed_columns = [x for x in previous_schema.names if x not in schema.names]
+    changed_columns = [f"{x} ({previous_schema.field(x).type} -> {schema.field(x).type})" for x in schema.names if
+                       x in previous_schema.names and schema.field(x).type != previous_schema.field(x).type]
+    if added_columns:
+        differences.append(f"added columns: {', '.join(added_columns)}")
+    if removed_columns:
+        differences.append(f"removed columns: {', '.join(removed_columns)}")
+    if changed_columns:
+        differences.append(f"changed column types: {', '.join(changed_columns)}")
+
+    return differences
+
+
+def verify_parquet_summary(summary, expected_summary, date):
+    """Verifies the summary of a Parquet object in S3, against what was written and the date of the file.
+
+    :param summary: The summary of the Parquet object in S3
+    :param expected_summary: The summary of the Parquet file that was written. If "None", only the date is verified
+    :param date: The date of the Parquet file (from the file name), in format of "%Y-%m-%d"
+    :return: A list of the problems found, as human-readable strings
+    """
+
+    problems = []
+    if expected_summary:
+        if summary["num_rows"] != expected_summary["num_rows"]:
+            problems.append(f"row count is {summary['num_rows']}, expected {expected_summary['num_rows']}")
+        if not summary["schema"].equals(expected_summary["schema"]):
+            problems.append("schema differs from the written schema: " +
+                            "; ".join(compare_parquet_schemas(summary["schema"], expected_summary["schema"]) or
+                                      ["column order or metadata differ"]))
+        for key in ["window_start_min", "window_end_max"]:
+            if summary[key] != expected_summary[key]:
+                problems.append(f"{key} is {summary[key]}, expected {expected_summary[key]}")
+    elif summary["num_rows"] == 0:
+        problems.append("the file contains no rows")
+
+    # The window timestamps must be within the date of the file
+    day_start = datetime.datetime.strptime(date, "%Y-%m-%d")
+    day_end = day_start + datetime.timedelta(days=1)
+    if summary["window_start_min"] is None or summary["window_end_max"] is None:
+        problems.append("window timestamps statistics are missing")
+    elif summary["window_start_min"] < day_start or summary["window_end_max"] > day_end:
+        problems.append(f"window timestamps ({summary['window_start_min']} - {summary['window_end_max']}) "
+                        f"are outside of {date}")
+
+    return problems
+
+
+def verify_uploaded_kubecost_allocation_parquet(s3_bucket_name, cluster_id, month, year, assume_role_response,
+                                                parquet_file_path):
+    """Verifies an uploaded Kubecost Allocation Parquet, by reading only its footer from S3.
+    The row count, schema and minimum and maximum window timestamps are compared to the local Parquet file.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
+    :param month: The month to use as part of the S3 bucket prefix
+    :param year: The year to use as part of the S3 bucket prefix
+    :param assume_role_response: The Assume Role API call response
+    :param parquet_file_path: The full path to the Parquet file
+    :return: "True" if the uploaded Parquet matches the local Parquet file, else "False"
+    """
+
+    cluster_account_id = cluster_id.split(":")[4]
+    cluster_region_code = cluster_id.split(":")[3]
+
+    # S3 file name and prefix definition
+    s3_file_name = parquet_file_path.split("/")[-1]
+    s3_key = f"account_id={cluster_account_id}/region={cluster_region_code}/year={year}/month={month}/{s3_file_name}"
+
+    try:
+        client = get_aws_client("s3", assume_role_response)
+
+        logger.info(f"Verifying file '{s3_file_name}' in S3 Bucket '{s3_bucket_name}'...")
+        summary = summarize_parquet_metadata(read_s3_parquet_footer(client, s3_bucket_name, s3_key))
+    except (botocore.exceptions.ClientError, ValueError, OSError) as error:
+        logger.error(f"Unable to read the Parquet footer of '{s3_key}': {error}")
+        return False
+
+    expected_summary = summarize_parquet_metadata(pq.read_metadata(parquet_file_path))
+    problems = verify_parquet_summary(summary, expected_summary, s3_file_name.split("_")[0])
+    for problem in problems:
+        logger.error(f"Verification of '{s3_key}' failed: {problem}")
+
+    return not problems
+
+
+def verify_s3_parquet_objects(s3_bucket_name, s3_prefix, cluster_name, workers, assume_role_response):
+    """Verifies all Parquet objects under an S3 prefix, by reading only their footers, in parallel.
+    Each object is verified to have rows, and window timestamps within the date in its file name.
+    In addition, the schema of each object is compared to the schema of the previous date of the same cluster.
+    This detects schema drift between days (for example, changed labels columns).
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param s3_prefix: The S3 prefix under which all Parquet objects are verified
+    :param cluster_name: If given, only the objects of this cluster are verified
+    :param workers: The number of objects to verify in parallel
+    :param assume_role_response: The Assume Role API call response
+    :return: The number of objects with problems
+    """
+
+    try:
+        # The connection pool of the client is sized to the number of workers, so that they don't wait for connections
+        client = get_aws_client("s3", assume_role_response,
+                                config=botocore.config.Config(max_pool_connections=workers))
+
+        logger.info(f"Listing Parquet objects under prefix '{s3_prefix}' in S3 Bucket '{s3_bucket_name}'...")
+        s3_keys = []
+        for page in client.get_paginator("list_objects_v2").paginate(Bucket=s3_bucket_name, Prefix=s3_prefix):
+            for s3_object in page.get("Contents", []):
+                s3_file_name = s3_object["Key"].split("/")[-1]
+                if re.match(r"^\d{4}-\d{2}-\d{2}_.+\.snappy\.parquet$", s3_file_name):
+                    if not cluster_name or s3_file_name.endswith(f"_{cluster_name}.snappy.parquet"):
+                        s3_keys.append(s3_object["Key"])
+    except botocore.exceptions.ClientError as error:
+        logger.error(error)
+        sys.exit(1)
+
+    logger.info(f"Verifying {len(s3_keys)} Parquet objects using {workers} workers...")
+
+    def summarize(s3_key):
+        try:
+            return s3_key, summarize_parquet_metadata(read_s3_parquet_footer(client, s3_bucket_name, s3_key)), None
+        except (botocore.exceptions.ClientError, ValueError, OSError) as error:
+            return s3_key, None, str(error)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(summarize, s3_keys))
+
+    # The cluster of each object is identified by the account ID and region prefixes, and the cluster name
+    # The file name is in format of "<date>_<cluster_name>.snappy.parquet", where the date is 10 characters long
+    def cluster_and_date(s3_key):
+        s3_file_name = s3_key.split("/")[-1]
+        return s3_key.split("/")[-5:-3] + [s3_file_name[11:]], s3_file_name[:10]
+
+    # Verifying each object, and comparing its schema to the previous date of the same cluster
+    objects_with_problems = 0
+    previous_summaries = {}
+    for s3_key, summary, error in sorted(results, key=lambda x: cluster_and_date(x[0])):
+        cluster, date = cluster_and_date(s3_key)
+        cluster_key = tuple(cluster)
+        problems = [f"unable to read the Parquet footer: {error}"] if error else verify_parquet_summary(summary,
+                                                                                                     None, date)
+        if summary and cluster_key in previous_summaries:
+            previous_key, previous_summary = previous_summaries[cluster_key]
+            schema_differences = compare_parquet_schemas(summary["schema"], previous_summary["schema"])
+            if schema_differences:
+                logger.warning(f"Schema drift in '{s3_key}' compared to '{previous_key}': "
+                               f"{'; '.join(schema_differences)}")
+        if summary:
+            previous_summaries[cluster_key] = (s3_key, summary)
+        if problems:
+            objects_with_problems += 1
+            for problem in problems:
+                logger.error(f"Verification of '{s3_key}' failed: {problem}")
+
+    logger.info(f"Verified {len(s3_keys)} Parquet objects, {objects_with_problems} with problems")
+
+    return objects_with_problems
+
+
+def glue_register_partitions(glue_database_name, glue_table_name, glue_region, glue_endpoint_url, s3_bucket_name,
+                              partitions, assume_role_response):
+    """Registers the S3 prefixes of uploaded Parquet files as partitions of the AWS Glue Table.
+    This makes new data available in Athena right after the upload, instead of waiting for the Glue crawler.
+    The partitions are created in batches, and partitions that already exist are ignored, so this is idempotent.
+    Each partition inherits the storage descriptor (format, SerDe and columns) from the table.
+
+    :param glue_database_name: The AWS Glue Database name
+    :param glue_table_name: The AWS Glue Table name
+    :param glue_region: The region-code of the AWS Glue Data Catalog
+    :param glue_endpoint_url: An optional AWS Glue endpoint URL (for example, a local AWS Glue stand-in for testing)
+    :param s3_bucket_name: The S3 bucket name to use
+    :param partitions: A set of the partition values (account ID, region, year and month) to register
+    :param assume_role_response: The Assume Role API call response
+    :return:
+    """
+
+    try:
+        client = get_aws_client("glue", assume_role_response, region_name=glue_region, endpoint_url=glue_endpoint_url)
+
+        table_storage_descriptor = client.get_table(DatabaseName=glue_database_name,
+                                                    Name=glue_table_name)["Table"]["StorageDescriptor"]
+
+        # Defining the partition input for each partition, based on the table's storage descriptor
+        partition_input_list = []
+        for account_id, region, year, month in sorted(partitions):
+            storage_descriptor = dict(table_storage_descriptor)
+            storage_descriptor["Location"] = (f"s3://{s3_bucket_name}/account_id={account_id}/region={region}/"
+                                              f"year={year}/month={month}/")
+            partition_input_list.append({"Values": [account_id, region, year, month],
+                                         "StorageDescriptor": storage_descriptor})
+
+        # Creating the partitions in batches of 100 (the maximum for the glue:BatchCreatePartition API call)
+        logger.info(f"Registering {len(partition_input_list)} partition(s) in AWS Glue Table "
+                    f"'{glue_database_name}.{glue_table_name}'...")
+        for i in range(0, len(partition_input_list), 100):
+            response = client.batch_create_partition(DatabaseName=glue_database_name, TableName=glue_table_name,
+                                                     PartitionInputList=partition_input_list[i:i + 100])
+            for error in response.get("Errors", []):
+                if error["ErrorDetail"]["ErrorCode"] != "AlreadyExistsException":
+                    logger.warning(f"Unable to register partition {'/'.join(error['PartitionValues'])} in AWS Glue: "
+                                   f"{error['ErrorDetail']['ErrorMessage']}")
+
+    # Failing to register partitions doesn't fail the run, as the data is already in S3, and the crawler will add them
+    except botocore.exceptions.ClientError as error:
+        logger.warning(f"Unable to register partitions in AWS Glue, they'll be added by the Glue crawler: {error}")
+
+
+def iceberg_column_name(column_name):
+    """Converts a DataFrame column name to the column name in the Iceberg table.
+    Iceberg treats dots in column names as nested fields, so they're replaced with underscores.
+
+    :param column_name: The DataFrame column name (for example, "window.start")
+    :return: The Iceberg column name (for example, "window_start")
+    """
+
+    return column_name.replace(".", "_")
+
+
+def iceberg_partition_date(partition_day):
+    """Converts the value of the "day" partition field (of the day transform) to a date.
+    Depending on the PyIceberg code path, the value is a date, or an integer of the days since the epoch.
+
+    :param partition_day: The value of the "day" partition field
+    :return: The date of the partition, in format of "YYYY-MM-DD"
+    """
+
+    if isinstance(partition_day, int):
+        partition_day = datetime.date(1970, 1, 1) + datetime.timedelta(days=partition_day)
+
+    return partition_day.strftime("%Y-%m-%d")
+
+
+def iceberg_partition_filter(cluster_id, date):
+    """Defines the Iceberg filter expression that matches exactly one partition (a cluster and a day).
+
+    :param cluster_id: The cluster ID of the partition
+    :param date: The date of the partition, in format of "YYYY-MM-DD"
+    :return: The Iceberg filter expression
+    """
+
+    from pyiceberg.expressions import And, EqualTo, GreaterThanOrEqual, LessThan
+
+    start = datetime.datetime.strptime(date, "%Y-%m-%d")
+    end = start + datetime.timedelta(days=1)
+
+    return And(EqualTo(iceberg_column_name("properties.clusterid"), cluster_id),
+               GreaterThanOrEqual(iceberg_column_name("window.start"), start.isoformat()),
+               LessThan(iceberg_column_name("window.start"), end.isoformat()))
+
+
+def iceberg_load_catalog(catalog_name, catalog_properties, assume_role_response):
+    """Loads the Iceberg catalog.
+    Besides the given properties, PyIceberg also reads the catalog configuration from ".pyiceberg.yaml" and from
+    "PYICEBERG_CATALOG__<name>__<property>" environment variables.
+
+    :param catalog_name: The Iceberg catalog name
+    :param catalog_properties: The Iceberg catalog properties (for example, "type", "uri" and "warehouse")
+    :param assume_role_response: The Assume Role API call response
+    :return: The Iceberg catalog
+    """
+
+    # PyIceberg is imported only when an Iceberg sink is used, so that runs with the Parquet sink (the default) don't
+    # pay for its import time and memory. The catalog is loaded before any other Iceberg function is used
+    import pyiceberg.exceptions
+    from pyiceberg.catalog import load_catalog
+
+    # In case the EKS cluster and the catalog (or warehouse) are in different AWS accounts, the parent IAM role
+    # credentials are used both for the catalog (for example, AWS Glue) and the warehouse (S3)
+    if assume_role_response:
+        catalog_properties = {**catalog_properties,
+                              "client.access-key-id": assume_role_response["Credentials"]["AccessKeyId"],
+                              "client.secret-access-key": assume_role_response["Credentials"]["SecretAccessKey"],
+                              "client.session-token": assume_role_response["Credentials"]["SessionToken"]}
+
+    try:
+        logger.info(f"Loading Iceberg catalog '{catalog_name}'...")
+        return load_catalog(catalog_name, **catalog_properties)
+    except (ValueError, pyiceberg.exceptions.NotInstalledError) as error:
+        logger.error(f"Unable to load Iceberg catalog '{catalog_name}': {error}")
+        sys.exit(1)
+
+
+def iceberg_load_or_create_table(iceberg_catalog, table_identifier, arrow_schema):
+    """Loads the Iceberg table, or creates it if it doesn't exist.
+    The table is partitioned by the cluster ID (identity) and by the day of the window start (hidden partitioning).
+    New columns (for example, newly added labels) are added to the table schema.
+
+    :param iceberg_catalog: The Iceberg catalog
+    :param table_identifier: The Iceberg table identifier, in format of "<namespace>.<table>"
+    :param arrow_schema: The Arrow schema of the data to be committed to the table
+    :return: The Iceberg table
+    """
+
+    import pyiceberg.exceptions
+    from pyiceberg.transforms import DayTransform, IdentityTransform
+
+    cluster_id_column = iceberg_column_name("properties.clusterid")
+    window_start_column = iceberg_column_name("window.start")
+
+    try:
+        table = iceberg_catalog.load_table(table_identifier)
+    except pyiceberg.exceptions.NoSuchTableError:
+        logger.info(f"Creating Iceberg table '{table_identifier}'...")
+        iceberg_catalog.create_namespace_if_not_exists(table_identifier.split(".")[0])
+
+        # Full metrics are kept for the cluster ID column (instead of truncated ones), so that overwriting a partition
+        # replaces whole data files, based on their metrics
+        with iceberg_catalog.create_table_transaction(
+                table_identifier, schema=arrow_schema,
+                properties={f"write.metadata.metrics.column.{cluster_id_column}": "full"}) as transaction:
+            with transaction.update_spec() as update_spec:
+                update_spec.add_field(cluster_id_column, IdentityTransform(), "cluster_id")
+                update_spec.add_field(window_start_column, DayTransform(), "day")
+        table = iceberg_catalog.load_table(table_identifier)
+
+    if set(arrow_schema.names) - set(x.name for x in table.schema().fields):
+        logger.info(f"Adding new columns to Iceberg table '{table_identifier}'...")
+        with table.update_schema() as update_schema:
+            update_schema.union_by_name(arrow_schema)
+
+    return table
+
+
+def iceberg_commit_kubecost_allocation_parquet(iceberg_catalog, table_identifier, cluster_id, date,
+                                               parquet_file_path):
+    """Commits the data of a Parquet file (a single date of a single cluster) to the Iceberg table.
+    The partition of the cluster and date is overwritten atomically, so that re-collecting a date replaces its data.
+
+    :param iceberg_catalog: The Iceberg catalog
+    :param table_identifier: The Iceberg table identifier, in format of "<namespace>.<table>"
+    :param cluster_id: The cluster ID of the data
+    :param date: The date of the data, in format of "YYYY-MM-DD"
+    :param parquet_file_path: The full path to the Parquet file
+    :return:
+    """
+
+    import pyiceberg.exceptions
+
+    # Renaming the columns to the Iceberg column names, and converting timestamps to microseconds precision
+    # This is because Iceberg (format version 2) doesn't support nanoseconds precision timestamps
+    arrow_table = pq.read_table(parquet_file_path)
+    arrow_table = arrow_table.rename_columns([iceberg_column_name(x) for x in arrow_table.column_names])
+    arrow_table = arrow_table.cast(pa.schema(
+        [x.with_type(pa.timestamp("us")) if pa.types.is_timestamp(x.type) else x for x in arrow_table.schema]))
+
+    try:
+        table = iceberg_load_or_create_table(iceberg_catalog, table_identifier, arrow_table.schema)
+
+        logger.info(f"Committing data for date {date} to Iceberg table '{table_identifier}'...")
+
+        # The overwrite warns when the partition doesn't have data yet (the first collection of the date)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", UserWarning)
+            table.overwrite(arrow_table, overwrite_filter=iceberg_partition_filter(cluster_id, date),
+                            snapshot_properties={"kubecost-s3-exporter.date": date})
+    except (pyiceberg.exceptions.CommitFailedException, pyiceberg.exceptions.NotInstalledError,
+            botocore.exceptions.ClientError, OSError, ValueError) as error:
+        logger.error(f"Unable to commit data for date {date} to Iceberg table '{table_identifier}': {error}")
+        sys.exit(1)
+
+
+def get_iceberg_backfill_period_available_dates(iceberg_catalog, table_identifier, cluster_id,
+                                                backfill_period_days):
+    """Retrieves the dates of the cluster that are available in the Iceberg table, in the backfill period.
+    Only the table metadata (the manifests) is read, and not the data files.
+
+    :param iceberg_catalog: The Iceberg catalog
+    :param table_identifier: The Iceberg table identifier, in format of "<namespace>.<table>"
+    :param cluster_id: The cluster ID
+    :param backfill_period_days: The backfill period in days
+    :return: A list of the dates that are available in the Iceberg table, in format of "YYYY-MM-DD"
+    """
+
+    import pyiceberg.exceptions
+
+    try:
+        table = iceberg_catalog.load_table(table_identifier)
+    except pyiceberg.exceptions.NoSuchTableError:
+        logger.info(f"Iceberg table '{table_identifier}' doesn't exist yet, so no dates are available")
+        return []
+
+    logger.info(f"Retrieving the dates for cluster '{cluster_id}' from Iceberg table '{table_identifier}'...")
+    backfill_start_date = (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(
+        days=backfill_period_days)).strftime("%Y-%m-%d")
+    partition_dates = [iceberg_partition_date(x["partition"]["day"]) for x in table.inspect.partitions().to_pylist()
+                       if x["partition"].get("cluster_id") == cluster_id and x["partition"].get("day") is not None]
+
+    return sorted(x for x in partition_dates if x >= backfill_start_date)
+
+
+def get_output_sink_backfill_period_available_dates(iceberg_catalog, assume_role_response):
+    """Retrieves the dates that are available in the output sink, in the backfill period.
+    In the "parquet" sink, they're listed in S3, and in the "iceberg" sink, they're read from the table metadata.
+    In the "both" sink, only the dates that are available in both are returned.
+
+    :param iceberg_catalog: The Iceberg catalog ("None" in the "parquet" sink)
+    :param assume_role_response: The Assume Role API call response
+    :return: A list of the dates that are available in the output sink, in format of "YYYY-MM-DD"
+    """
+
+    if OUTPUT_SINK == "iceberg":
+        return get_iceberg_backfill_period_available_dates(iceberg_catalog, ICEBERG_TABLE, CLUSTER_ID,
+                                                           BACKFILL_PERIOD_DAYS)
+
+    s3_backfill_period_available_dates = get_s3_backfill_period_available_dates(S3_BUCKET_NAME, CLUSTER_ID,
+                                                                                BACKFILL_PERIOD_DAYS,
+                                                                                assume_role_response)
+    if OUTPUT_SINK == "both":
+        iceberg_backfill_period_available_dates = get_iceberg_backfill_period_available_dates(
+            iceberg_catalog, ICEBERG_TABLE, CLUSTER_ID, BACKFILL_PERIOD_DAYS)
+        return [x for x in s3_backfill_period_available_dates if x in iceberg_backfill_period_available_dates]
+
+    return s3_backfill_period_available_dates
+
+
+def output_kubecost_allocation_parquet(date, parquet_file_path, iceberg_catalog, assume_role_response):
+    """Outputs the Parquet file of a date to the output sink.
+    In the "parquet" sink, it's uploaded to S3 (and optionally verified, and uploaded again once if verification fails).
+    In the "iceberg" sink, it's committed to the Iceberg table, overwriting the partition of the date.
+    In the "both" sink, both are done.
+
+    :param date: The date of the Parquet file
+    :param parquet_file_path: The full path to the Parquet file
+    :param iceberg_catalog: The Iceberg catalog ("None" in the "parquet" sink)
+    :param assume_role_response: The Assume Role API call response
+    :return: The Glue partition of the uploaded file (account ID, region, year and month),
+    or "None" if it wasn't uploaded to S3
+    """
+
+    year, month = date.split("-")[0:2]
+    partition = None
+
+    # Uploading the Parquet file to S3, if the output sink includes Parquet files
+    if OUTPUT_SINK in ["parquet", "both"]:
+        upload_kubecost_allocation_parquet_to_s3(S3_BUCKET_NAME, CLUSTER_ID, month,
+                                                 year, assume_role_response, parquet_file_path)
+
+        # Verifying the uploaded file by reading only its footer, and uploading it again once if it fails
+        if VERIFY_UPLOADS and not verify_uploaded_kubecost_allocation_parquet(
+                S3_BUCKET_NAME, CLUSTER_ID, month, year, assume_role_response, parquet_file_path):
+            logger.warning(f"Uploading the Parquet file for date {date} again, after failed verification")
+            if run_telemetry:
+                run_telemetry["upload_retries"] += 1
+            upload_kubecost_allocation_parquet_to_s3(S3_BUCKET_NAME, CLUSTER_ID, month, year,
+                                                     assume_role_response, parquet_file_path)
+            if not verify_uploaded_kubecost_allocation_parquet(S3_BUCKET_NAME, CLUSTER_ID, month, year,
+                                                               assume_role_response, parquet_file_path):
+                logger.error(f"Verification of the uploaded Parquet file for date {date} failed twice")
+                sys.exit(1)
+        partition = (CLUSTER_ID.split(":")[4], CLUSTER_ID.split(":")[3], year, month)
+
+    # Committing the data of the Parquet file to the Iceberg table, overwriting the partition of the date
+    if OUTPUT_SINK in ["iceberg", "both"]:
+        iceberg_commit_kubecost_allocation_parquet(iceberg_catalog, ICEBERG_TABLE, CLUSTER_ID, date,
+                                                   parquet_file_path)
+
+    return partition
+
+
+def get_peak_rss(reset=False):
+    """Reads the peak resident set size (RSS) of the process, from "/proc/self/status" (Linux only).
+
+    :param reset: Dictates whether to reset the peak RSS first, so that it's tracked per run (in daemon mode)
+    :return: The peak RSS (in bytes), or "None" if it isn't available
+    """
+
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    return None
+
+
+def reset_run_telemetry():
+    """Resets the run telemetry at the start of a run.
+
+    :return:
+    """
+
+    run_telemetry.clear()
+    run_telemetry.update({
+        "run_start": time.time(), "dates_collected": [], "collection_strategies": [], "backfill_seconds": 0.0,
+        "kubecost_api_seconds": 0.0, "transform_seconds": 0.0, "output_seconds": 0.0, "merge_seconds": 0.0,
+        "kubecost_api_calls": 0, "kubecost_response_bytes": 0, "kubecost_cache_hits": 0, "rows": 0,
+        "folded_allocations": 0, "output_bytes": 0, "aws_retries": 0, "upload_retries": 0
+    })
+    get_peak_rss(reset=True)
+
+
+def upload_run_telemetry_to_s3(s3_bucket_name, telemetry_prefix, cluster_id, uploaded_dates, assume_role_response):
+    """Uploads the telemetry of the run to S3, as a Parquet file with a single row.
+    The files are partitioned the same way as the Kubecost Allocation data, under the telemetry prefix.
+    The file name includes the run start time in milliseconds, so consecutive short runs don't overwrite each other.
+    A failure to upload the telemetry is logged, but doesn't fail the run.
+
+    :param s3_bucket_name: The S3 bucket name to use
+    :param telemetry_prefix: The S3 prefix of the run telemetry
+    :param cluster_id: The cluster ID to use for the S3 bucket prefix and Parquet file name
+    :param uploaded_dates: The dates that were uploaded to the output sink in the run
+    :param assume_role_response: The Assume Role API call response
+    :return:
+    """
+
+    cluster_name = cluster_id.split("/")[-1]
+    cluster_account_id = cluster_id.split(":")[4]
+    cluster_region_code = cluster_id.split(":")[3]
+    run_start = datetime.datetime.fromtimestamp(run_telemetry["run_start"], datetime.timezone.utc).replace(tzinfo=None)
+    s3_key = (f"{telemetry_prefix}/account_id={cluster_account_id}/region={cluster_region_code}/"
+              f"year={run_start.strftime('%Y')}/month={run_start.strftime('%m')}/"
+              f"{run_start.strftime('%Y-%m-%dT%H-%M-%S')}-{run_start.microsecond // 1000:03d}_{cluster_name}"
+              f"{kubecost_shard_suffix(SHARD_INDEX, SHARD_COUNT)}.snappy.parquet")
+
+    record = {
+        **{x: run_telemetry[x] for x in RUN_TELEMETRY_SCHEMA.names if x in run_telemetry},
+        "cluster_id": cluster_id, "cluster_name": cluster_name, "shard_index": SHARD_INDEX, "shard_count": SHARD_COUNT,
+        "run_start": run_start, "duration_seconds": time.time() - run_telemetry["run_start"],
+        "dates_collected": ",".join(run_telemetry["dates_collected"]),
+        "dates_collected_count": len(run_telemetry["dates_collected"]), "dates_uploaded_count": len(uploaded_dates),
+        "collection_strategies": ",".join(sorted(set(run_telemetry["collection_strategies"]))),
+        "peak_rss_bytes": get_peak_rss(), "memory_limit_bytes": get_cgroup_memory_limit_and_usage()[0]
+    }
+    sink = pa.BufferOutputStream()
+    pq.write_table(pa.Table.from_pylist([record], schema=RUN_TELEMETRY_SCHEMA), sink)
+
+    try:
+        client = get_aws_client("s3", assume_role_response)
+        logger.info(f"Uploading the run telemetry to '{s3_key}' in S3 Bucket '{s3_bucket_name}'...")
+        client.put_object(Bucket=s3_bucket_name, Key=s3_key, Body=sink.getvalue().to_pybytes())
+    except botocore.exceptions.ClientError as error:
+        logger.warning(f"Unable to upload the run telemetry: {error}")
+
+
+def iceberg_table_maintenance(iceberg_catalog, table_identifier, cluster_id, expire_older_than_days):
+    """Compacts the partitions of the Iceberg table, and expires old snapshots.
+    Each partition with more than one data file is rewritten as a single commit, which replaces its data files.
+    Then, snapshots that are older than the given number of days are expired (except the current snapshot).
+
+    :param iceberg_catalog: The Iceberg catalog
+    :param table_identifier: The Iceberg table identifier, in format of "<namespace>.<table>"
+    :param cluster_id: If given, only the partitions of this cluster are compacted
+    :param expire_older_than_days: Snapshots older than this number of days are expired
+    :return:
+    """
+
+    import pyiceberg.exceptions
+
+    try:
+        table = iceberg_catalog.load_table(table_identifier)
+
+        for partition in table.inspect.partitions().to_pylist():
+            partition_cluster_id = partition["partition"].get("cluster_id")
+            partition_day = partition["partition"].get("day")
+            if (cluster_id and partition_cluster_id != cluster_id) or partition_day is None or partition[
+                    "file_count"] < 2:
+                continue
+
+            date = iceberg_partition_date(partition_day)
+            logger.info(f"Compacting {partition['file_count']} data files of cluster '{partition_cluster_id}' for "
+                        f"date {date} in Iceberg table '{table_identifier}'...")
+            partition_filter = iceberg_partition_filter(partition_cluster_id, date)
+            table.overwrite(table.scan(row_filter=partition_filter).to_arrow(), overwrite_filter=partition_filter,
+                            snapshot_properties={"kubecost-s3-exporter.date": date,
+                                                 "kubecost-s3-exporter.operation": "compaction"})
+
+        logger.info(f"Expiring snapshots older than {expire_older_than_days} days in Iceberg table "
+                    f"'{table_identifier}'...")
+        table.maintenance.expire_snapshots().older_than(
+            datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=expire_older_than_days)).commit()
+    except (pyiceberg.exceptions.NoSuchTableError, pyiceberg.exceptions.CommitFailedException,
+            botocore.exceptions.ClientError, OSError, ValueError) as error:
+        logger.error(f"Maintenance of Iceberg table '{table_identifier}' failed: {error}")
+        sys.exit(1)
+
+
+def prepare_exporter_state():
+    """Prepares the state which is used by the data collection runs.
+    In daemon mode, it's prepared once and kept warm between runs, together with the allocations count history.
+
+    :return: A dict of the exporter state
+    """
+
+    ################
+    # Preparations #
+    ################
+
+    # The below set of functions are used to prepare things needed to execute other logic, as follows:
+    # 1. Define the DataFrame columns
+    # 2. Assume IAM Role to be used in all other AWS API calls
+    # 3. Optionally, retrieve Kubecost root CA certificate from AWS Secrets Manager
+
+    # Creating a mapping of Kubecost K8s labels and annotations to original K8s labels and annotations
+    kubecost_labels_to_orig_labels = create_kubecost_labels_to_k8s_labels_mapping(LABELS)
+    kubecost_annotations_to_orig_annotations = create_kubecost_annotations_to_k8s_annotations_mapping(ANNOTATIONS)
+
+    # Defining a mapping of the DataFrame columns to their NA/NaN value
+    dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations = define_dataframe_columns(
+        kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations)
+
+    # Defining the allocation fields to keep when decoding Kubecost Allocation API responses (client-side projection)
+    # And the Kubecost filter used for narrowing the Kubecost Allocation API queries (server-side filtering)
+    kubecost_allocation_projection = define_kubecost_allocation_projection(
+        dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations)
+    kubecost_allocation_filter = build_kubecost_allocation_filter(EXCLUDED_NAMESPACES, EXCLUDED_CONTROLLERS,
+                                                                  KUBECOST_ALLOCATION_API_FILTER)
+
+    # In case the EKS cluster and target services (AWS Secret Manager and S3) are in different account:
+    # Assume IAM Role once, to be used in all other AWS API calls
+    # Content of "assume_role_response" will be the sts:AssumeRole API response
+    # Otherwise:
+    # Sets "assume_role_response" to "None"
+    # Functions executing AWS API calls conditionally set their credentials as follows:
+    # If "assume_role_response" has content, using the assumed role credentials
+    # If "assume_role_response" is "None", they won't pass credentials, but will use the IRSA credentials
+    if IRSA_PARENT_IAM_ROLE_ARN:
+        assume_role_response = iam_assume_role(IRSA_PARENT_IAM_ROLE_ARN, "kubecost-s3-exporter")
+    else:
+        assume_role_response = None
+
+    # If the user gave a secret name as an input to the "KUBECOST_CA_CERTIFICATE_SECRET_NAME" environment variable
+    # 1. The secret with the given name will be retrieved from AWS Secrets Manager
+    # 2. An SSL context will be created in memory from the content of the CA certificate
+    # 3. The Kubecost HTTP session will use it for the Kubecost API endpoint only (the AWS clients aren't affected)
+    # Without TLS verification, the CA certificate isn't used, so the default adapter is kept
+    if KUBECOST_CA_CERTIFICATE_SECRET_NAME:
+        kubecost_ca_cert = secrets_manager_get_secret_value(KUBECOST_CA_CERTIFICATE_SECRET_NAME,
+                                                            KUBECOST_CA_CERTIFICATE_SECRET_REGION, assume_role_response)
+        if TLS_VERIFY:
+            kubecost_session.mount(KUBECOST_API_ENDPOINT, create_kubecost_tls_adapter(kubecost_ca_cert))
+
+    # If the output sink includes Iceberg, the Iceberg catalog is loaded once, to be used in all runs
+    iceberg_catalog = None
+    if OUTPUT_SINK != "parquet":
+        iceberg_catalog = iceberg_load_catalog(ICEBERG_CATALOG_NAME, ICEBERG_CATALOG_PROPERTIES, assume_role_response)
+
+    return {
+        "kubecost_labels_to_orig_labels": kubecost_labels_to_orig_labels,
+        "kubecost_annotations_to_orig_annotations": kubecost_annotations_to_orig_annotations,
+        "dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations":
+            dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations,
+        "kubecost_allocation_projection": kubecost_allocation_projection,
+        "kubecost_allocation_filter": kubecost_allocation_filter,
+        "assume_role_response": assume_role_response,
+        "iceberg_catalog": iceberg_catalog,
+        "allocations_history": None,
+        "lease_owner": f"{os.uname().nodename}/{os.getpid()}"
+    }
+
+
+def refresh_exporter_state_credentials(exporter_state):
+    """Assumes the IAM Role again, if its credentials are about to expire (in daemon mode, between runs).
+    The AWS clients of the expired credentials are dropped, so that they're created again with the new credentials.
+
+    :param exporter_state: The exporter state
+    :return:
+    """
+
+    assume_role_response = exporter_state["assume_role_response"]
+    if assume_role_response and assume_role_response["Credentials"]["Expiration"] - datetime.datetime.now(
+            datetime.timezone.utc) < datetime.timedelta(minutes=15):
+        logger.info("Assuming IAM Role again, as the credentials are about to expire...")
+        exporter_state["assume_role_response"] = iam_assume_role(IRSA_PARENT_IAM_ROLE_ARN, "kubecost-s3-exporter")
+        aws_clients.clear()
+        if exporter_state["iceberg_catalog"]:
+            exporter_state["iceberg_catalog"] = iceberg_load_catalog(ICEBERG_CATALOG_NAME, ICEBERG_CATALOG_PROPERTIES,
+                                                                     exporter_state["assume_role_response"])
+
+
+def cleanup_exporter_state(exporter_state):
+    """Cleans up the exporter state (the HTTP adapter of the root CA certificate, in the Kubecost HTTP session).
+
+    :param exporter_state: The exporter state
+    :return:
+    """
+
+    # Root CA certificate cleanup
+    if KUBECOST_API_ENDPOINT in kubecost_session.adapters:
+        kubecost_session.adapters.pop(KUBECOST_API_ENDPOINT).close()
+
+
+def main(exporter_state=None):
+    """Runs the backfill logic and the data collection logic once.
+
+    :param exporter_state: The exporter state. If "None", it's prepared and cleaned up as part of this run
+    :return: The dates that were uploaded to S3
+    """
+
+    one_shot_run = exporter_state is None
+    if one_shot_run:
+        exporter_state = prepare_exporter_state()
+
+    kubecost_labels_to_orig_labels = exporter_state["kubecost_labels_to_orig_labels"]
+    kubecost_annotations_to_orig_annotations = exporter_state["kubecost_annotations_to_orig_annotations"]
+    dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations = exporter_state[
+        "dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations"]
+    kubecost_allocation_projection = exporter_state["kubecost_allocation_projection"]
+    kubecost_allocation_filter = exporter_state["kubecost_allocation_filter"]
+    assume_role_response = exporter_state["assume_role_response"]
+    iceberg_catalog = exporter_state["iceberg_catalog"]
+
+    if RUN_TELEMETRY:
+        reset_run_telemetry()
+
+    ##################
+    # Backfill logic #
+    ##################
+
+    # The below set of functions is used to calculate which dates should be collected from Kubecost.
+    # This is based on a backfill period in days that is given as an input (default is 15 days).
+    # The logic is as follows:
+
+    # Based on the given backfill period, the following is done:
+    # 1. The window for the Kubecost API call is defined, based on the backfill period.
     # The start date is the first day of the backfill period, and end date is 2 days ago (from today).
     # 2. Executing Kubecost Allocation API call for the above window.
     # The API call is executed with the highest possible aggregation (cluster), daily granularity, and "1d" resolution
@@ -916,31 +3652,44 @@ def main():
     # 5. Find the missing dates in S3, by comparing the dates available in Kubecost with the dates available in S3.
     # Those dates will be used as input to the data collection logic.
 
-    logger.info("### Backfill Dates Calculation Logic Start ###")
-
-    # Define the Kubecost window, execute Kubecost API call and extract the dates and window for each timeset
-    kubecost_backfill_start_date_midnight, kubecost_backfill_end_date_midnight = kubecost_backfill_period_window_calc(
-        BACKFILL_PERIOD_DAYS)
-    kubecost_backfill_period_allocation_data = execute_kubecost_allocation_api(TLS_VERIFY, root_ca_cert_path,
-                                                                               KUBECOST_API_ENDPOINT,
-                                                                               kubecost_backfill_start_date_midnight,
-                                                                               kubecost_backfill_end_date_midnight,
-                                                                               "daily", "cluster", CONNECTION_TIMEOUT,
-                                                                               KUBECOST_ALLOCATION_API_READ_TIMEOUT,
-                                                                               "No", True, True, True, True, False)
-    kubecost_backfill_period_available_dates = get_kubecost_backfill_period_available_dates(
-        kubecost_backfill_period_allocation_data)
-
-    # Get available dates in S3
-    s3_backfill_period_available_dates = get_s3_backfill_period_available_dates(S3_BUCKET_NAME, CLUSTER_ID,
-                                                                                BACKFILL_PERIOD_DAYS,
-                                                                                assume_role_response)
+    # In offline replay mode, the backfill logic is skipped, and all dates available in the cache are replayed.
+    # This is so that transform changes can be re-run (or benchmarked) from cached responses, without querying Kubecost
+    backfill_start = time.time()
+    if KUBECOST_CACHE_REPLAY:
+        logger.info("### Offline Replay Mode: collecting all dates available in the Kubecost cache ###")
+        if not os.path.isdir(KUBECOST_CACHE_DIR):
+            logger.error(f"The Kubecost cache directory '{KUBECOST_CACHE_DIR}' doesn't exist")
+            sys.exit(1)
+        kubecost_dates_missing_from_s3 = get_kubecost_cache_available_dates(KUBECOST_CACHE_DIR, AGGREGATION,
+                                                                            KUBECOST_SUB_WINDOW_HOURS)
+        s3_backfill_period_available_dates = []
+
+    else:
+        logger.info("### Backfill Dates Calculation Logic Start ###")
+
+        # Define the Kubecost window, execute Kubecost API call and extract the dates and window for each timeset
+        kubecost_backfill_start_date_midnight, kubecost_backfill_end_date_midnight = \
+            kubecost_backfill_period_window_calc(BACKFILL_PERIOD_DAYS)
+        kubecost_backfill_period_allocation_data = execute_kubecost_allocation_api(
+            TLS_VERIFY, KUBECOST_API_ENDPOINT, kubecost_backfill_start_date_midnight,
+            kubecost_backfill_end_date_midnight, "daily", "cluster", CONNECTION_TIMEOUT,
+            KUBECOST_ALLOCATION_API_READ_TIMEOUT, "No", True, True, True, True, False, "", None)
+        kubecost_backfill_period_available_dates = get_kubecost_backfill_period_available_dates(
+            kubecost_backfill_period_allocation_data)
 
-    # Find missing dates in S3
-    kubecost_dates_missing_from_s3 = calc_kubecost_dates_missing_from_s3(kubecost_backfill_period_available_dates,
-                                                                         s3_backfill_period_available_dates)
+        # Get available dates in S3 (or in the Iceberg table, or in both, based on the output sink)
+        # In daemon mode, they're listed in every run, as other runners might have uploaded or deleted dates
+        s3_backfill_period_available_dates = get_output_sink_backfill_period_available_dates(iceberg_catalog,
+                                                                                           assume_role_response)
 
-    logger.info("### Backfill Dates Calculation Logic End ###")
+        # Find missing dates in S3
+        kubecost_dates_missing_from_s3 = calc_kubecost_dates_missing_from_s3(kubecost_backfill_period_available_dates,
+                                                                             s3_backfill_period_available_dates)
+
+        logger.info("### Backfill Dates Calculation Logic End ###")
+
+    if run_telemetry:
+        run_telemetry["backfill_seconds"] = time.time() - backfill_start
 
     #########################
     # Data Collection Logic #
@@ -949,7 +3698,8 @@ def main():
     # The below set of functions is used collect the data from Kubecost, convert it to Parquet and upload it to S3.
     # The collection windows are based on the result of the backfill logic above.
     # The logic is as follows, for each date identified as missing in S3 (if any. If none - data collection isn't done):
-    # 1. Executing the Kubecost Allocation API call
+    # 1. Choosing the collection strategy based on the memory limit, and executing the Kubecost Allocation API call(s)
+    # Consecutive missing dates are fetched in a single multi-day API call (as memory allows), and split by date
     # 2. Executing the Kubecost Assets API call
     # 3. Performing different changes on the data:
     # 3.1 Adding the real cluster ID and name to each allocation properties
@@ -967,55 +3717,494 @@ def main():
     # 4.7 The DataFrame is filtered to include only the required column
     # 4.8 The Dataframe is converted to Snappy-compressed Parquet
     # 5. Uploading the Snappy-compressed Parquet file to S3
+    # 6. Optionally, verifying the uploaded file by reading only its Parquet footer from S3
+    # 7. Optionally, registering the partitions of the uploaded files in AWS Glue (once, for all uploaded files)
+    # 8. Optionally, committing the data to an Iceberg table, instead of (or in addition to) steps 5-7
+    # Optionally, a lease is acquired in S3 for each date before it's collected, and released after it's uploaded.
+    # Dates whose lease is held by another runner (for example, an overrunning CronJob run) are skipped.
+    # The leases are renewed by a heartbeat thread during the collection, and dates whose lease was taken over anyway
+    # (for example, if the heartbeat was stalled) aren't uploaded
+    # In sharded collection, each worker collects only its shard of each date (a subset of the Namespaces).
+    # The shard is uploaded to the shards prefix instead of steps 5-8, and when all shards of a date are uploaded,
+    # the worker that finds them merges them to the Parquet file of the date, and does steps 5-8 for it
+
+    # The per-run cleanup is done also if the run failed, as in daemon mode, the next runs are done in the same process
+    # The leases are popped once they're released, so the leases left are of dates that weren't collected
+    uploaded_dates = []
+    leases = {}
+    leases_lock = threading.Lock()
+    leases_heartbeat_stop = threading.Event()
+    leases_heartbeat = None
+    try:
+        # Dates where the shard of this worker was already uploaded (for example, by a previous run) are only merged
+        shard_merge_dates = []
+        if kubecost_dates_missing_from_s3 and SHARD_COUNT > 1:
+            for date in list(kubecost_dates_missing_from_s3):
+                if SHARD_INDEX in list_kubecost_shards(S3_BUCKET_NAME, SHARD_PREFIX, CLUSTER_ID, date, SHARD_COUNT,
+                                                       assume_role_response):
+                    shard_merge_dates.append(date)
+                    del kubecost_dates_missing_from_s3[date]
+
+        # Acquiring the leases of the missing dates
+        if kubecost_dates_missing_from_s3 and COLLECTION_LEASE:
+            leases = acquire_kubecost_dates_leases(S3_BUCKET_NAME, COLLECTION_LEASE_PREFIX, CLUSTER_ID,
+                                                   list(kubecost_dates_missing_from_s3), exporter_state["lease_owner"],
+                                                   COLLECTION_LEASE_DURATION_MINUTES, COLLECTION_LEASE_WAIT_MINUTES,
+                                                   assume_role_response)
+
+            # Another runner might have uploaded some of the dates (and released their leases) since they were listed
+            if leases and not KUBECOST_CACHE_REPLAY:
+                s3_backfill_period_available_dates = get_output_sink_backfill_period_available_dates(
+                    iceberg_catalog, assume_role_response)
+                for date in [x for x in leases if x in s3_backfill_period_available_dates]:
+                    logger.info(f"Skipping date {date}, as it was uploaded by another runner")
+                    release_s3_lease(S3_BUCKET_NAME, s3_lease_key(COLLECTION_LEASE_PREFIX, CLUSTER_ID, date),
+                                     leases.pop(date), assume_role_response)
+            kubecost_dates_missing_from_s3 = {x: kubecost_dates_missing_from_s3[x] for x in leases}
+
+            # Renewing the leases every third of the lease duration, until the run ends
+            if leases:
+                leases_heartbeat = threading.Thread(target=kubecost_dates_leases_heartbeat, daemon=True, args=(
+                    leases_heartbeat_stop, COLLECTION_LEASE_DURATION_MINUTES * 20, S3_BUCKET_NAME,
+                    COLLECTION_LEASE_PREFIX, CLUSTER_ID, leases, leases_lock, exporter_state["lease_owner"],
+                    COLLECTION_LEASE_DURATION_MINUTES, assume_role_response))
+                leases_heartbeat.start()
+
+        # Narrowing the filter to the Namespaces of the shard of this worker.
+        # The Namespaces are listed once, for the window of all the dates to collect.
+        # If no Namespace is assigned to the shard, an empty shard marker is uploaded for each date instead
+        if kubecost_dates_missing_from_s3 and SHARD_COUNT > 1:
+            kubecost_allocation_filter = build_kubecost_shard_filter(
+                kubecost_allocation_filter, None if SHARD_NAMESPACES else get_kubecost_namespaces(
+                    datetime.datetime.strptime(
+                        min(x["start"] for x in kubecost_dates_missing_from_s3.values()), "%Y-%m-%dT%H:%M:%SZ"),
+                    datetime.datetime.strptime(max(x["end"] for x in kubecost_dates_missing_from_s3.values()),
+                                               "%Y-%m-%dT%H:%M:%SZ"), kubecost_allocation_filter),
+                SHARD_INDEX, SHARD_COUNT, SHARD_NAMESPACES)
+            if kubecost_allocation_filter is None:
+                logger.info(f"No Namespace is assigned to shard {SHARD_INDEX} of {SHARD_COUNT}")
+                for date in kubecost_dates_missing_from_s3:
+                    upload_kubecost_shard_to_s3(S3_BUCKET_NAME, kubecost_shard_s3_key(
+                        SHARD_PREFIX, CLUSTER_ID, date, SHARD_INDEX, SHARD_COUNT), assume_role_response, None)
+                    shard_merge_dates.append(date)
+                    if COLLECTION_LEASE:
+                        with leases_lock:
+                            release_s3_lease(S3_BUCKET_NAME, s3_lease_key(COLLECTION_LEASE_PREFIX, CLUSTER_ID, date),
+                                             leases.pop(date), assume_role_response)
+                kubecost_dates_missing_from_s3 = {}
+            else:
+                logger.info(f"Collecting shard {SHARD_INDEX} of {SHARD_COUNT}, "
+                            f"with filter '{kubecost_allocation_filter}'")
+
+        if kubecost_dates_missing_from_s3 or shard_merge_dates:
+
+            logger.info("### Data Collection Logic Start ###")
+            if kubecost_dates_missing_from_s3:
+                logger.info(f"Data will be collected from Kubecost for dates "
+                            f"{', '.join(kubecost_dates_missing_from_s3)}")
+
+            uploaded_partitions = set()
+            memory_limit = get_cgroup_memory_limit_and_usage()[0]
+            allocations_history = exporter_state["allocations_history"]
+            prefetched_time_sets = {}
+
+            for date, window in kubecost_dates_missing_from_s3.items():
+                start = datetime.datetime.strptime(window["start"], "%Y-%m-%dT%H:%M:%SZ")
+                end = datetime.datetime.strptime(window["end"], "%Y-%m-%dT%H:%M:%SZ")
+
+                # Renewing the lease of the date, and skipping the date if it expired and was taken over by another
+                # runner
+                if COLLECTION_LEASE and not renew_kubecost_dates_leases(
+                        S3_BUCKET_NAME, COLLECTION_LEASE_PREFIX, CLUSTER_ID, [date], leases, leases_lock,
+                        exporter_state["lease_owner"], COLLECTION_LEASE_DURATION_MINUTES, assume_role_response):
+                    logger.warning(f"Skipping date {date}, as its lease was taken over by another runner")
+                    prefetched_time_sets.pop(date, None)
+                    continue
+
+                # Choosing the collection strategy, based on the memory limit and the allocations count history
+                # Dates that were fetched as part of a multi-day API call keep the collection strategy of that call
+                if date in prefetched_time_sets:
+                    logger.info(f"Using the data of date {date} from the multi-day API call")
+                # In offline replay mode, dates cached in sub-day windows are replayed with the strategy they were
+                # collected with, as their cache entries match only the API calls of that strategy
+                elif "collection_strategy" in window:
+                    collection_strategy = window["collection_strategy"]
+                elif COLLECTION_STRATEGY != "auto":
+                    collection_strategy = COLLECTION_STRATEGY
+                elif memory_limit is None:
+                    collection_strategy = "single"
+                else:
+                    if allocations_history is None:
+                        allocations_history = get_kubecost_allocations_history_from_s3(
+                            S3_BUCKET_NAME, CLUSTER_ID, max(s3_backfill_period_available_dates),
+                            assume_role_response) if s3_backfill_period_available_dates else None
+                    # In offline replay mode, the probe isn't possible, so the daily call is assumed to exceed a chunk
+                    if allocations_history is None and KUBECOST_CACHE_REPLAY:
+                        allocations_history = {"allocations_per_day": TRANSFORM_CHUNK_SIZE + 1,
+                                               "source": "no history in offline replay mode"}
+                    elif allocations_history is None:
+                        allocations_history = probe_kubecost_allocations_count(
+                            TLS_VERIFY, KUBECOST_API_ENDPOINT, end, AGGREGATION, CONNECTION_TIMEOUT,
+                            KUBECOST_ALLOCATION_API_READ_TIMEOUT, kubecost_allocation_filter)
+                    collection_strategy = choose_collection_strategy(
+                        memory_limit, get_cgroup_memory_limit_and_usage()[1], allocations_history,
+                        MEMORY_HEADROOM_PERCENT, TRANSFORM_CHUNK_SIZE,
+                        ["single", "chunked"] if KUBECOST_CACHE_REPLAY else ["single", "chunked", "windowed"])
+
+                # Fetching this date and the consecutive missing dates after it in a single multi-day API call
+                # This isn't done in offline replay mode, where each date is replayed from the cache entry covering it
+                if not prefetched_time_sets and collection_strategy not in ["windowed", "paginated"] and \
+                        KUBECOST_RANGE_FETCH_MAX_DAYS > 1 and not KUBECOST_CACHE_REPLAY:
+                    range_fetch_dates = calc_kubecost_range_fetch_dates(
+                        kubecost_dates_missing_from_s3, date, calc_kubecost_range_fetch_max_days(
+                            memory_limit, get_cgroup_memory_limit_and_usage()[1], allocations_history,
+                            MEMORY_HEADROOM_PERCENT, TRANSFORM_CHUNK_SIZE, collection_strategy,
+                            KUBECOST_RANGE_FETCH_MAX_DAYS))
+                    if len(range_fetch_dates) > 1:
+                        logger.info(f"Fetching dates {', '.join(range_fetch_dates)} in a single API call")
+                        prefetched_time_sets = fetch_kubecost_allocation_data_range(
+                            start, datetime.datetime.strptime(
+                                kubecost_dates_missing_from_s3[range_fetch_dates[-1]]["end"], "%Y-%m-%dT%H:%M:%SZ"),
+                            kubecost_allocation_filter, kubecost_allocation_projection)
+
+                # Executing Kubecost Allocation API calls (unless the date was already fetched), adding the real
+                # cluster ID and name from the cluster ID input, and updating timestamps.
+                # The batches are consumed one by one while they're converted to Parquet
+                kubecost_allocation_data_batches = collect_kubecost_allocation_data_batches(
+                    collection_strategy, start, end, kubecost_allocation_filter, kubecost_allocation_projection,
+                    prefetched_time_sets.pop(date, None))
+
+                # Transforming Kubecost's updated allocation data to a Snappy-compressed Parquet, and uploading it to S3
+                # The transform duration in the run telemetry excludes the Kubecost API calls done while transforming
+                transform_start = time.time()
+                kubecost_api_seconds = run_telemetry.get("kubecost_api_seconds")
+                parquet_file_path, parquet_file_umask, max_allocations_per_batch = kubecost_allocation_data_to_parquet(
+                    kubecost_allocation_data_batches,
+                    dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations,
+                    kubecost_labels_to_orig_labels, kubecost_annotations_to_orig_annotations, date, CLUSTER_ID,
+                    None if collection_strategy == "single" else TRANSFORM_CHUNK_SIZE, collection_strategy)
+                try:
+                    parquet_file_metadata = pq.read_metadata(parquet_file_path)
+                    parquet_file_rows = parquet_file_metadata.num_rows
+                    folded_allocations = json.loads(parquet_file_metadata.metadata[b"kubecost_s3_exporter"]).get(
+                        "folded_allocations", 0)
+                    if run_telemetry:
+                        run_telemetry["transform_seconds"] += time.time() - transform_start - (
+                            run_telemetry["kubecost_api_seconds"] - kubecost_api_seconds)
+                        run_telemetry["dates_collected"].append(date)
+                        run_telemetry["collection_strategies"].append(collection_strategy)
+                        run_telemetry["rows"] += parquet_file_rows
+                        run_telemetry["folded_allocations"] += folded_allocations
+                        run_telemetry["output_bytes"] += os.path.getsize(parquet_file_path)
+                    if collection_strategy == "windowed":
+                        allocations_history = {"allocations_per_day": parquet_file_rows + folded_allocations,
+                                               "allocations_per_hour": max_allocations_per_batch,
+                                               "source": f"the collection of {date}"}
+                    else:
+                        allocations_history = {
+                            "allocations_per_hour" if collection_strategy == "paginated" else "allocations_per_day":
+                                max_allocations_per_batch, "source": f"the collection of {date}"}
+                    exporter_state["allocations_history"] = allocations_history
+
+                    # Renewing the lease of the date right before the output, and not outputting the date if its lease
+                    # was taken over by another runner during the collection (which then outputs the date itself)
+                    if COLLECTION_LEASE and not renew_kubecost_dates_leases(
+                            S3_BUCKET_NAME, COLLECTION_LEASE_PREFIX, CLUSTER_ID, [date], leases, leases_lock,
+                            exporter_state["lease_owner"], COLLECTION_LEASE_DURATION_MINUTES, assume_role_response):
+                        logger.warning(f"Not outputting date {date}, as its lease was taken over by another runner")
+                        continue
+
+                    # Uploading the Parquet file of the shard to the shards prefix, in sharded collection
+                    # Otherwise, outputting the Parquet file to the output sink (S3 and/or the Iceberg table)
+                    output_start = time.time()
+                    if SHARD_COUNT > 1:
+                        upload_kubecost_shard_to_s3(S3_BUCKET_NAME, kubecost_shard_s3_key(
+                            SHARD_PREFIX, CLUSTER_ID, date, SHARD_INDEX, SHARD_COUNT), assume_role_response,
+                            parquet_file_path)
+                        shard_merge_dates.append(date)
+                    else:
+                        uploaded_partitions.add(output_kubecost_allocation_parquet(
+                            date, parquet_file_path, iceberg_catalog, assume_role_response))
+                        uploaded_dates.append(date)
+                        s3_backfill_period_available_dates.append(date)
+                    if run_telemetry:
+                        run_telemetry["output_seconds"] += time.time() - output_start
+                finally:
+
+                    # Parquet cleanup (also if the output failed, so that a daemon doesn't accumulate temp files)
+                    remove_parquet_file(parquet_file_path, parquet_file_umask)
+
+                # Releasing the lease of the date (unless the heartbeat found it taken over during the output)
+                if COLLECTION_LEASE:
+                    with leases_lock:
+                        if date in leases:
+                            release_s3_lease(S3_BUCKET_NAME, s3_lease_key(COLLECTION_LEASE_PREFIX, CLUSTER_ID, date),
+                                             leases.pop(date), assume_role_response)
+
+            # Merging the shards of each date whose shards were all uploaded, and outputting the merged Parquet file
+            # Any worker that finds all the shards of a date merges them, so it's done by the last worker to finish
+            for date in shard_merge_dates:
+                uploaded_shards = list_kubecost_shards(S3_BUCKET_NAME, SHARD_PREFIX, CLUSTER_ID, date, SHARD_COUNT,
+                                                       assume_role_response)
+                if len(uploaded_shards) < SHARD_COUNT:
+                    logger.info(f"Shards {', '.join(str(x) for x in range(SHARD_COUNT) if x not in uploaded_shards)} "
+                                f"of date {date} weren't uploaded yet. The date will be merged by the last worker to "
+                                f"finish")
+                    continue
+                merge_start = time.time()
+                merged_shards = merge_kubecost_shards_parquet(S3_BUCKET_NAME, uploaded_shards, date, CLUSTER_ID,
+                                                              assume_role_response)
+                if merged_shards is None:
+                    continue
+                parquet_file_path, parquet_file_umask = merged_shards
 
-    if kubecost_dates_missing_from_s3:
+                try:
+                    output_start = time.time()
+                    uploaded_partitions.add(output_kubecost_allocation_parquet(date, parquet_file_path, iceberg_catalog,
+                                                                               assume_role_response))
+                    uploaded_dates.append(date)
+                    s3_backfill_period_available_dates.append(date)
+                    delete_kubecost_shards(S3_BUCKET_NAME, uploaded_shards, assume_role_response)
+                    if run_telemetry:
+                        run_telemetry["merge_seconds"] += output_start - merge_start
+                        run_telemetry["output_seconds"] += time.time() - output_start
+                        run_telemetry["output_bytes"] += os.path.getsize(parquet_file_path)
+                finally:
+
+                    # Parquet cleanup
+                    remove_parquet_file(parquet_file_path, parquet_file_umask)
+
+            # Registering the partitions of the uploaded files in AWS Glue, so that the data is available in Athena
+            uploaded_partitions.discard(None)
+            if GLUE_TABLE_NAME and uploaded_partitions:
+                output_start = time.time()
+                glue_register_partitions(GLUE_DATABASE_NAME, GLUE_TABLE_NAME, GLUE_REGION, GLUE_ENDPOINT_URL,
+                                         S3_BUCKET_NAME, uploaded_partitions, assume_role_response)
+                if run_telemetry:
+                    run_telemetry["output_seconds"] += time.time() - output_start
+
+            logger.info("### Data Collection Logic End ###")
+    finally:
+        leases_heartbeat_stop.set()
+        if leases_heartbeat:
+            leases_heartbeat.join()
+        for date, lease_etag in leases.items():
+            release_s3_lease(S3_BUCKET_NAME, s3_lease_key(COLLECTION_LEASE_PREFIX, CLUSTER_ID, date), lease_etag,
+                             assume_role_response)
+
+        # Uploading the telemetry of the run (also when no date was collected, or the run failed)
+        # This is for analyzing runs across the fleet
+        if RUN_TELEMETRY:
+            upload_run_telemetry_to_s3(S3_BUCKET_NAME, RUN_TELEMETRY_PREFIX, CLUSTER_ID, uploaded_dates,
+                                       assume_role_response)
+
+        if one_shot_run:
+            cleanup_exporter_state(exporter_state)
+
+    return uploaded_dates
+
+
+def verify_main(args):
+    """Verifies the Parquet objects in S3, by reading only their footers (the "verify" subcommand).
+
+    :param args: The command-line arguments of the subcommand
+    :return:
+    """
 
-        logger.info("### Data Collection Logic Start ###")
-        logger.info(f"Data will be collected from Kubecost for dates {', '.join(kubecost_dates_missing_from_s3)}")
+    parser = argparse.ArgumentParser(prog="kubecost-s3-exporter verify",
+                                     description="Verifies the Parquet objects in S3, by reading only their footers")
+    parser.add_argument("--prefix", help="The S3 prefix to verify. Default is the prefix of the cluster's account "
+                                         "and region")
+    parser.add_argument("--all-clusters", action="store_true",
+                        help="Verify the objects of all clusters under the prefix, not only of this cluster")
+    parser.add_argument("--workers", type=int, default=VERIFY_WORKERS, help="The number of objects to verify in "
+                                                                            "parallel")
+    parsed_args = parser.parse_args(args)
 
-        for date, window in kubecost_dates_missing_from_s3.items():
-            start = datetime.datetime.strptime(window["start"], "%Y-%m-%dT%H:%M:%SZ")
-            end = datetime.datetime.strptime(window["end"], "%Y-%m-%dT%H:%M:%SZ")
-            year = date.split("-")[0]
-            month = date.split("-")[1]
+    if IRSA_PARENT_IAM_ROLE_ARN:
+        assume_role_response = iam_assume_role(IRSA_PARENT_IAM_ROLE_ARN, "kubecost-s3-exporter")
+    else:
+        assume_role_response = None
 
-            # Executing Kubecost Allocation API call
-            kubecost_allocation_data = execute_kubecost_allocation_api(TLS_VERIFY, root_ca_cert_path,
-                                                                       KUBECOST_API_ENDPOINT, start, end, "daily",
-                                                                       AGGREGATION, CONNECTION_TIMEOUT,
-                                                                       KUBECOST_ALLOCATION_API_READ_TIMEOUT,
-                                                                       KUBECOST_ALLOCATION_API_PAGINATE, True, True,
-                                                                       True, True, False)
+    s3_prefix = parsed_args.prefix
+    if s3_prefix is None:
+        s3_prefix = f"account_id={CLUSTER_ID.split(':')[4]}/region={CLUSTER_ID.split(':')[3]}/"
+    cluster_name = None if parsed_args.all_clusters else CLUSTER_ID.split("/")[-1]
 
-            # Adding the real cluster ID and name from the cluster ID input
-            kubecost_allocation_data_with_eks_cluster_name = kubecost_allocation_data_add_cluster_id_and_name(
-                kubecost_allocation_data, CLUSTER_ID)
+    if verify_s3_parquet_objects(S3_BUCKET_NAME, s3_prefix, cluster_name, max(parsed_args.workers, 1),
+                                 assume_role_response):
+        sys.exit(1)
 
-            # Transforming Kubecost's Allocation API data to a list of lists, and updating timestamps
-            kubecost_updated_allocation_data = kubecost_allocation_data_timestamp_update(
-                kubecost_allocation_data_with_eks_cluster_name)
 
-            # Transforming Kubecost's updated allocation data to a Snappy-compressed Parquet, and uploading it to S3
-            parquet_file_path, parquet_file_umask = kubecost_allocation_data_to_parquet(
-                kubecost_updated_allocation_data,
-                dataframe_columns_to_na_value_mapping_with_kubecost_labels_annotations, kubecost_labels_to_orig_labels,
-                kubecost_annotations_to_orig_annotations, date, CLUSTER_ID)
-            upload_kubecost_allocation_parquet_to_s3(S3_BUCKET_NAME, CLUSTER_ID, month,
-                                                     year, assume_role_response, parquet_file_path)
+def iceberg_maintenance_main(args):
+    """Compacts the partitions of the Iceberg table and expires old snapshots (the "iceberg-maintenance" subcommand).
 
-            # Parquet cleanup
-            os.remove(parquet_file_path)
-            os.umask(parquet_file_umask)
-            os.rmdir(parquet_file_path.rsplit("/", 1)[0])
+    :param args: The command-line arguments of the subcommand
+    :return:
+    """
 
-        logger.info("### Data Collection Logic End ###")
+    parser = argparse.ArgumentParser(prog="kubecost-s3-exporter iceberg-maintenance",
+                                     description="Compacts the partitions of the Iceberg table and expires old "
+                                                 "snapshots")
+    parser.add_argument("--all-clusters", action="store_true",
+                        help="Compact the partitions of all clusters in the table, not only of this cluster")
+    parser.add_argument("--expire-older-than-days", type=int, default=7,
+                        help="Expire snapshots older than this number of days")
+    parsed_args = parser.parse_args(args)
+
+    if not ICEBERG_TABLE:
+        logger.error("The 'ICEBERG_TABLE' input is required for the 'iceberg-maintenance' subcommand")
+        sys.exit(1)
 
-    # Root CA certificate cleanup
-    if KUBECOST_CA_CERTIFICATE_SECRET_NAME:
-        os.remove(root_ca_cert_path)
-        os.umask(root_ca_cert_saved_umask)
-        os.rmdir(root_ca_cert_path.rsplit("/", 1)[0])
+    if IRSA_PARENT_IAM_ROLE_ARN:
+        assume_role_response = iam_assume_role(IRSA_PARENT_IAM_ROLE_ARN, "kubecost-s3-exporter")
+    else:
+        assume_role_response = None
+
+    iceberg_catalog = iceberg_load_catalog(ICEBERG_CATALOG_NAME, ICEBERG_CATALOG_PROPERTIES, assume_role_response)
+    iceberg_table_maintenance(iceberg_catalog, ICEBERG_TABLE, None if parsed_args.all_clusters else CLUSTER_ID,
+                              max(parsed_args.expire_older_than_days, 0))
+
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the health and metrics endpoints in daemon mode.
+    The "/healthz" endpoint returns 200 as long as a run succeeded recently, and 503 otherwise.
+    The "/metrics" endpoint returns the daemon metrics, in Prometheus text format.
+    """
+
+    def do_GET(self):
+        daemon_status = self.server.daemon_status
+        if self.path == "/healthz":
+
+            # The daemon is healthy if a run succeeded within the last two intervals (or since it started)
+            last_success = daemon_status["last_success_timestamp"] or daemon_status["start_timestamp"]
+            healthy = time.time() - last_success < 2 * (DAEMON_INTERVAL_MINUTES + DAEMON_JITTER_MINUTES) * 60
+            self.send_daemon_response(200 if healthy else 503, "ok\n" if healthy else "unhealthy\n")
+        elif self.path == "/metrics":
+            self.send_daemon_response(200, daemon_metrics(daemon_status))
+        else:
+            self.send_daemon_response(404, "not found\n")
+
+    def send_daemon_response(self, status_code, body):
+        body = body.encode()
+        self.send_response(status_code)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+
+        # The health and metrics endpoints are polled frequently, so requests aren't logged
+        pass
+
+
+def daemon_metrics(daemon_status):
+    """Formats the daemon metrics in Prometheus text format.
+
+    :param daemon_status: The daemon status
+    :return: The daemon metrics, in Prometheus text format
+    """
+
+    metrics = [
+        ("runs_total", "counter", "The number of data collection runs, by result",
+         [('{result="success"}', daemon_status["successful_runs"]),
+          ('{result="failure"}', daemon_status["failed_runs"])]),
+        ("uploaded_dates_total", "counter", "The number of dates uploaded to S3",
+         [("", daemon_status["uploaded_dates"])]),
+        ("last_run_timestamp_seconds", "gauge", "The start time of the last data collection run",
+         [("", daemon_status["last_run_timestamp"])]),
+        ("last_success_timestamp_seconds", "gauge", "The start time of the last successful data collection run",
+         [("", daemon_status["last_success_timestamp"])]),
+        ("last_run_duration_seconds", "gauge", "The duration of the last data collection run",
+         [("", daemon_status["last_run_duration"])]),
+        ("next_run_timestamp_seconds", "gauge", "The scheduled start time of the next data collection run",
+         [("", daemon_status["next_run_timestamp"])])
+    ]
+
+    lines = []
+    for name, metric_type, description, samples in metrics:
+        lines.append(f"# HELP kubecost_s3_exporter_{name} {description}")
+        lines.append(f"# TYPE kubecost_s3_exporter_{name} {metric_type}")
+        for metric_labels, value in samples:
+            lines.append(f"kubecost_s3_exporter_{name}{metric_labels} {value or 0}")
+
+    return "\n".join(lines) + "\n"
+
+
+def daemon_main(args):
+    """Runs the data collection as a long-running daemon (the "daemon" subcommand).
+    The runs are scheduled internally, every interval with a random jitter, until the daemon is stopped.
+    The exporter state (AWS clients, Kubecost HTTP session, root CA certificate and allocations history) is kept warm.
+    A failed run doesn't stop the daemon, and the next run is done on schedule.
+
+    :param args: The command-line arguments of the subcommand
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(prog="kubecost-s3-exporter daemon",
+                                     description="Runs the data collection as a long-running daemon")
+    parser.parse_args(args)
+
+    logger.info(f"Starting daemon mode, running every {DAEMON_INTERVAL_MINUTES} minutes (with up to "
+                f"{DAEMON_JITTER_MINUTES} minutes jitter), with health and metrics endpoints on port {DAEMON_PORT}")
+
+    daemon_status = {"start_timestamp": time.time(), "successful_runs": 0, "failed_runs": 0, "uploaded_dates": 0,
+                     "last_run_timestamp": None, "last_success_timestamp": None, "last_run_duration": None,
+                     "next_run_timestamp": None}
+    server = http.server.ThreadingHTTPServer(("", DAEMON_PORT), DaemonRequestHandler)
+    server.daemon_status = daemon_status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # Stopping gracefully on SIGTERM (sent by Kubernetes when the pod is terminated) and SIGINT
+    # A running run is completed before the daemon stops
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+
+    exporter_state = prepare_exporter_state()
+
+    # The jitter is also used before the first run, so that multiple clusters don't query at the same time
+    daemon_status["next_run_timestamp"] = time.time() + random.uniform(0, DAEMON_JITTER_MINUTES * 60)
+    while not stop_event.wait(max(daemon_status["next_run_timestamp"] - time.time(), 0)):
+        run_start = time.time()
+        daemon_status["last_run_timestamp"] = run_start
+        run_succeeded = False
+        try:
+            refresh_exporter_state_credentials(exporter_state)
+            daemon_status["uploaded_dates"] += len(main(exporter_state))
+            run_succeeded = True
+        except SystemExit as error:
+
+            # The run logic exits on errors. An exit with code 0 or without a code isn't a failure
+            run_succeeded = error.code in [0, None]
+        except Exception as error:
+            logger.exception(f"Data collection run failed: {error}")
+
+        daemon_status["last_run_duration"] = time.time() - run_start
+        if run_succeeded:
+            daemon_status["successful_runs"] += 1
+            daemon_status["last_success_timestamp"] = run_start
+        else:
+            daemon_status["failed_runs"] += 1
+            logger.error("Data collection run failed, the next run will be done on schedule")
+
+        daemon_status["next_run_timestamp"] = run_start + DAEMON_INTERVAL_MINUTES * 60 + random.uniform(
+            0, DAEMON_JITTER_MINUTES * 60)
+        logger.info(f"Next data collection run is at "
+                    f"{datetime.datetime.fromtimestamp(daemon_status['next_run_timestamp'], datetime.timezone.utc)}")
+
+    logger.info("Stopping daemon mode...")
+    server.shutdown()
+    cleanup_exporter_state(exporter_state)
 
 
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 1 and sys.argv[1] == "verify":
+        verify_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "daemon":
+        daemon_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "iceberg-maintenance":
+        iceberg_maintenance_main(sys.argv[2:])
+    else:
+        main()
@@ -226,7 +226,9 @@ variable "aggregation" {
 
 variable "kubecost_allocation_api_paginate" {
   description = <<-EOF
-    (Optional) Dictates whether to paginate using 1-hour time ranges (relevant for 1h step).
+    (Optional) Deprecated, and has no effect. It only applied to 1h step, and the data is collected in 1d step.
+               To collect with hourly API calls, set the COLLECTION_STRATEGY environment variable in the Helm chart
+               to "paginated" (it always wins over this variable).
                Possible values: "Yes", "No", "Y", "N", "True" or "False"
                Default value: False
   EOF
@@ -0,0 +1,77 @@
+"""Shared fixtures of the Kubecost S3 Exporter tests.
+The exporter validates its inputs when it's imported, so the mandatory inputs are set before importing it.
+The inputs are module-level constants, so each test sets the inputs it needs using "monkeypatch".
+"""
+import os
+import sys
+import tempfile
+
+os.environ.update({
+    "S3_BUCKET_NAME": "kubecost-data-bucket",
+    "CLUSTER_ID": "arn:aws:eks:us-east-1:111122223333:cluster/cluster-one",
+    "IRSA_PARENT_IAM_ROLE_ARN": "",
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "AWS_SECURITY_TOKEN": "testing",
+    "AWS_SESSION_TOKEN": "testing"
+})
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import boto3
+import moto
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import main
+from kubecost_stub import KubecostStub
+
+
+@pytest.fixture(autouse=True)
+def exporter_inputs(monkeypatch, tmp_path):
+    """Sets the inputs that make the tests deterministic, regardless of the container the tests run in."""
+
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 4)
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "single")
+    monkeypatch.setattr(main, "KUBECOST_RANGE_FETCH_MAX_DAYS", 1)
+    monkeypatch.setattr(main, "get_cgroup_memory_limit_and_usage", lambda: (None, None))
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    main.run_telemetry.clear()
+    yield
+    main.run_telemetry.clear()
+    main.aws_clients.clear()
+
+
+@pytest.fixture
+def s3():
+    """A local stand-in for S3 (and the other AWS services), with the exporter's bucket."""
+
+    with moto.mock_aws():
+        main.aws_clients.clear()
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=main.S3_BUCKET_NAME)
+        yield client
+    main.aws_clients.clear()
+
+
+@pytest.fixture
+def kubecost(monkeypatch):
+    """A local stand-in for the Kubecost Allocation API, used as the exporter's Kubecost API endpoint."""
+
+    stub = KubecostStub()
+    monkeypatch.setattr(main, "KUBECOST_API_ENDPOINT", stub.url)
+    yield stub
+    stub.close()
+
+
+@pytest.fixture
+def read_uploaded_parquet(s3):
+    """Reads the Parquet objects under a prefix of the exporter's bucket (by default, the data prefixes)."""
+
+    def read_uploaded_parquet(prefix="account_id="):
+        response = s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix=prefix)
+        return {x["Key"]: pq.read_table(pa.BufferReader(s3.get_object(
+            Bucket=main.S3_BUCKET_NAME, Key=x["Key"])["Body"].read())) for x in response.get("Contents", [])}
+
+    return read_uploaded_parquet
@@ -0,0 +1,139 @@
+"""A local stand-in for the Kubecost Allocation API, used by the tests.
+It serves deterministic allocations for any window, with the "step", "accumulate", "aggregate" and "filter" parameters.
+"""
+import datetime
+import json
+import random
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+KUBECOST_TIME_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def stub_allocation(name, namespace, controller, pod, container, start, end, minutes, rng):
+    """Creates a single allocation, in the format of the Kubecost Allocation API response.
+    About a third of the allocations have a tiny cost, so that there's a long tail of allocations.
+    """
+
+    cost = rng.random() * 2 if rng.random() > 0.3 else rng.random() * 0.001
+    return {
+        "name": name,
+        "properties": {
+            "cluster": "cluster-one", "node": f"ip-10-0-0-{rng.randint(1, 5)}", "container": container,
+            "controller": controller, "controllerKind": "deployment" if controller else "", "namespace": namespace,
+            "pod": pod, "providerID": "i-0123456789",
+            "labels": {"app": controller, "node_kubernetes_io_instance_type": "m5.large",
+                       "topology_kubernetes_io_region": "us-east-1", "eks_amazonaws_com_capacityType": "ON_DEMAND"},
+            "annotations": {"team": f"team{rng.randint(0, 3)}"},
+        },
+        "window": {"start": start, "end": end}, "start": start, "end": end, "minutes": minutes,
+        "cpuCores": 0.5, "cpuCoreRequestAverage": 0.5, "cpuCoreUsageAverage": rng.random(),
+        "cpuCoreHours": 0.5 * minutes / 60, "cpuCost": cost * 0.6, "cpuCostAdjustment": 0,
+        "cpuEfficiency": rng.random(), "gpuCount": 0, "gpuHours": 0, "gpuCost": 0, "gpuCostAdjustment": 0,
+        "networkTransferBytes": 100, "networkReceiveBytes": 100, "networkCost": 0, "networkCrossZoneCost": 0,
+        "networkCrossRegionCost": 0, "networkInternetCost": 0, "networkCostAdjustment": 0, "loadBalancerCost": 0,
+        "loadBalancerCostAdjustment": 0, "pvBytes": 0, "pvByteHours": 0, "pvCost": 0, "pvCostAdjustment": 0,
+        "ramBytes": 1e9, "ramByteRequestAverage": 1e9, "ramByteUsageAverage": rng.random() * 1e9,
+        "ramByteHours": 1e9 * minutes / 60, "ramCost": cost * 0.4, "ramCostAdjustment": 0,
+        "ramEfficiency": rng.random(), "sharedCost": 0, "externalCost": 0, "totalCost": cost,
+        "totalEfficiency": rng.random(), "rawAllocationOnly": {"cpuCoreUsageMax": 1, "ramByteUsageMax": 1},
+    }
+
+
+def stub_filter_matches(allocation_filter, namespace, controller):
+    """Evaluates the subset of the Kubecost filter language that the exporter uses ("+" joined "namespace:",
+    "namespace!:" and "controllerName!:" clauses, optionally in parentheses).
+    """
+
+    for clause in allocation_filter.replace("(", "").replace(")", "").split("+"):
+        field, _, values = clause.strip().partition(":")
+        values = [x.strip().strip('"') for x in values.split(",")]
+        value = controller if field.startswith("controllerName") else namespace
+        if (value in values) == field.endswith("!"):
+            return False
+    return True
+
+
+class KubecostStub:
+    """Serves the Kubecost Allocation API on a local port.
+
+    :param allocations: The number of container allocations in each time set
+    :param namespaces: The number of Namespaces the allocations are spread across
+    :param idle: Dictates whether each time set includes "<cluster>/<node>/__idle__" allocations (one per node)
+    """
+
+    def __init__(self, allocations=200, namespaces=7, idle=False, ssl_context=None):
+        self.allocations = allocations
+        self.namespaces = namespaces
+        self.idle = idle
+        self.requests = []
+
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                params = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+                stub.requests.append(params)
+                body = json.dumps(stub.response(params)).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        if ssl_context is not None:
+            self.server.socket = ssl_context.wrap_socket(self.server.socket, server_side=True)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        scheme = "https" if ssl_context is not None else "http"
+        self.url = f"{scheme}://localhost:{self.server.server_port}"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def response(self, params):
+        start, end = [datetime.datetime.strptime(x, KUBECOST_TIME_FORMAT) for x in params["window"].split(",")]
+        step = datetime.timedelta(days=1) if params.get("step", "1d") == "1d" else datetime.timedelta(hours=1)
+        if params.get("accumulate", "false").lower() == "true":
+            step = end - start
+        aggregate = params.get("aggregate", "container")
+
+        data = []
+        time_set_start = start
+        while time_set_start < end:
+            time_set_end = min(time_set_start + step, end)
+            window = [x.strftime(KUBECOST_TIME_FORMAT) for x in (time_set_start, time_set_end)]
+            minutes = (time_set_end - time_set_start).total_seconds() / 60
+            data.append(self.time_set(aggregate, params.get("filter", ""), window, minutes))
+            time_set_start = time_set_end
+
+        return {"code": 200, "data": data}
+
+    def time_set(self, aggregate, allocation_filter, window, minutes):
+
+        # The same seed is used for each time set, so that each allocation has the same cost in every time set
+        rng = random.Random(0)
+        if aggregate == "cluster":
+            return {"cluster-one": stub_allocation("cluster-one", "", "", "", "", *window, minutes, rng)}
+
+        time_set = {}
+        for i in range(self.allocations):
+            namespace, controller = f"ns{i % self.namespaces}", f"ctrl{i % 13}"
+            allocation = stub_allocation(f"cluster-one/node/{namespace}/pod{i}/c{i}", namespace, controller,
+                                         f"pod{i}", f"c{i}", *window, minutes, rng)
+            if allocation_filter and not stub_filter_matches(allocation_filter, namespace, controller):
+                continue
+            name = namespace if aggregate == "namespace" else allocation["name"]
+            time_set[name] = dict(allocation, name=name)
+        if self.idle and not allocation_filter.startswith("namespace:"):
+            # Split by node, the idle allocations are named the way Kubecost names them with "idleByNode"
+            for node in range(2):
+                name = f"cluster-one/ip-10-0-0-{node}/__idle__"
+                time_set[name] = stub_allocation(name, "", "", "", "", *window, minutes, rng)
+
+        return time_set
@@ -0,0 +1,71 @@
+import datetime
+import json
+
+import main
+from kubecost_stub import KubecostStub
+
+WINDOW = "2024-01-01T00:00:00Z,2024-01-02T00:00:00Z"
+
+
+def dataframe_columns():
+    labels = main.create_kubecost_labels_to_k8s_labels_mapping("app")
+    annotations = main.create_kubecost_annotations_to_k8s_annotations_mapping("team")
+    return main.define_dataframe_columns(labels, annotations), labels, annotations
+
+
+def transform(body, projection):
+    columns, labels, annotations = dataframe_columns()
+    allocation_data = main.decode_kubecost_allocation_api_response(body, projection)["data"]
+    allocation_data = main.kubecost_allocation_data_timestamp_update(
+        main.kubecost_allocation_data_add_cluster_id_and_name(allocation_data, main.CLUSTER_ID))
+    return main.kubecost_allocation_data_to_dataframe(allocation_data, columns, labels, annotations)
+
+
+def test_build_kubecost_allocation_filter():
+    assert main.build_kubecost_allocation_filter(None, None, None) == ""
+    assert main.build_kubecost_allocation_filter("kube-system, monitoring", None, None) == \
+        'namespace!:"kube-system","monitoring"'
+    assert main.build_kubecost_allocation_filter("kube-system", "ctrl1", 'cluster:"one"') == \
+        'namespace!:"kube-system"+controllerName!:"ctrl1"+(cluster:"one")'
+    assert main.build_kubecost_allocation_filter(None, None, 'cluster:"one"') == 'cluster:"one"'
+
+
+def stub_response_body(allocations=200):
+    stub = KubecostStub(allocations=allocations)
+    try:
+        return json.dumps(stub.response({"window": WINDOW})).encode()
+    finally:
+        stub.close()
+
+
+def test_projection_drops_unused_fields():
+    body = stub_response_body(allocations=3)
+    projection = main.define_kubecost_allocation_projection(dataframe_columns()[0])
+
+    allocation = next(iter(main.decode_kubecost_allocation_api_response(body, projection)["data"][0].values()))
+
+    assert "rawAllocationOnly" not in allocation
+    assert set(allocation["properties"]["labels"]) == {"app", "node_kubernetes_io_instance_type",
+                                                       "topology_kubernetes_io_region",
+                                                       "eks_amazonaws_com_capacityType"}
+    assert allocation["properties"]["annotations"] == {"team": allocation["properties"]["annotations"]["team"]}
+    assert allocation["window"] == {"start": "2024-01-01T00:00:00Z", "end": "2024-01-02T00:00:00Z"}
+
+
+def test_projection_doesnt_change_the_transform():
+    body = stub_response_body()
+    projection = main.define_kubecost_allocation_projection(dataframe_columns()[0])
+
+    assert transform(body, projection).equals(transform(body, None))
+
+
+def test_excluded_namespaces_are_filtered_server_side(monkeypatch, s3, kubecost, read_uploaded_parquet):
+    monkeypatch.setattr(main, "EXCLUDED_NAMESPACES", "ns1, ns2")
+
+    main.main()
+
+    collection_requests = [x for x in kubecost.requests if x.get("aggregate") != "cluster"]
+    assert [x["filter"] for x in collection_requests] == ['namespace!:"ns1","ns2"']
+    [table] = read_uploaded_parquet().values()
+    assert set(table.column("properties.namespace").to_pylist()) == {"ns0", "ns3", "ns4", "ns5", "ns6"}
+    assert table.column("window.start")[0].as_py().date() < datetime.date.today()
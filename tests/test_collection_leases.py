@@ -0,0 +1,166 @@
+import json
+import threading
+import time
+
+import botocore.exceptions
+import pytest
+
+import main
+
+DATE = "2024-01-01"
+OTHER_OWNER = "other-pod/1"
+
+
+@pytest.fixture
+def lease_key():
+    return main.s3_lease_key(main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID, DATE)
+
+
+def put_lease(s3, lease_key, owner, expires):
+    """Writes a lease object unconditionally, as another runner that holds (or took over) the lease."""
+
+    return s3.put_object(Bucket=main.S3_BUCKET_NAME, Key=lease_key,
+                         Body=json.dumps({"owner": owner, "expires": expires}).encode())["ETag"]
+
+
+def lease_owner(s3, lease_key):
+    return json.loads(s3.get_object(Bucket=main.S3_BUCKET_NAME, Key=lease_key)["Body"].read())["owner"]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.05)
+    return condition()
+
+
+def test_held_lease_isnt_acquired(s3, lease_key):
+    assert main.acquire_s3_lease(main.S3_BUCKET_NAME, lease_key, "pod/1", 60, None)
+    assert main.acquire_s3_lease(main.S3_BUCKET_NAME, lease_key, OTHER_OWNER, 60, None) is None
+    assert lease_owner(s3, lease_key) == "pod/1"
+
+
+def test_expired_lease_is_taken_over_by_one_runner_only(monkeypatch, s3, lease_key):
+    expired_lease_etag = put_lease(s3, lease_key, "crashed-pod/1", time.time() - 1)
+    client = main.get_aws_client("s3", None)
+    get_object = client.get_object
+    lease_etags = {}
+
+    # Both runners read the expired lease, and the other runner takes it over before this runner does
+    def get_object_then_race(**kwargs):
+        response = get_object(**kwargs)
+        monkeypatch.setattr(client, "get_object", get_object)
+        lease_etags[OTHER_OWNER] = main.acquire_s3_lease(main.S3_BUCKET_NAME, lease_key, OTHER_OWNER, 60, None)
+        return response
+
+    monkeypatch.setattr(client, "get_object", get_object_then_race)
+
+    assert main.acquire_s3_lease(main.S3_BUCKET_NAME, lease_key, "pod/1", 60, None) is None
+    assert lease_etags[OTHER_OWNER]
+    assert lease_owner(s3, lease_key) == OTHER_OWNER
+
+    # The crashed runner can neither renew nor release the lease that was taken over
+    assert main.renew_s3_lease(main.S3_BUCKET_NAME, lease_key, expired_lease_etag, "crashed-pod/1", 60, None) is None
+    main.release_s3_lease(main.S3_BUCKET_NAME, lease_key, expired_lease_etag, None)
+    assert lease_owner(s3, lease_key) == OTHER_OWNER
+
+
+def test_heartbeat_renews_the_leases_until_they_are_taken_over(s3, lease_key):
+    leases = main.acquire_kubecost_dates_leases(main.S3_BUCKET_NAME, main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID,
+                                                [DATE], "pod/1", 60, 0, None)
+    acquired_lease_etag = leases[DATE]
+    leases_lock = threading.Lock()
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=main.kubecost_dates_leases_heartbeat, args=(
+        stop_event, 0.05, main.S3_BUCKET_NAME, main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID, leases, leases_lock,
+        "pod/1", 60, None))
+    heartbeat.start()
+    try:
+        assert wait_for(lambda: leases[DATE] != acquired_lease_etag)
+
+        put_lease(s3, lease_key, OTHER_OWNER, time.time() + 3600)
+        assert wait_for(lambda: DATE not in leases)
+    finally:
+        stop_event.set()
+        heartbeat.join()
+
+    assert lease_owner(s3, lease_key) == OTHER_OWNER
+
+
+def test_heartbeat_survives_a_failed_renewal(monkeypatch, s3, lease_key, caplog):
+    leases = main.acquire_kubecost_dates_leases(main.S3_BUCKET_NAME, main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID,
+                                                [DATE], "pod/1", 60, 0, None)
+    acquired_lease_etag = leases[DATE]
+    get_aws_client = main.get_aws_client
+    failed_renewals = []
+
+    # The first renewals are throttled, as with a transient S3 error
+    class ThrottledS3Client:
+        def put_object(self, **kwargs):
+            if len(failed_renewals) < 2:
+                failed_renewals.append(kwargs["Key"])
+                raise botocore.exceptions.ClientError(
+                    {"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."}}, "PutObject")
+            return get_aws_client("s3", None).put_object(**kwargs)
+
+    monkeypatch.setattr(main, "get_aws_client", lambda *args: ThrottledS3Client())
+    leases_lock = threading.Lock()
+    stop_event = threading.Event()
+    heartbeat = threading.Thread(target=main.kubecost_dates_leases_heartbeat, args=(
+        stop_event, 0.05, main.S3_BUCKET_NAME, main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID, leases, leases_lock,
+        "pod/1", 60, None))
+    heartbeat.start()
+    try:
+        # The lease is still held after the failed renewals, and the next renewal succeeds
+        assert wait_for(lambda: leases[DATE] != acquired_lease_etag)
+        assert heartbeat.is_alive()
+    finally:
+        stop_event.set()
+        heartbeat.join()
+
+    assert failed_renewals == [lease_key, lease_key]
+    assert "Unable to renew the lease" in caplog.text
+    assert lease_owner(s3, lease_key) == "pod/1"
+
+
+def test_lease_is_renewed_during_a_long_collection(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "COLLECTION_LEASE", True)
+
+    # A lease of 3 seconds, renewed every second, and a collection of 4 seconds
+    monkeypatch.setattr(main, "COLLECTION_LEASE_DURATION_MINUTES", 0.05)
+    kubecost_allocation_data_to_parquet = main.kubecost_allocation_data_to_parquet
+    other_runner_leases = []
+
+    def slow_collection(*args):
+        output = kubecost_allocation_data_to_parquet(*args)
+        time.sleep(4)
+        date = args[4]
+        other_runner_leases.append(main.acquire_s3_lease(main.S3_BUCKET_NAME, main.s3_lease_key(
+            main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID, date), OTHER_OWNER, 60, None))
+        return output
+
+    monkeypatch.setattr(main, "kubecost_allocation_data_to_parquet", slow_collection)
+
+    assert len(main.main()) == 1
+    assert other_runner_leases == [None]
+    assert s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix=main.COLLECTION_LEASE_PREFIX)["KeyCount"] == 0
+
+
+def test_date_whose_lease_was_taken_over_during_collection_isnt_uploaded(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "COLLECTION_LEASE", True)
+    kubecost_allocation_data_to_parquet = main.kubecost_allocation_data_to_parquet
+
+    def collection_overrunning_the_lease(*args):
+        output = kubecost_allocation_data_to_parquet(*args)
+        put_lease(s3, main.s3_lease_key(main.COLLECTION_LEASE_PREFIX, main.CLUSTER_ID, args[4]), OTHER_OWNER,
+                  time.time() + 3600)
+        return output
+
+    monkeypatch.setattr(main, "kubecost_allocation_data_to_parquet", collection_overrunning_the_lease)
+
+    assert main.main() == []
+    assert s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix="account_id=")["KeyCount"] == 0
+
+    # The lease of the other runner is left as is
+    [lease] = s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix=main.COLLECTION_LEASE_PREFIX)["Contents"]
+    assert lease_owner(s3, lease["Key"]) == OTHER_OWNER
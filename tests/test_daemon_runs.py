@@ -0,0 +1,82 @@
+import os
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def exporter_state(s3, kubecost):
+    """An exporter state kept between runs, as in daemon mode."""
+
+    state = main.prepare_exporter_state()
+    yield state
+    main.cleanup_exporter_state(state)
+
+
+def list_keys(s3, prefix):
+    return [x["Key"] for x in s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix=prefix).get("Contents", [])]
+
+
+def current_umask():
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+def test_each_run_lists_the_dates_in_s3(monkeypatch, s3, exporter_state):
+    [date] = main.main(exporter_state)
+    [s3_key] = list_keys(s3, "account_id=")
+
+    # A date deleted from S3 is collected again by the next run
+    s3.delete_object(Bucket=main.S3_BUCKET_NAME, Key=s3_key)
+    assert main.main(exporter_state) == [date]
+
+    # A date uploaded by another runner isn't collected again
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 5)
+    kubecost_dates = main.get_kubecost_backfill_period_available_dates(main.execute_kubecost_allocation_api(
+        False, main.KUBECOST_API_ENDPOINT, *main.kubecost_backfill_period_window_calc(5), "daily", "cluster", 10, 60,
+        "No", True, True, True, True, False, "", None))
+    [other_date] = [x for x in kubecost_dates if x != date]
+    s3.copy_object(Bucket=main.S3_BUCKET_NAME, Key=s3_key.replace(date, other_date),
+                   CopySource={"Bucket": main.S3_BUCKET_NAME, "Key": s3_key})
+    assert main.main(exporter_state) == []
+
+
+def test_failed_run_cleans_up(monkeypatch, tmp_path, s3, exporter_state):
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 5)
+    monkeypatch.setattr(main, "COLLECTION_LEASE", True)
+    monkeypatch.setattr(main, "RUN_TELEMETRY", True)
+    umask = current_umask()
+    upload_kubecost_allocation_parquet_to_s3 = main.upload_kubecost_allocation_parquet_to_s3
+
+    def fail_upload(*args):
+        raise RuntimeError("S3 is unavailable")
+
+    monkeypatch.setattr(main, "upload_kubecost_allocation_parquet_to_s3", fail_upload)
+
+    with pytest.raises(RuntimeError):
+        main.main(exporter_state)
+
+    # Both leases are released (also of the date that wasn't reached), and the temp Parquet file is removed
+    assert list_keys(s3, main.COLLECTION_LEASE_PREFIX) == []
+    assert os.listdir(tmp_path) == []
+    assert current_umask() == umask
+    assert len(list_keys(s3, main.RUN_TELEMETRY_PREFIX)) == 1
+
+    # The next run collects both dates
+    monkeypatch.setattr(main, "upload_kubecost_allocation_parquet_to_s3", upload_kubecost_allocation_parquet_to_s3)
+    assert len(main.main(exporter_state)) == 2
+
+
+def test_run_exiting_on_an_empty_response_cleans_up(monkeypatch, tmp_path, s3, kubecost, exporter_state):
+    monkeypatch.setattr(kubecost, "allocations", 0)
+    monkeypatch.setattr(main, "COLLECTION_LEASE", True)
+    umask = current_umask()
+
+    with pytest.raises(SystemExit):
+        main.main(exporter_state)
+
+    assert list_keys(s3, main.COLLECTION_LEASE_PREFIX) == []
+    assert os.listdir(tmp_path) == []
+    assert current_umask() == umask
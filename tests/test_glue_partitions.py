@@ -0,0 +1,89 @@
+import logging
+
+import boto3
+import botocore.stub
+import pytest
+
+import main
+
+STORAGE_DESCRIPTOR = {
+    "Columns": [{"Name": "name", "Type": "string"}],
+    "Location": "s3://kubecost-data-bucket/",
+    "InputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat",
+    "OutputFormat": "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat",
+    "SerdeInfo": {"SerializationLibrary": "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"}
+}
+
+
+@pytest.fixture
+def glue(monkeypatch):
+    """A stubbed AWS Glue client, returned by the exporter's AWS client factory."""
+
+    client = boto3.client("glue", region_name="us-east-1")
+    monkeypatch.setattr(main, "get_aws_client", lambda *args, **kwargs: client)
+    with botocore.stub.Stubber(client) as stubber:
+        yield stubber
+        stubber.assert_no_pending_responses()
+
+
+def partition_input(account_id, region, year, month):
+    return {"Values": [account_id, region, year, month],
+            "StorageDescriptor": dict(STORAGE_DESCRIPTOR, Location=f"s3://kubecost-data-bucket/account_id={account_id}/"
+                                                                   f"region={region}/year={year}/month={month}/")}
+
+
+def test_partitions_are_created_in_batches_of_100(glue, caplog):
+    partitions = {("111122223333", "us-east-1", str(year), f"{month:02d}") for year in range(2000, 2013) for month in
+                  range(1, 13)}
+    partition_inputs = [partition_input(*x) for x in sorted(partitions)]
+    glue.add_response("get_table", {"Table": {"Name": "kubecost_table", "StorageDescriptor": STORAGE_DESCRIPTOR}},
+                      {"DatabaseName": "kubecost_db", "Name": "kubecost_table"})
+    glue.add_response("batch_create_partition", {"Errors": [
+        {"PartitionValues": partition_inputs[0]["Values"],
+         "ErrorDetail": {"ErrorCode": "AlreadyExistsException", "ErrorMessage": "Partition already exists."}}]},
+        {"DatabaseName": "kubecost_db", "TableName": "kubecost_table", "PartitionInputList": partition_inputs[:100]})
+    glue.add_response("batch_create_partition", {"Errors": [
+        {"PartitionValues": partition_inputs[-1]["Values"],
+         "ErrorDetail": {"ErrorCode": "InternalServiceException", "ErrorMessage": "Try again."}}]},
+        {"DatabaseName": "kubecost_db", "TableName": "kubecost_table", "PartitionInputList": partition_inputs[100:]})
+
+    with caplog.at_level(logging.WARNING):
+        main.glue_register_partitions("kubecost_db", "kubecost_table", "us-east-1", None, "kubecost-data-bucket",
+                                      partitions, None)
+
+    assert len(partitions) == 156
+    warnings = [x.getMessage() for x in caplog.records if x.levelno == logging.WARNING]
+    assert warnings == ["Unable to register partition 111122223333/us-east-1/2012/12 in AWS Glue: Try again."]
+
+
+def test_missing_table_doesnt_fail_the_run(glue, caplog):
+    glue.add_client_error("get_table", "EntityNotFoundException", "Table kubecost_table not found.")
+
+    with caplog.at_level(logging.WARNING):
+        main.glue_register_partitions("kubecost_db", "kubecost_table", "us-east-1", None, "kubecost-data-bucket",
+                                      {("111122223333", "us-east-1", "2024", "01")}, None)
+
+    assert "they'll be added by the Glue crawler" in caplog.text
+
+
+def test_uploaded_partitions_are_registered(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "GLUE_DATABASE_NAME", "kubecost_db")
+    monkeypatch.setattr(main, "GLUE_TABLE_NAME", "kubecost_table")
+    monkeypatch.setattr(main, "GLUE_REGION", "us-east-1")
+    glue = boto3.client("glue", region_name="us-east-1")
+    glue.create_database(DatabaseInput={"Name": "kubecost_db"})
+    glue.create_table(DatabaseName="kubecost_db", TableInput={
+        "Name": "kubecost_table", "StorageDescriptor": STORAGE_DESCRIPTOR,
+        "PartitionKeys": [{"Name": x, "Type": "string"} for x in ["account_id", "region", "year", "month"]]})
+
+    uploaded_dates = main.main()
+    year, month = uploaded_dates[0].split("-")[0:2]
+
+    # Registering the same partition again is idempotent
+    main.glue_register_partitions("kubecost_db", "kubecost_table", "us-east-1", None, "kubecost-data-bucket",
+                                  {("111122223333", "us-east-1", year, month)}, None)
+
+    partitions = glue.get_partitions(DatabaseName="kubecost_db", TableName="kubecost_table")["Partitions"]
+    assert [x["Values"] for x in partitions] == [["111122223333", "us-east-1", year, month]]
+    assert partitions[0]["StorageDescriptor"]["Location"] == \
+        f"s3://kubecost-data-bucket/account_id=111122223333/region=us-east-1/year={year}/month={month}/"
@@ -0,0 +1,113 @@
+import datetime
+import os
+import subprocess
+import sys
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import main
+
+TABLE = "kubecost.allocations"
+
+
+@pytest.fixture
+def iceberg_catalog_properties(tmp_path):
+    """The properties of a local SQL (SQLite) Iceberg catalog, with a warehouse on the local file system."""
+
+    warehouse = tmp_path / "warehouse"
+    warehouse.mkdir()
+    return {"type": "sql", "uri": f"sqlite:///{tmp_path / 'catalog.db'}", "warehouse": f"file://{warehouse}"}
+
+
+@pytest.fixture
+def iceberg_catalog(iceberg_catalog_properties):
+    return main.iceberg_load_catalog("test", iceberg_catalog_properties, None)
+
+
+def days_ago(days):
+    return (datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def write_parquet(tmp_path, date, costs):
+    window_start = datetime.datetime.strptime(date, "%Y-%m-%d")
+    path = str(tmp_path / f"{date}_cluster-one.snappy.parquet")
+    pq.write_table(pa.table({
+        "properties.clusterid": [main.CLUSTER_ID] * len(costs),
+        "window.start": pa.array([window_start] * len(costs), pa.timestamp("ns")),
+        "totalCost": costs}), path)
+    return path
+
+
+def table_costs(iceberg_catalog, date):
+    table = iceberg_catalog.load_table(TABLE)
+    return sorted(table.scan(row_filter=main.iceberg_partition_filter(main.CLUSTER_ID, date)).to_arrow()[
+        "totalCost"].to_pylist())
+
+
+def test_parquet_sink_doesnt_import_pyiceberg():
+    # A fresh interpreter, as the other tests of the session already imported PyIceberg
+    result = subprocess.run([sys.executable, "-c", "import sys, main; print('pyiceberg' in sys.modules)"],
+                            cwd=os.path.dirname(main.__file__), capture_output=True, text=True, check=True)
+
+    assert result.stdout.strip() == "False"
+
+
+@pytest.mark.parametrize("partition_day", [19723, datetime.date(2024, 1, 1)])
+def test_partition_day_is_converted_to_a_date(partition_day):
+    assert main.iceberg_partition_date(partition_day) == "2024-01-01"
+
+
+def test_overwrite_backfill_dates_and_maintenance(tmp_path, iceberg_catalog):
+    first_date, second_date, old_date = days_ago(3), days_ago(2), days_ago(30)
+    for date, costs in [(old_date, [9.0]), (first_date, [1.0, 2.0]), (second_date, [3.0])]:
+        main.iceberg_commit_kubecost_allocation_parquet(iceberg_catalog, TABLE, main.CLUSTER_ID, date,
+                                                        write_parquet(tmp_path, date, costs))
+
+    # Re-collecting a date replaces its data, and doesn't affect the other dates
+    main.iceberg_commit_kubecost_allocation_parquet(iceberg_catalog, TABLE, main.CLUSTER_ID, first_date,
+                                                    write_parquet(tmp_path, first_date, [4.0]))
+
+    assert main.get_iceberg_backfill_period_available_dates(iceberg_catalog, TABLE, main.CLUSTER_ID, 5) == [
+        first_date, second_date]
+    assert main.get_iceberg_backfill_period_available_dates(iceberg_catalog, TABLE, "other-cluster", 5) == []
+    assert table_costs(iceberg_catalog, first_date) == [4.0]
+    assert table_costs(iceberg_catalog, second_date) == [3.0]
+
+    # A partition with more than one data file is compacted, and the snapshots before the last one are expired
+    iceberg_catalog.load_table(TABLE).append(pa.table({
+        "properties_clusterid": [main.CLUSTER_ID],
+        "window_start": pa.array([datetime.datetime.strptime(second_date, "%Y-%m-%d")], pa.timestamp("us")),
+        "totalCost": [5.0]}))
+    main.iceberg_table_maintenance(iceberg_catalog, TABLE, main.CLUSTER_ID, 0)
+
+    table = iceberg_catalog.load_table(TABLE)
+    partitions = {main.iceberg_partition_date(x["partition"]["day"]): x["file_count"] for x in
+                  table.inspect.partitions().to_pylist()}
+    assert partitions == {old_date: 1, first_date: 1, second_date: 1}
+    assert table_costs(iceberg_catalog, second_date) == [3.0, 5.0]
+    assert len(table.metadata.snapshots) == 1
+    assert table.current_snapshot().summary["kubecost-s3-exporter.operation"] == "compaction"
+
+
+def test_missing_table_has_no_dates(iceberg_catalog):
+    assert main.get_iceberg_backfill_period_available_dates(iceberg_catalog, TABLE, main.CLUSTER_ID, 5) == []
+
+
+def test_iceberg_sink_collects_only_missing_dates(monkeypatch, s3, kubecost, iceberg_catalog_properties):
+    monkeypatch.setattr(main, "OUTPUT_SINK", "iceberg")
+    monkeypatch.setattr(main, "ICEBERG_TABLE", TABLE)
+    monkeypatch.setattr(main, "ICEBERG_CATALOG_PROPERTIES", iceberg_catalog_properties)
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 5)
+    exporter_state = main.prepare_exporter_state()
+    iceberg_catalog = exporter_state["iceberg_catalog"]
+
+    uploaded_dates = main.main(exporter_state)
+
+    assert len(uploaded_dates) == 2
+    assert main.get_iceberg_backfill_period_available_dates(iceberg_catalog, TABLE, main.CLUSTER_ID, 5) == sorted(
+        uploaded_dates)
+    assert iceberg_catalog.load_table(TABLE).scan().count() == 400
+    assert main.main(exporter_state) == []
+    assert s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix="account_id=")["KeyCount"] == 0
@@ -0,0 +1,123 @@
+import os
+import time
+
+import pytest
+
+import main
+
+WINDOW = "2024-01-01T00:00:00Z,2024-01-02T00:00:00Z"
+
+
+def cache_entry_path(cache_dir, cache_key):
+    return os.path.join(cache_dir, f"{cache_key}.json.zst")
+
+
+def test_cache_roundtrip(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    params = {"window": WINDOW, "step": "1d"}
+    cache_key = main.kubecost_cache_key("http://kubecost/model/allocation", params)
+    main.kubecost_cache_put(cache_dir, cache_key, "http://kubecost/model/allocation", params, b'{"code": 200}', 72,
+                            40)
+
+    assert main.kubecost_cache_get(cache_dir, cache_key, 72, False) == b'{"code": 200}'
+    assert main.kubecost_cache_get_header(cache_entry_path(cache_dir, cache_key))["params"] == params
+    assert main.kubecost_cache_get(cache_dir, "missing", 72, False) is None
+
+
+def test_frequently_read_entry_still_expires(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    main.kubecost_cache_put(cache_dir, "key", "http://kubecost", {"window": WINDOW}, b"body", 1, 40)
+    path = cache_entry_path(cache_dir, "key")
+    written = time.time() - 3000
+    os.utime(path, (written, written))
+
+    # Reading the entry updates only its access time, so it doesn't extend the TTL
+    for _ in range(3):
+        assert main.kubecost_cache_get(cache_dir, "key", 1, False) == b"body"
+    assert os.path.getmtime(path) == pytest.approx(written)
+    assert os.path.getatime(path) > written + 2000
+
+    os.utime(path, (time.time(), time.time() - 3700))
+    assert main.kubecost_cache_get(cache_dir, "key", 1, False) is None
+    assert not os.path.exists(path)
+
+
+def test_replay_mode_ignores_ttl(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    main.kubecost_cache_put(cache_dir, "key", "http://kubecost", {"window": WINDOW}, b"body", 1, 40)
+    os.utime(cache_entry_path(cache_dir, "key"), (0, 0))
+
+    assert main.kubecost_cache_get(cache_dir, "key", 1, True) == b"body"
+
+
+def test_size_eviction_removes_least_recently_read_entry(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    for cache_key in ["read-recently", "written-recently"]:
+        main.kubecost_cache_put(cache_dir, cache_key, "http://kubecost", {"window": WINDOW}, os.urandom(4096), 72, 40)
+    now = time.time()
+    os.utime(cache_entry_path(cache_dir, "read-recently"), (now, now - 7200))
+    os.utime(cache_entry_path(cache_dir, "written-recently"), (now - 3600, now - 3600))
+
+    main.kubecost_cache_evict(cache_dir, 72, 6 / 1024)
+
+    assert os.listdir(cache_dir) == ["read-recently.json.zst"]
+
+
+def test_cached_response_is_used_instead_of_kubecost(tmp_path, monkeypatch, kubecost):
+    monkeypatch.setattr(main, "KUBECOST_CACHE_DIR", str(tmp_path / "cache"))
+    main.reset_run_telemetry()
+    params = main.kubecost_allocation_api_params(WINDOW, "container", False, "1d", True, True, True, True, "")
+
+    responses = [main.kubecost_api_get(f"{kubecost.url}/model/allocation", params, 10, 60, True, None)
+                 for _ in range(3)]
+
+    assert len(kubecost.requests) == 1
+    assert responses[0] == responses[1] == responses[2]
+
+    # Cache hits are counted separately from the Kubecost API calls
+    assert main.run_telemetry["kubecost_api_calls"] == 1
+    assert main.run_telemetry["kubecost_cache_hits"] == 2
+    cached_body = main.kubecost_cache_get(str(tmp_path / "cache"), main.kubecost_cache_key(
+        f"{kubecost.url}/model/allocation", params), 72, False)
+    assert main.run_telemetry["kubecost_response_bytes"] == len(cached_body)
+    assert main.get_kubecost_cache_available_dates(str(tmp_path / "cache"), "container", 6) == {
+        "2024-01-01": {"start": "2024-01-01T00:00:00Z", "end": "2024-01-02T00:00:00Z"}}
+
+
+def test_replay_mode_without_cached_response_exits(tmp_path, monkeypatch, kubecost):
+    monkeypatch.setattr(main, "KUBECOST_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(main, "KUBECOST_CACHE_REPLAY", True)
+    params = main.kubecost_allocation_api_params(WINDOW, "container", False, "1d", True, True, True, True, "")
+
+    with pytest.raises(SystemExit):
+        main.kubecost_api_get(f"{kubecost.url}/model/allocation", params, 10, 60, True, None)
+    assert not kubecost.requests
+
+
+@pytest.mark.parametrize("collection_strategy, range_fetch_max_days", [
+    ("single", 7), ("windowed", 1), ("paginated", 1)])
+def test_dates_are_replayed_from_any_collection(tmp_path, monkeypatch, s3, kubecost, read_uploaded_parquet,
+                                                collection_strategy, range_fetch_max_days):
+    monkeypatch.setattr(main, "KUBECOST_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", collection_strategy)
+    monkeypatch.setattr(main, "KUBECOST_RANGE_FETCH_MAX_DAYS", range_fetch_max_days)
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 5)
+    main.main()
+    collected = read_uploaded_parquet()
+    s3.delete_objects(Bucket=main.S3_BUCKET_NAME, Delete={"Objects": [{"Key": x} for x in collected]})
+    kubecost.requests.clear()
+
+    # The dates are indexed by the cache entries covering them (a multi-day entry covers each of its dates)
+    available_dates = main.get_kubecost_cache_available_dates(str(tmp_path / "cache"), "container", 6)
+    assert len(available_dates) == len(collected) > 1
+    assert all(x.get("collection_strategy", "single") == collection_strategy for x in available_dates.values())
+
+    monkeypatch.setattr(main, "KUBECOST_CACHE_REPLAY", True)
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "single")
+    main.main()
+
+    assert not kubecost.requests
+    replayed = read_uploaded_parquet()
+    assert replayed.keys() == collected.keys()
+    for key, table in collected.items():
+        assert replayed[key].to_pandas().equals(table.to_pandas())
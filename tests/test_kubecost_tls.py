@@ -0,0 +1,94 @@
+import datetime
+import ssl
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+import main
+from kubecost_stub import KubecostStub
+
+SECRET_NAME = "kubecost-ca-certificate"
+
+
+def create_certificate(common_name, issuer_key=None, issuer_name=None, ca=False):
+    """Creates a key and a certificate, self-signed or signed by the given issuer, valid for "localhost"."""
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    builder = x509.CertificateBuilder().subject_name(name).issuer_name(issuer_name or name).public_key(
+        key.public_key()).serial_number(x509.random_serial_number()).not_valid_before(
+        now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1)).add_extension(
+        x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+    if not ca:
+        builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName("localhost")]), critical=False)
+    certificate = builder.sign(issuer_key or key, hashes.SHA256())
+    return key, certificate
+
+
+def to_pem(certificate):
+    return certificate.public_bytes(serialization.Encoding.PEM).decode()
+
+
+@pytest.fixture
+def root_ca():
+    return create_certificate("Kubecost Root CA", ca=True)
+
+
+@pytest.fixture
+def tls_kubecost(monkeypatch, tmp_path, root_ca):
+    """The Kubecost stub, served over HTTPS with a server certificate signed by the root CA."""
+
+    ca_key, ca_certificate = root_ca
+    key, certificate = create_certificate("localhost", ca_key, ca_certificate.subject)
+    (tmp_path / "server.pem").write_bytes(certificate.public_bytes(serialization.Encoding.PEM))
+    (tmp_path / "server.key").write_bytes(key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()))
+    ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    ssl_context.load_cert_chain(str(tmp_path / "server.pem"), str(tmp_path / "server.key"))
+
+    stub = KubecostStub(ssl_context=ssl_context)
+    monkeypatch.setattr(main, "KUBECOST_API_ENDPOINT", stub.url)
+    monkeypatch.setattr(main, "KUBECOST_CA_CERTIFICATE_SECRET_NAME", SECRET_NAME)
+    monkeypatch.setattr(main, "KUBECOST_CA_CERTIFICATE_SECRET_REGION", "us-east-1")
+    yield stub
+    stub.close()
+
+
+def put_ca_certificate_secret(ca_certificate_pem):
+    main.get_aws_client("secretsmanager", None, region_name="us-east-1").create_secret(
+        Name=SECRET_NAME, SecretString=ca_certificate_pem)
+
+
+def test_kubecost_certificate_is_verified_with_the_root_ca(monkeypatch, tmp_path, s3, tls_kubecost, root_ca):
+    put_ca_certificate_secret(to_pem(root_ca[1]))
+
+    # A CA bundle path in the environment doesn't replace the root CA in the Kubecost session
+    monkeypatch.setenv("REQUESTS_CA_BUNDLE", str(tmp_path / "missing-bundle.pem"))
+
+    assert len(main.main()) == 1
+    assert tls_kubecost.requests
+    assert main.KUBECOST_API_ENDPOINT not in main.kubecost_session.adapters
+
+
+def test_kubecost_certificate_of_another_root_ca_is_rejected(s3, tls_kubecost):
+    put_ca_certificate_secret(to_pem(create_certificate("Another Root CA", ca=True)[1]))
+
+    exporter_state = main.prepare_exporter_state()
+    try:
+        assert isinstance(main.kubecost_session.adapters[main.KUBECOST_API_ENDPOINT], main.KubecostTLSAdapter)
+        with pytest.raises(SystemExit) as exit_info:
+            main.main(exporter_state)
+    finally:
+        main.cleanup_exporter_state(exporter_state)
+
+    assert exit_info.value.code == 1
+    assert not tls_kubecost.requests
+
+
+def test_invalid_root_ca_certificate_exits():
+    with pytest.raises(SystemExit):
+        main.create_kubecost_tls_adapter("not a certificate")
@@ -0,0 +1,73 @@
+import json
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import main
+
+SUM_COLUMNS = [x for x in main.KUBECOST_ADDITIVE_COLUMNS if x != "minutes"]
+
+
+def collect_parquet_file(s3):
+    """Reads the uploaded Parquet file of the collected date, and removes it from S3."""
+
+    [key] = [x["Key"] for x in s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix="account_id=")["Contents"]]
+    parquet_file = pq.ParquetFile(pa.BufferReader(s3.get_object(Bucket=main.S3_BUCKET_NAME, Key=key)["Body"].read()))
+    s3.delete_object(Bucket=main.S3_BUCKET_NAME, Key=key)
+    return parquet_file
+
+
+@pytest.mark.parametrize("collection_strategy, chunk_size, fold_by", [
+    ("single", 100, "namespace"), ("chunked", 30, "namespace"), ("chunked", 30, "controller"),
+    ("windowed", 30, "namespace"), ("paginated", 80, "namespace")])
+def test_folded_totals_reconcile_with_the_unfolded_data(monkeypatch, s3, kubecost, collection_strategy, chunk_size,
+                                                        fold_by):
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", collection_strategy)
+    monkeypatch.setattr(main, "TRANSFORM_CHUNK_SIZE", chunk_size)
+    main.main()
+    unfolded_df = collect_parquet_file(s3).read().to_pandas()
+    monkeypatch.setattr(main, "LONG_TAIL_FOLD_COST_THRESHOLD", 0.01)
+    monkeypatch.setattr(main, "LONG_TAIL_FOLD_BY", fold_by)
+
+    main.main()
+
+    parquet_file = collect_parquet_file(s3)
+    folded_df = parquet_file.read().to_pandas()
+    synthetic_rows = folded_df["name"].str.startswith("__folded__")
+    assert parquet_file.schema_arrow.field("foldedAllocations").type == pa.int64()
+    assert 0 < synthetic_rows.sum() and len(folded_df) < len(unfolded_df)
+
+    # Each allocation is either kept as is, or counted in exactly one synthetic row
+    folded_allocations = int(folded_df["foldedAllocations"].sum())
+    assert len(folded_df) - synthetic_rows.sum() + folded_allocations == len(unfolded_df)
+    assert (folded_df.loc[~synthetic_rows, "foldedAllocations"] == 0).all()
+    assert json.loads(parquet_file.metadata.metadata[b"kubecost_s3_exporter"])[
+        "folded_allocations"] == folded_allocations
+
+    # There's a single synthetic row per group and window, even if the allocations were folded in chunks
+    key_columns = main.LONG_TAIL_FOLD_KEY_COLUMNS[fold_by]
+    assert not folded_df.loc[synthetic_rows].duplicated(key_columns).any()
+
+    # The additive fields (except the minutes) reconcile, in total and per Namespace and window
+    assert folded_df[SUM_COLUMNS].sum().to_numpy() == pytest.approx(unfolded_df[SUM_COLUMNS].sum().to_numpy())
+    group_columns = ["properties.namespace", "window.start"]
+    assert folded_df.groupby(group_columns)[SUM_COLUMNS].sum().to_numpy() == pytest.approx(
+        unfolded_df.groupby(group_columns)[SUM_COLUMNS].sum().to_numpy())
+
+    # The minutes of a synthetic row are the longest minutes of its folded allocations, so they don't reconcile
+    assert folded_df["minutes"].sum() < unfolded_df["minutes"].sum()
+    assert (folded_df.loc[synthetic_rows, "minutes"] == unfolded_df["minutes"].max()).all()
+
+
+def test_split_idle_allocations_are_never_folded(monkeypatch, s3, kubecost):
+    kubecost.idle = True
+    monkeypatch.setattr(main, "LONG_TAIL_FOLD_COST_THRESHOLD", 1e9)
+
+    main.main()
+
+    # Every allocation is below the threshold, but the idle allocations (named by node) are kept as is
+    folded_df = collect_parquet_file(s3).read().to_pandas()
+    idle_rows = folded_df.loc[folded_df["foldedAllocations"] == 0]
+    assert sorted(idle_rows["name"]) == ["cluster-one/ip-10-0-0-0/__idle__", "cluster-one/ip-10-0-0-1/__idle__"]
+    assert (folded_df.loc[folded_df["foldedAllocations"] > 0, "properties.namespace"] != "").all()
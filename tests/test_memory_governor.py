@@ -0,0 +1,92 @@
+import datetime
+import json
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import main
+
+MIB = 2 ** 20
+HISTORY = {"allocations_per_day": 1000, "allocations_per_hour": 100, "source": "a test"}
+SHORT_LIVED_HISTORY = {"allocations_per_day": 10000, "allocations_per_hour": 100, "source": "a test"}
+STRATEGIES = ["single", "chunked", "windowed"]
+
+
+@pytest.mark.parametrize("memory_limit, allocations_history, collection_strategy", [
+    (100 * MIB, HISTORY, "single"), (20 * MIB, HISTORY, "chunked"), (60 * MIB, SHORT_LIVED_HISTORY, "windowed")])
+def test_first_fitting_strategy_is_chosen(memory_limit, allocations_history, collection_strategy):
+    assert main.choose_collection_strategy(memory_limit, 0, allocations_history, 0, 100,
+                                           STRATEGIES) == collection_strategy
+
+
+def test_smallest_strategy_is_chosen_when_none_fits(caplog):
+    with caplog.at_level(logging.WARNING):
+        assert main.choose_collection_strategy(1 * MIB, 0, HISTORY, 0, 100, STRATEGIES) == "chunked"
+
+    assert "None of the collection strategies fit the memory budget" in caplog.text
+
+
+def test_headroom_and_usage_reduce_the_budget():
+    assert main.choose_collection_strategy(100 * MIB, 0, HISTORY, 80, 100, STRATEGIES) == "chunked"
+    assert main.choose_collection_strategy(100 * MIB, 80 * MIB, HISTORY, 0, 100, STRATEGIES) == "chunked"
+
+
+def test_estimates_are_configurable(monkeypatch):
+    monkeypatch.setattr(main, "KUBECOST_RESPONSE_BYTES_PER_ALLOCATION", 1024)
+    monkeypatch.setattr(main, "TRANSFORM_BYTES_PER_ALLOCATION", 1024)
+
+    assert main.choose_collection_strategy(5 * MIB, 0, HISTORY, 0, 100, STRATEGIES) == "single"
+
+
+def test_unknown_allocations_count_uses_the_most_memory_safe_strategy(caplog):
+    with caplog.at_level(logging.WARNING):
+        assert main.choose_collection_strategy(100 * MIB, 0, None, 0, 100, STRATEGIES) == "windowed"
+        assert main.choose_collection_strategy(100 * MIB, 0, None, 0, 100, ["single", "chunked"]) == "chunked"
+
+    assert "The allocations count is unknown" in caplog.text
+
+
+@pytest.mark.parametrize("memory_limit, collection_strategy, range_fetch_days", [
+    (None, "single", 7), (100 * MIB, "single", 10), (100 * MIB, "chunked", 12), (5 * MIB, "chunked", 1)])
+def test_range_fetch_max_days(memory_limit, collection_strategy, range_fetch_days):
+    assert main.calc_kubecost_range_fetch_max_days(memory_limit, 0, HISTORY, 0, 100, collection_strategy,
+                                                   7 if memory_limit is None else 30) == range_fetch_days
+
+
+def test_failed_probe_falls_back_to_the_most_memory_safe_strategy(monkeypatch, s3, kubecost, caplog):
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "auto")
+    monkeypatch.setattr(main, "get_cgroup_memory_limit_and_usage", lambda: (1024 * MIB, 0))
+    kubecost_api_get = main.kubecost_api_get
+
+    # The probe is the only accumulated API call of a single hour (the windowed strategy's calls are longer)
+    def fail_probe(kubecost_api_url, params, *args):
+        start, end = [datetime.datetime.strptime(x, "%Y-%m-%dT%H:%M:%SZ") for x in params["window"].split(",")]
+        if params["accumulate"] is True and end - start == datetime.timedelta(hours=1):
+            return 500, {"code": 500, "message": "Internal Server Error"}
+        return kubecost_api_get(kubecost_api_url, params, *args)
+
+    monkeypatch.setattr(main, "kubecost_api_get", fail_probe)
+
+    with caplog.at_level(logging.WARNING):
+        main.main()
+
+    assert "The allocations count probe returned no allocations (status code 500)" in caplog.text
+    [key] = [x["Key"] for x in s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME)["Contents"]]
+    metadata = pq.ParquetFile(pa.BufferReader(s3.get_object(Bucket=main.S3_BUCKET_NAME, Key=key)["Body"].read()))
+    assert json.loads(metadata.metadata.metadata[b"kubecost_s3_exporter"])["collection_strategy"] == "windowed"
+
+    # The fallback keeps the daily rows of the dataset
+    assert (metadata.read(columns=["window.start"]).to_pandas()["window.start"].dt.hour == 0).all()
+
+
+def test_history_is_read_from_the_previous_parquet_file(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "paginated")
+    main.main()
+    date = s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME)["Contents"][0]["Key"].split("/")[-1].split("_")[0]
+
+    assert main.get_kubecost_allocations_history_from_s3(main.S3_BUCKET_NAME, main.CLUSTER_ID, date, None) == {
+        "allocations_per_hour": 200, "source": f"the Parquet file of {date}"}
+    assert main.get_kubecost_allocations_history_from_s3(main.S3_BUCKET_NAME, main.CLUSTER_ID, "2000-01-01",
+                                                         None) is None
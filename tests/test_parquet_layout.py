@@ -0,0 +1,101 @@
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import main
+
+
+def row_group_statistics(parquet_file, column):
+    column_index = parquet_file.schema_arrow.get_field_index(column)
+    return [(x.min, x.max) for x in (parquet_file.metadata.row_group(i).column(column_index).statistics for i in
+                                     range(parquet_file.num_row_groups))]
+
+
+def uploaded_parquet_file(s3):
+    key = s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix="account_id=")["Contents"][0]["Key"]
+    return pq.ParquetFile(pa.BufferReader(s3.get_object(Bucket=main.S3_BUCKET_NAME, Key=key)["Body"].read()))
+
+
+def assert_sorted(table):
+    assert table.equals(table.sort_by([(x, "ascending") for x in main.PARQUET_SORT_COLUMNS]))
+
+
+@pytest.mark.parametrize("collection_strategy, chunk_size", [("chunked", 30), ("paginated", 100)])
+def test_chunked_file_is_sorted_as_a_whole(monkeypatch, s3, kubecost, collection_strategy, chunk_size):
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", collection_strategy)
+    monkeypatch.setattr(main, "TRANSFORM_CHUNK_SIZE", chunk_size)
+    monkeypatch.setattr(main, "PARQUET_ROW_GROUP_SIZE", 30)
+
+    main.main()
+
+    parquet_file = uploaded_parquet_file(s3)
+    table = parquet_file.read()
+    assert_sorted(table)
+    assert len(table) == (200 if collection_strategy == "chunked" else 24 * 200)
+    assert all(x.num_rows == 30 for x in (parquet_file.metadata.row_group(i) for i in
+                                          range(parquet_file.num_row_groups - 1)))
+
+    # Each Namespace is in consecutive row groups, so a Namespace predicate skips the other row groups
+    statistics = row_group_statistics(parquet_file, "properties.namespace")
+    assert all(x[1] <= y[0] for x, y in zip(statistics, statistics[1:]))
+    assert sum(1 for x in statistics if x[0] <= "ns3" <= x[1]) < len(statistics) / 3
+
+
+def test_chunked_file_has_the_same_rows_as_a_single_transform(monkeypatch, s3, kubecost, read_uploaded_parquet):
+    main.main()
+    [single_table] = read_uploaded_parquet().values()
+    s3.delete_objects(Bucket=main.S3_BUCKET_NAME, Delete={"Objects": [
+        {"Key": x} for x in read_uploaded_parquet()]})
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "chunked")
+    monkeypatch.setattr(main, "TRANSFORM_CHUNK_SIZE", 30)
+
+    main.main()
+
+    [chunked_table] = read_uploaded_parquet().values()
+    assert chunked_table.equals(single_table)
+
+
+def test_bloom_filter_is_sized_by_distinct_values(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "chunked")
+    monkeypatch.setattr(main, "TRANSFORM_CHUNK_SIZE", 30)
+    monkeypatch.setattr(main, "PARQUET_BLOOM_FILTER_COLUMNS", ["properties.pod", "properties.namespace"])
+    writers = []
+    create_parquet_writer = main.create_parquet_writer
+
+    def record_parquet_writer(path, schema, bloom_filter_ndv):
+        writers.append(bloom_filter_ndv)
+        return create_parquet_writer(path, schema, bloom_filter_ndv)
+
+    monkeypatch.setattr(main, "create_parquet_writer", record_parquet_writer)
+
+    main.main()
+
+    assert writers == [{"properties.pod": 200, "properties.namespace": 7}]
+    parquet_file = uploaded_parquet_file(s3)
+    pod_column = parquet_file.metadata.row_group(0).column(parquet_file.schema_arrow.get_field_index("properties.pod"))
+    assert 0 < pod_column.bloom_filter_length < 4096
+
+
+
+def test_runs_of_different_files_are_merged(tmp_path):
+    paths = []
+    for i, namespaces in enumerate([["ns0", "ns2", "ns4"], ["ns1", "ns3"]]):
+        table = pa.table({"properties.namespace": namespaces, "properties.controller": ["ctrl"] * len(namespaces),
+                          "properties.pod": [f"pod{i}"] * len(namespaces),
+                          "window.start": pa.array([0] * len(namespaces), pa.timestamp("ns"))})
+        if i == 0:
+            table = table.append_column("properties.labels.app", pa.array(["app"] * len(namespaces)))
+        paths.append(str(tmp_path / f"shard-{i}.parquet"))
+        pq.write_table(table, paths[-1], row_group_size=2)
+    shard_files = [pq.ParquetFile(x) for x in paths]
+
+    main.write_sorted_parquet(str(tmp_path / "merged.parquet"), [(x, list(range(x.num_row_groups))) for x in
+                                                                  shard_files],
+                              pa.unify_schemas([x.schema_arrow for x in shard_files]), {"key": "value"})
+
+    merged_file = pq.ParquetFile(str(tmp_path / "merged.parquet"))
+    merged_table = merged_file.read()
+    assert merged_table["properties.namespace"].to_pylist() == ["ns0", "ns1", "ns2", "ns3", "ns4"]
+    assert merged_table["properties.labels.app"].to_pylist() == ["app", None, "app", None, "app"]
+    assert merged_file.metadata.metadata[b"key"] == b"value"
+    assert merged_file.metadata.row_group(0).sorting_columns
@@ -0,0 +1,58 @@
+import datetime
+
+import pytest
+
+import main
+
+
+def missing_dates(*dates):
+    return {x: {"start": f"{x}T00:00:00Z", "end": (datetime.datetime.strptime(x, "%Y-%m-%d") + datetime.timedelta(
+        days=1)).strftime("%Y-%m-%dT00:00:00Z")} for x in dates}
+
+
+@pytest.mark.parametrize("first_date, max_days, range_fetch_dates", [
+    ("2024-01-01", 7, ["2024-01-01", "2024-01-02"]),
+    ("2024-01-01", 1, ["2024-01-01"]),
+    ("2024-01-04", 7, ["2024-01-04", "2024-01-05", "2024-01-06"]),
+    ("2024-01-04", 2, ["2024-01-04", "2024-01-05"])])
+def test_range_fetch_dates_are_consecutive(first_date, max_days, range_fetch_dates):
+    dates = missing_dates("2024-01-01", "2024-01-02", "2024-01-04", "2024-01-05", "2024-01-06")
+
+    assert main.calc_kubecost_range_fetch_dates(dates, first_date, max_days) == range_fetch_dates
+
+
+def allocation_data_requests(kubecost):
+    """The Kubecost Allocation API requests of the collection (without the backfill request, aggregated by cluster)."""
+
+    return [x["window"] for x in kubecost.requests if x.get("aggregate") != "cluster"]
+
+
+@pytest.mark.parametrize("max_days, api_calls", [(7, 1), (3, 2), (1, 4)])
+def test_consecutive_dates_are_fetched_in_a_single_api_call(monkeypatch, s3, kubecost, read_uploaded_parquet,
+                                                             max_days, api_calls):
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 7)
+    monkeypatch.setattr(main, "KUBECOST_RANGE_FETCH_MAX_DAYS", max_days)
+
+    uploaded_dates = main.main()
+
+    assert len(uploaded_dates) == 4
+    assert len(allocation_data_requests(kubecost)) == api_calls
+
+    # Each date is still uploaded as its own Parquet file, with the rows of that date only
+    for key, table in read_uploaded_parquet().items():
+        date = key.split("/")[-1].split("_")[0]
+        assert table.num_rows == 200
+        assert {x.strftime("%Y-%m-%d") for x in table["window.start"].to_pylist()} == {date}
+
+
+def test_dates_already_in_s3_split_the_range(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 7)
+    monkeypatch.setattr(main, "KUBECOST_RANGE_FETCH_MAX_DAYS", 7)
+    dates = sorted(main.main())
+    s3.delete_objects(Bucket=main.S3_BUCKET_NAME, Delete={"Objects": [
+        {"Key": x["Key"]} for x in s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME)["Contents"] if dates[1] not in
+        x["Key"]]})
+    kubecost.requests.clear()
+
+    assert sorted(main.main()) == [dates[0]] + dates[2:]
+    assert [x.split(",")[0][:10] for x in allocation_data_requests(kubecost)] == [dates[0], dates[2]]
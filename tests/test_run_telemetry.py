@@ -0,0 +1,60 @@
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import main
+
+
+def read_telemetry_records(s3):
+    response = s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix=main.RUN_TELEMETRY_PREFIX)
+    tables = [pq.read_table(pa.BufferReader(s3.get_object(Bucket=main.S3_BUCKET_NAME, Key=x["Key"])["Body"].read()))
+              for x in response.get("Contents", [])]
+    return [x for table in tables for x in table.to_pylist()], [x["Key"] for x in response.get("Contents", [])]
+
+
+def test_run_telemetry_record(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "RUN_TELEMETRY", True)
+    monkeypatch.setattr(main, "BACKFILL_PERIOD_DAYS", 5)
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", "chunked")
+    monkeypatch.setattr(main, "TRANSFORM_CHUNK_SIZE", 50)
+    monkeypatch.setattr(main, "get_cgroup_memory_limit_and_usage", lambda: (2 ** 30, None))
+
+    uploaded_dates = main.main()
+
+    [record], [s3_key] = read_telemetry_records(s3)
+    data_objects = s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix="account_id=")["Contents"]
+    assert s3_key.startswith(f"{main.RUN_TELEMETRY_PREFIX}/account_id=111122223333/region=us-east-1/year=")
+    assert s3_key.endswith("_cluster-one.snappy.parquet")
+    assert record["cluster_id"] == main.CLUSTER_ID
+    assert record["dates_collected"].split(",") == uploaded_dates
+    assert record["dates_collected_count"] == record["dates_uploaded_count"] == 2
+    assert record["collection_strategies"] == "chunked"
+    assert record["rows"] == 400
+    assert record["kubecost_api_calls"] == len(kubecost.requests) == 3
+    assert record["kubecost_response_bytes"] > 0
+    assert record["output_bytes"] == sum(x["Size"] for x in data_objects)
+    assert record["memory_limit_bytes"] == 2 ** 30
+    assert record["peak_rss_bytes"] > 0
+    assert record["duration_seconds"] >= record["backfill_seconds"] + record["transform_seconds"]
+
+
+def test_run_without_missing_dates_has_a_telemetry_record(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "RUN_TELEMETRY", True)
+    main.main()
+
+    assert main.main() == []
+
+    records, _ = read_telemetry_records(s3)
+    assert [x["dates_uploaded_count"] for x in records] == [1, 0]
+    assert records[1]["kubecost_api_calls"] == 1
+    assert records[1]["dates_collected"] == ""
+
+
+def test_failed_telemetry_upload_doesnt_fail_the_run(s3, caplog):
+    main.reset_run_telemetry()
+
+    with caplog.at_level(logging.WARNING):
+        main.upload_run_telemetry_to_s3("missing-bucket", main.RUN_TELEMETRY_PREFIX, main.CLUSTER_ID, [], None)
+
+    assert "Unable to upload the run telemetry" in caplog.text
@@ -0,0 +1,46 @@
+import pytest
+
+import main
+
+
+def list_keys(s3, prefix):
+    return [x["Key"] for x in s3.list_objects_v2(Bucket=main.S3_BUCKET_NAME, Prefix=prefix).get("Contents", [])]
+
+
+@pytest.mark.parametrize("shard_index, shard_filter", [
+    (0, 'namespace!:"ns1","ns2","ns3"+(controllerName!:"ctrl0")'),
+    (1, 'namespace:"ns1","ns2"+(controllerName!:"ctrl0")'),
+    (2, 'namespace:"ns3"+(controllerName!:"ctrl0")')])
+def test_shard_filters_dont_overlap(shard_index, shard_filter):
+    assert main.build_kubecost_shard_filter('controllerName!:"ctrl0"', None, shard_index, 3,
+                                            [["ns1", "ns2"], ["ns3"]]) == shard_filter
+
+
+def test_shard_without_namespaces_has_no_filter():
+    assert main.build_kubecost_shard_filter("", None, 1, 2, [[]]) is None
+
+
+@pytest.mark.parametrize("shard_count, shard_namespaces", [(2, [["ns1", "ns2"]]), (3, None), (8, None)])
+def test_shards_are_merged_by_the_last_worker(monkeypatch, s3, kubecost, read_uploaded_parquet, shard_count,
+                                              shard_namespaces):
+    main.main()
+    [single_table] = read_uploaded_parquet().values()
+    s3.delete_objects(Bucket=main.S3_BUCKET_NAME, Delete={"Objects": [{"Key": x} for x in read_uploaded_parquet()]})
+    monkeypatch.setattr(main, "SHARD_COUNT", shard_count)
+    monkeypatch.setattr(main, "SHARD_NAMESPACES", shard_namespaces)
+
+    # Each worker uploads its shard, and only the last worker to finish merges the shards and uploads the date
+    for shard_index in range(shard_count):
+        monkeypatch.setattr(main, "SHARD_INDEX", shard_index)
+        uploaded_dates = main.main()
+        assert len(uploaded_dates) == (1 if shard_index == shard_count - 1 else 0)
+        assert len(list_keys(s3, main.SHARD_PREFIX)) == (0 if shard_index == shard_count - 1 else shard_index + 1)
+
+    [merged_table] = read_uploaded_parquet().values()
+    assert merged_table.num_rows == single_table.num_rows
+    assert merged_table.select(single_table.column_names).equals(single_table)
+
+    # Each shard collected its own Namespaces (shards without Namespaces upload an empty marker without collecting)
+    shard_requests = [x for x in kubecost.requests if x.get("aggregate") not in ["cluster", "namespace"]][1:]
+    assert 1 < len(shard_requests) <= shard_count
+    assert len({x.get("filter", "") for x in shard_requests}) == len(shard_requests)
@@ -0,0 +1,117 @@
+import datetime
+import io
+import logging
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import main
+
+PREFIX = "account_id=111122223333/region=us-east-1/"
+
+
+def parquet_bytes(table):
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
+
+
+def allocation_table(date, rows=3):
+    window_start = datetime.datetime.strptime(date, "%Y-%m-%d")
+    return pa.table({"name": [f"alloc{i}" for i in range(rows)],
+                     "window.start": pa.array([window_start] * rows, pa.timestamp("ns")),
+                     "window.end": pa.array([window_start + datetime.timedelta(days=1)] * rows, pa.timestamp("ns"))})
+
+
+def put_parquet(s3, date, body, cluster_name="cluster-one"):
+    year, month = date.split("-")[0:2]
+    s3.put_object(Bucket=main.S3_BUCKET_NAME, Key=f"{PREFIX}year={year}/month={month}/{date}_{cluster_name}"
+                                                  f".snappy.parquet", Body=body)
+
+
+def test_footer_is_read_with_ranged_gets(s3):
+    table = pa.table({f"properties.labels.label_{i}": ["value"] for i in range(3000)})
+    s3.put_object(Bucket=main.S3_BUCKET_NAME, Key="wide.parquet", Body=parquet_bytes(table))
+
+    metadata = main.read_s3_parquet_footer(s3, main.S3_BUCKET_NAME, "wide.parquet")
+
+    assert metadata.serialized_size > 65536
+    assert metadata.num_rows == 1
+    assert metadata.schema.to_arrow_schema().equals(table.schema)
+
+
+def test_uploads_are_verified(monkeypatch, s3, kubecost):
+    monkeypatch.setattr(main, "VERIFY_UPLOADS", True)
+    verify = main.verify_uploaded_kubecost_allocation_parquet
+    verifications = []
+
+    def record_verification(*args):
+        verifications.append(verify(*args))
+        return verifications[-1]
+
+    monkeypatch.setattr(main, "verify_uploaded_kubecost_allocation_parquet", record_verification)
+    main.reset_run_telemetry()
+
+    main.main()
+
+    assert verifications == [True]
+    assert main.run_telemetry["upload_retries"] == 0
+
+
+def test_failed_verification_uploads_again(monkeypatch, s3, kubecost, read_uploaded_parquet):
+    monkeypatch.setattr(main, "VERIFY_UPLOADS", True)
+    upload = main.upload_kubecost_allocation_parquet_to_s3
+    uploads = []
+
+    # The first upload is truncated, as if the object was partially written
+    def upload_partially_once(s3_bucket_name, cluster_id, month, year, assume_role_response, parquet_file_path):
+        upload(s3_bucket_name, cluster_id, month, year, assume_role_response, parquet_file_path)
+        uploads.append(parquet_file_path)
+        if len(uploads) == 1:
+            put_parquet(s3, parquet_file_path.split("/")[-1].split("_")[0], open(parquet_file_path, "rb").read()[:-100])
+
+    monkeypatch.setattr(main, "upload_kubecost_allocation_parquet_to_s3", upload_partially_once)
+    main.reset_run_telemetry()
+
+    main.main()
+
+    assert len(uploads) == 2
+    assert main.run_telemetry["upload_retries"] == 1
+    assert next(iter(read_uploaded_parquet().values())).num_rows == 200
+
+
+def test_verify_s3_parquet_objects(s3, caplog):
+    put_parquet(s3, "2024-01-01", parquet_bytes(allocation_table("2024-01-01")))
+    put_parquet(s3, "2024-01-02", parquet_bytes(allocation_table("2024-01-02").append_column("extra", pa.array(
+        ["x"] * 3))))
+    put_parquet(s3, "2024-01-03", parquet_bytes(allocation_table("2024-01-02")))
+    put_parquet(s3, "2024-01-04", parquet_bytes(allocation_table("2024-01-04"))[:-10])
+    put_parquet(s3, "2024-01-05", parquet_bytes(allocation_table("2024-01-05", rows=0)))
+    put_parquet(s3, "2024-01-03", parquet_bytes(allocation_table("2024-01-03")), cluster_name="cluster-two")
+
+    with caplog.at_level(logging.INFO):
+        assert main.verify_s3_parquet_objects(main.S3_BUCKET_NAME, PREFIX, "cluster-one", 4, None) == 3
+        assert main.verify_s3_parquet_objects(main.S3_BUCKET_NAME, PREFIX, None, 4, None) == 3
+
+    errors = [x.getMessage() for x in caplog.records if x.levelno == logging.ERROR]
+    assert any("2024-01-03_cluster-one" in x and "are outside of 2024-01-03" in x for x in errors)
+    assert any("2024-01-04_cluster-one" in x and "unable to read the Parquet footer" in x for x in errors)
+    assert any("2024-01-05_cluster-one" in x and "the file contains no rows" in x for x in errors)
+    assert "Schema drift in" in caplog.text and "added columns: extra" in caplog.text
+
+
+def test_verify_uses_the_shared_aws_client(s3):
+    put_parquet(s3, "2024-01-01", parquet_bytes(allocation_table("2024-01-01")))
+    main.reset_run_telemetry()
+
+    for _ in range(2):
+        assert main.verify_s3_parquet_objects(main.S3_BUCKET_NAME, PREFIX, "cluster-one", 3, None) == 0
+
+    s3_clients = [x for x in main.aws_clients.values() if x.meta.service_model.service_name == "s3"]
+    assert len(s3_clients) == 1
+    assert s3_clients[0].meta.config.max_pool_connections == 3
+
+    # The client counts the retries of its API calls in the run telemetry
+    s3_clients[0].meta.events.emit("after-call.s3.GetObject", parsed={"ResponseMetadata": {"RetryAttempts": 2}},
+                                   model=None, http_response=None, context={})
+    assert main.run_telemetry["aws_retries"] == 2
@@ -0,0 +1,75 @@
+import pytest
+
+import main
+
+
+def collect_dataframe(monkeypatch, s3, read_uploaded_parquet, collection_strategy):
+    """Collects a date with the given collection strategy, and returns its rows (removing them from S3)."""
+
+    monkeypatch.setattr(main, "COLLECTION_STRATEGY", collection_strategy)
+    main.main()
+    [table] = read_uploaded_parquet().values()
+    s3.delete_objects(Bucket=main.S3_BUCKET_NAME, Delete={"Objects": [{"Key": x} for x in read_uploaded_parquet()]})
+    return table.to_pandas().set_index("name").sort_index()
+
+
+@pytest.mark.parametrize("sub_window_hours", [1, 6])
+def test_windows_are_accumulated_into_daily_rows(monkeypatch, s3, kubecost, read_uploaded_parquet, sub_window_hours):
+    monkeypatch.setattr(main, "KUBECOST_SUB_WINDOW_HOURS", sub_window_hours)
+    monkeypatch.setattr(main, "TRANSFORM_CHUNK_SIZE", 80)
+    hourly_df = collect_dataframe(monkeypatch, s3, read_uploaded_parquet, "paginated")
+    kubecost.requests.clear()
+
+    daily_df = collect_dataframe(monkeypatch, s3, read_uploaded_parquet, "windowed")
+
+    # An accumulated API call per sub-day window, and a single daily row per allocation
+    windows = [x for x in kubecost.requests if x.get("aggregate") != "cluster"]
+    assert len(windows) == 24 // sub_window_hours
+    assert all(x["accumulate"] == "True" for x in windows)
+    assert len(daily_df) == 200
+    assert (daily_df["window.end"] - daily_df["window.start"]).eq(main.pd.Timedelta(days=1)).all()
+
+    # The additive fields are the sums of the day, and the averages are weighted by minutes.
+    # The stub's allocations have the same costs and bytes in any window (only the minutes and the resource hours
+    # depend on the window length), so they're summed over the sub-day windows instead of the hours
+    hourly_sums = hourly_df.groupby(level=0)[main.KUBECOST_ADDITIVE_COLUMNS].sum()
+    for column in main.KUBECOST_ADDITIVE_COLUMNS:
+        if column == "minutes" or column.endswith("Hours"):
+            expected = hourly_sums[column]
+        else:
+            expected = hourly_sums[column] / sub_window_hours
+        assert daily_df[column].to_numpy() == pytest.approx(expected.to_numpy()), column
+    assert (daily_df["minutes"] == 1440).all()
+    for column in main.KUBECOST_MINUTE_WEIGHTED_COLUMNS + ["cpuCores", "ramBytes"]:
+        assert daily_df[column].to_numpy() == pytest.approx(
+            hourly_df.groupby(level=0)[column].mean().to_numpy()), column
+
+
+def test_allocation_missing_from_some_windows_spans_the_gap(monkeypatch, s3, kubecost, read_uploaded_parquet):
+    gap_allocation, first_window_allocation = "cluster-one/node/ns0/pod0/c0", "cluster-one/node/ns1/pod1/c1"
+    time_set = kubecost.time_set
+
+    # One allocation is missing from the 2 middle windows, and another one exists in the first window only
+    def time_set_with_gaps(aggregate, allocation_filter, window, minutes):
+        allocations = time_set(aggregate, allocation_filter, window, minutes)
+        if window[0].endswith(("T06:00:00Z", "T12:00:00Z")):
+            allocations.pop(gap_allocation, None)
+        if not window[0].endswith("T00:00:00Z"):
+            allocations.pop(first_window_allocation, None)
+        return allocations
+
+    monkeypatch.setattr(kubecost, "time_set", time_set_with_gaps)
+    monkeypatch.setattr(main, "KUBECOST_SUB_WINDOW_HOURS", 6)
+
+    daily_df = collect_dataframe(monkeypatch, s3, read_uploaded_parquet, "windowed")
+
+    # As in Kubecost's accumulation, the minutes are the span from the earliest start to the latest end, so the
+    # averages and the derived fields are spread over the gap (12 hours of 0.5 cores over a span of 24 hours)
+    assert daily_df.loc[gap_allocation, "minutes"] == 1440
+    assert daily_df.loc[gap_allocation, "cpuCoreHours"] == pytest.approx(6)
+    assert daily_df.loc[gap_allocation, "cpuCores"] == pytest.approx(0.25)
+    assert daily_df.loc[gap_allocation, "cpuCoreRequestAverage"] == pytest.approx(0.25)
+    assert daily_df.loc[gap_allocation, "ramBytes"] == pytest.approx(0.5e9)
+    assert daily_df.loc[first_window_allocation, "minutes"] == 360
+    assert daily_df.loc[first_window_allocation, "cpuCores"] == pytest.approx(0.5)
+    assert "start" not in daily_df.columns and "end" not in daily_df.columns